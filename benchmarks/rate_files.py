@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Times reading and writing a synthetic rate file in each rate file format,
+along with the original (pure-Python) YAML dump and FullLoader approach: -
+
+    ./benchmarks/rate_files.py --rates 100000
+"""
+import argparse
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+import yaml
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'tools'))
+from rate_files import read_rates, write_rates  # pylint: disable=wrong-import-position
+
+
+def _synthetic_rates(num_rates: int) -> List[Dict[str, Any]]:
+    return [{'collection': f'collection-{i % 50}',
+             'job': f'job-{i}',
+             'version': f'1.{i % 10}.0',
+             'rate': f'{(i % 1000) / 100:.2f}',
+             'comment': 'Synthetic rate'} for i in range(num_rates)]
+
+
+def _time(func: Callable[[], Any]) -> float:
+    start: float = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main(c_args: argparse.Namespace) -> None:
+    """Main function."""
+
+    rates: List[Dict[str, Any]] = _synthetic_rates(c_args.rates)
+    print(f"{c_args.rates} rates")
+    print(f"{'Format':<22} | {'Write (s)':>9} | {'Read (s)':>9} | {'Size (MiB)':>10}")
+    print(f"{'-' * 23}+{'-' * 11}+{'-' * 11}+{'-' * 11}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        # The original approach (for comparison)
+        filename: str = os.path.join(tmp_dir, 'original.yaml')
+        write_s: float = _time(lambda: Path(filename).write_text(
+            yaml.dump(rates, default_flow_style=False), encoding='utf8'))
+        read_s: float = _time(lambda: yaml.load(
+            Path(filename).read_text(encoding='utf8'), Loader=yaml.FullLoader))
+        size_mib: float = os.path.getsize(filename) / 1048576
+        print(f"{'yaml (original)':<22} | {write_s:9.2f} | {read_s:9.2f} | {size_mib:10.1f}")
+
+        for extension in ('.yaml', '.jsonl'):
+            filename = os.path.join(tmp_dir, f'rates{extension}')
+            write_s = _time(lambda: write_rates(filename, iter(rates), header=['Benchmark']))
+            read_s = _time(lambda: sum(1 for _ in read_rates(filename)))
+            size_mib = os.path.getsize(filename) / 1048576
+            print(f"{extension[1:]:<22} | {write_s:9.2f} | {read_s:9.2f} | {size_mib:10.1f}")
+
+
+if __name__ == "__main__":
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        prog="rate_files",
+        description="Times reading and writing rate files"
+    )
+    parser.add_argument('--rates', type=int, help='The number of rates', default=100000)
+    args: argparse.Namespace = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""Runs the tools against the local stand-in (see stand_in.py) at a number of
+scales, reporting each tool's wall time and the number of requests (and
+connections) it made, so scaling regressions can be found without a live
+Squonk2 deployment: -
+
+    ./benchmarks/scaling.py --scales 10,100,1000 --json results.json
+    ./benchmarks/scaling.py --scales 10,100 --baseline results.json
+
+Each tool is run (as a separate process) against freshly generated data
+and with empty token, charge and manifest caches. With --baseline the
+results are compared with an earlier --json file, and the benchmark fails
+if a tool makes more requests, or takes longer (by more than --tolerance),
+than it did.
+"""
+import argparse
+from datetime import date, timedelta
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import yaml
+
+import stand_in
+
+_TOOLS_DIRECTORY: Path = Path(__file__).resolve().parent.parent / 'tools'
+sys.path.insert(0, str(_TOOLS_DIRECTORY))
+from rate_files import write_rates  # pylint: disable=wrong-import-position
+
+_ENVIRONMENT: str = 'stand-in'
+_TARGET_ENVIRONMENT: str = 'stand-in-target'
+
+# Each benchmark is a tool and a function that returns its arguments,
+# given the dataset, a temporary directory (for any input files)
+# and the number of workers.
+_BENCHMARKS: List[Tuple[str, Callable[[stand_in.Dataset, Path, str], List[str]]]] = [
+    ('get-orgs-units-products',
+     lambda dataset, tmp_dir, workers: [_ENVIRONMENT, '--workers', workers]),
+    ('org-jobs',
+     lambda dataset, tmp_dir, workers: [_ENVIRONMENT, dataset.benchmark_org_id, '--workers', workers]),
+    ('coins',
+     lambda dataset, tmp_dir, workers: [_ENVIRONMENT, '--org', dataset.benchmark_org_id, '--workers', workers]),
+    ('get-job-executions',
+     lambda dataset, tmp_dir, workers: [_ENVIRONMENT, dataset.benchmark_org_id,
+                                        str(date.today() - timedelta(days=90)), '--format', 'csv']),
+    ('sync-charges',
+     lambda dataset, tmp_dir, workers: [_ENVIRONMENT, '--org', dataset.benchmark_org_id,
+                                        '--database', str(tmp_dir / 'charges.db'), '--workers', workers]),
+    ('save-er',
+     lambda dataset, tmp_dir, workers: [_ENVIRONMENT, str(tmp_dir / 'saved-rates.jsonl')]),
+    ('load-er',
+     lambda dataset, tmp_dir, workers: [_ENVIRONMENT, _rates_file(dataset, tmp_dir), '--workers', workers]),
+    ('sync-er',
+     lambda dataset, tmp_dir, workers: [_ENVIRONMENT, _TARGET_ENVIRONMENT, '--workers', workers]),
+    ('load-job-manifests',
+     lambda dataset, tmp_dir, workers: [_ENVIRONMENT, _manifests_file(dataset, tmp_dir), '--workers', workers]),
+    ('create-organisations-and-units',
+     lambda dataset, tmp_dir, workers: [_ENVIRONMENT, _organisations_file(dataset, tmp_dir),
+                                        '--workers', workers]),
+    ('delete-old-instances',
+     lambda dataset, tmp_dir, workers: [_ENVIRONMENT, '--workers', workers, '--do-it']),
+    ('delete-all-instances',
+     lambda dataset, tmp_dir, workers: [_ENVIRONMENT, '--workers', workers, '--do-it']),
+    ('delete-test-projects',
+     lambda dataset, tmp_dir, workers: [_ENVIRONMENT, '--workers', workers, '--do-it']),
+]
+
+
+def _rates_file(dataset: stand_in.Dataset, tmp_dir: Path) -> str:
+    """A rate file that changes every rate."""
+    filename: str = str(tmp_dir / 'rates.jsonl')
+    write_rates(filename,
+                ({'collection': job['collection'], 'job': job['job'], 'version': job['version'],
+                  'rate': '1.00', 'comment': 'Benchmark'} for job in dataset.jobs.values()),
+                header=['Benchmark'])
+    return filename
+
+
+def _manifests_file(dataset: stand_in.Dataset, tmp_dir: Path) -> str:
+    """A manifest file with one manifest for each job collection."""
+    filename: Path = tmp_dir / 'manifests.yaml'
+    collections: List[str] = sorted({job['collection'] for job in dataset.jobs.values()})
+    filename.write_text(yaml.dump([{'url': f'https://example.com/{collection}/manifest.yaml'}
+                                   for collection in collections]), encoding='utf8')
+    return str(filename)
+
+
+def _organisations_file(dataset: stand_in.Dataset, tmp_dir: Path) -> str:
+    """An organisation file with new organisations (each with two units),
+    as many as there are Units in the benchmark Organisation.
+    """
+    filename: Path = tmp_dir / 'organisations.yaml'
+    num_organisations: int = sum(1 for unit in dataset.units.values()
+                                 if unit['organisation_id'] == dataset.benchmark_org_id)
+    filename.write_text(yaml.dump([{'name': f'New Organisation {n}', 'owner': 'dmit-user-admin',
+                                    'units': [{'name': 'Unit A'}, {'name': 'Unit B'}]}
+                                   for n in range(num_organisations)]), encoding='utf8')
+    return str(filename)
+
+
+def _run(server: stand_in.StandIn,
+         tool: str,
+         scale: int,
+         args_func: Callable[[stand_in.Dataset, Path, str], List[str]],
+         c_args: argparse.Namespace) -> Dict[str, Any]:
+    """Runs a tool against freshly generated data, returning its result."""
+    dataset: stand_in.Dataset = stand_in.generate(scale, seed=c_args.seed)
+    with tempfile.TemporaryDirectory() as tmp_name:
+        tmp_dir: Path = Path(tmp_name)
+        stand_in.write_environments(str(tmp_dir / 'environments'), server, [_ENVIRONMENT, _TARGET_ENVIRONMENT])
+        env: Dict[str, str] = dict(os.environ,
+                                   SQUONK2_ENVIRONMENTS_FILE=str(tmp_dir / 'environments'),
+                                   SQUONK2_TOKEN_CACHE_FILE=str(tmp_dir / 'tokens'),
+                                   SQUONK2_CHARGE_CACHE_DIRECTORY=str(tmp_dir / 'charge-cache'),
+                                   SQUONK2_MANIFEST_STATE_FILE=str(tmp_dir / 'manifests'),
+                                   SQUONK2_CHARGE_DATABASE=str(tmp_dir / 'charges.db'))
+        command: List[str] = [sys.executable, str(_TOOLS_DIRECTORY / f'{tool}.py'),
+                              *args_func(dataset, tmp_dir, str(c_args.workers))]
+        server.reset(dataset)
+        start: float = time.perf_counter()
+        completed: subprocess.CompletedProcess = subprocess.run(
+            command, env=env, cwd=tmp_dir, capture_output=True, text=True, check=False)
+        wall_s: float = time.perf_counter() - start
+    if c_args.verbose or completed.returncode:
+        print(completed.stdout[-2000:] + completed.stderr[-2000:], file=sys.stderr)
+    return {'tool': tool,
+            'scale': scale,
+            'wall_s': round(wall_s, 3),
+            'requests': sum(server.requests.values()),
+            'connections': server.connections,
+            'exit': completed.returncode}
+
+
+def _regressions(results: List[Dict[str, Any]],
+                 baseline: List[Dict[str, Any]],
+                 tolerance: float) -> List[str]:
+    """Compares results with a baseline, returning a description of each regression."""
+    baseline_results: Dict[Tuple[str, int], Dict[str, Any]] = {
+        (result['tool'], result['scale']): result for result in baseline
+    }
+    regressions: List[str] = []
+    for result in results:
+        previous: Optional[Dict[str, Any]] = baseline_results.get((result['tool'], result['scale']))
+        if not previous:
+            continue
+        if result['requests'] > previous['requests']:
+            regressions.append(f"{result['tool']} (scale {result['scale']})"
+                               f" made {result['requests']} requests (was {previous['requests']})")
+        if result['wall_s'] > previous['wall_s'] * tolerance:
+            regressions.append(f"{result['tool']} (scale {result['scale']})"
+                               f" took {result['wall_s']}s (was {previous['wall_s']}s)")
+    return regressions
+
+
+def main(c_args: argparse.Namespace) -> None:
+    """Main function."""
+
+    server: stand_in.StandIn = stand_in.StandIn(('127.0.0.1', 0),
+                                                stand_in.generate(1, seed=c_args.seed),
+                                                latency_s=c_args.latency_ms / 1000,
+                                                error_rate=c_args.error_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results: List[Dict[str, Any]] = []
+    print(f"{'Tool':<31} | {'Scale':>5} | {'Wall (s)':>8} | {'Requests':>8}"
+          f" | {'Connections':>11} | {'Exit':>4}")
+    print(f"{'-' * 32}+{'-' * 7}+{'-' * 10}+{'-' * 10}+{'-' * 13}+{'-' * 5}")
+    for tool, args_func in _BENCHMARKS:
+        if c_args.tools and tool not in c_args.tools:
+            continue
+        for scale in c_args.scales:
+            result: Dict[str, Any] = _run(server, tool, scale, args_func, c_args)
+            results.append(result)
+            print(f"{tool:<31} | {scale:>5} | {result['wall_s']:8.2f}"
+                  f" | {result['requests']:>8} | {result['connections']:>11}"
+                  f" | {result['exit']:>4}", flush=True)
+    server.shutdown()
+
+    if c_args.json:
+        Path(c_args.json).write_text(json.dumps(results, indent=2), encoding='utf8')
+
+    if c_args.baseline:
+        baseline: List[Dict[str, Any]] = json.loads(Path(c_args.baseline).read_text(encoding='utf8'))
+        regressions: List[str] = _regressions(results, baseline, c_args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Times the tools against the local stand-in at a number of scales"
+    )
+    parser.add_argument('--scales', type=lambda value: [int(scale) for scale in value.split(',')],
+                        default=[10, 100, 1000], help='Comma-separated scales (default 10,100,1000)')
+    parser.add_argument('--tools', type=lambda value: value.split(','),
+                        help='Comma-separated tools to run (the default is all of them)')
+    parser.add_argument('--workers', type=int, default=1, help='The --workers given to the tools')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='A delay (milliseconds) added to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='The fraction (0 to 1) of API requests that fail (with a 503)')
+    parser.add_argument('--seed', type=int, default=0, help='The seed for the synthetic data')
+    parser.add_argument('--json', type=str, help='A file to write the results to')
+    parser.add_argument('--baseline', type=str, help='A results file (see --json) to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='How many times slower than the baseline a tool can be (default 1.5)')
+    parser.add_argument('--verbose', action='store_true', help='Print the output of each tool')
+    args: argparse.Namespace = parser.parse_args()
+    if args.workers < 1:
+        parser.error("The number of workers must be at least 1")
+
+    main(args)
@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+"""A local stand-in for the Squonk2 Account Server (AS), Data Manager (DM)
+and Keycloak, serving synthetic data so the tools can be run (and timed,
+see scaling.py) without a live Squonk2 deployment: -
+
+    ./benchmarks/stand_in.py --scale 100 --latency-ms 20
+
+The AS API is served under /account-server-api, the DM API under
+/data-manager-api and Keycloak's token endpoint under /auth. An environments
+file entry for the stand-in is printed when it starts. Only the endpoints
+(and response fields) used by the tools are implemented. With --error-rate
+a fraction of the API requests fail (with a 503) to exercise retries.
+
+The data is generated from a seed, so the same scale always serves the same
+data. A scale of 1 has one Unit and Product in the benchmark Organisation,
+two Projects (each with three Instances) and ten Jobs. Everything grows
+linearly with the scale. Charges are generated when they're requested.
+Billing predictions are not calculated (so coins reports them as mismatches).
+"""
+import argparse
+import base64
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from pathlib import Path
+import random
+import re
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+import uuid
+
+import yaml
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'tools'))
+from common import TEST_USER_NAMES  # pylint: disable=wrong-import-position
+
+# The number of billing periods (including the current one) that have charges
+NUM_PERIODS: int = 24
+
+_KEYCLOAK_REALM: str = 'squonk2'
+_AS_PREFIX: str = '/account-server-api'
+_DM_PREFIX: str = '/data-manager-api'
+_TOKEN_LIFETIME_S: int = 3600
+
+
+@dataclass
+class Dataset:
+    """The synthetic AS and DM objects, indexed by their IDs.
+    Products are given the number of billing periods they've existed for.
+    """
+    organisations: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    units: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    products: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    projects: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    instances: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    jobs: Dict[int, Dict[str, Any]] = field(default_factory=dict)
+    # Job IDs indexed by (collection, job, version)
+    job_ids: Dict[Tuple[str, str, str], int] = field(default_factory=dict)
+    usernames: List[str] = field(default_factory=list)
+    # The Organisation that grows with the scale
+    benchmark_org_id: str = ''
+    seed: int = 0
+
+
+def generate(scale: int, *, seed: int = 0) -> Dataset:
+    """Generates the synthetic data for a scale."""
+    rng: random.Random = random.Random(f'{seed}|{scale}')
+    dataset: Dataset = Dataset(seed=seed)
+    dataset.usernames = TEST_USER_NAMES + [f'user-{n}' for n in range(5 * scale)]
+    now: datetime = datetime.utcnow()
+
+    def new_id(prefix: str) -> str:
+        return f'{prefix}-{uuid.UUID(int=rng.getrandbits(128), version=4)}'
+
+    def add_organisation(name: str) -> str:
+        org_id: str = new_id('org')
+        dataset.organisations[org_id] = {'id': org_id, 'name': name, 'owner': rng.choice(dataset.usernames)}
+        return org_id
+
+    def add_unit(org_id: str, name: str) -> str:
+        unit_id: str = new_id('unit')
+        dataset.units[unit_id] = {'id': unit_id, 'name': name, 'organisation_id': org_id, 'billing_day': 1}
+        return unit_id
+
+    def add_product(unit_id: str, name: str) -> None:
+        product_id: str = new_id('product')
+        dataset.products[product_id] = {'id': product_id, 'name': name, 'unit_id': unit_id,
+                                        'num_periods': rng.randint(1, NUM_PERIODS)}
+
+    add_organisation('Default')
+    dataset.benchmark_org_id = add_organisation('Benchmark')
+    for n in range(scale):
+        add_product(add_unit(dataset.benchmark_org_id, f'Unit {n}'), f'Product {n}')
+    # Other (small) Organisations
+    for n in range(scale // 10):
+        org_id: str = add_organisation(f'Organisation {n}')
+        add_product(add_unit(org_id, f'Organisation {n} Unit'), f'Organisation {n} Product')
+
+    for n in range(2 * scale):
+        project_id: str = new_id('project')
+        owner: str = rng.choice(dataset.usernames)
+        dataset.projects[project_id] = {'project_id': project_id, 'name': f'Project {n}', 'owner': owner}
+        for i in range(3):
+            instance_id: str = new_id('instance')
+            instance: Dict[str, Any] = {'id': instance_id, 'name': f'Instance {n}.{i}',
+                                        'owner': owner, 'project_id': project_id}
+            # Most instances have stopped (some of them a long time ago)
+            if i:
+                instance['stopped'] = (now - timedelta(hours=rng.randint(1, 24 * 14))).isoformat()
+            dataset.instances[instance_id] = instance
+
+    for job_id in range(1, 10 * scale + 1):
+        job: Dict[str, Any] = {'id': job_id,
+                               'collection': f'collection-{job_id % 20}',
+                               'job': f'job-{job_id}',
+                               'version': f'1.{job_id % 5}.0'}
+        # A few jobs have no rate
+        if job_id % 10:
+            job['rate'] = f'{rng.randint(1, 500) / 100:.2f}'
+            job['comment'] = 'Synthetic rate'
+        dataset.jobs[job_id] = job
+        dataset.job_ids[(job['collection'], job['job'], job['version'])] = job_id
+
+    return dataset
+
+
+def _period_start(today: date, pbp: int) -> date:
+    """The first day of a (monthly) billing period."""
+    months: int = today.year * 12 + today.month - 1 + pbp
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def _period_charges(dataset: Dataset, product_id: str, pbp: int, today: date) -> Dict[str, Any]:
+    """The (generated) charges for a Product's billing period."""
+    period_from: date = _period_start(today, pbp)
+    period_until: date = _period_start(today, pbp + 1)
+    charges: Dict[str, Any] = {'from': str(period_from), 'until': str(period_until),
+                               'processing_charges': [], 'storage_charges': {'items': []}}
+    product: Dict[str, Any] = dataset.products[product_id]
+    if -pbp >= product['num_periods']:
+        return charges
+
+    rng: random.Random = random.Random(f'{dataset.seed}|{product_id}|{period_from}')
+    last_day: date = today if pbp == 0 else period_until - timedelta(days=1)
+    num_days: int = (last_day - period_from).days + 1
+    for _ in range(rng.randint(0, 10)):
+        day: date = period_from + timedelta(days=rng.randrange(num_days))
+        timestamp: str = f'{day}T{rng.randrange(24):02d}:{rng.randrange(60):02d}:00'
+        job: Dict[str, Any] = dataset.jobs[rng.randint(1, len(dataset.jobs))]
+        processing_charge: Dict[str, Any] = {'charge': {
+            'coins': f'{rng.randint(1, 2000) / 100:.2f}',
+            'timestamp': timestamp,
+            'username': rng.choice(dataset.usernames),
+            'additional_data': {'job_collection': job['collection'],
+                                'job_job': job['job'],
+                                'job_version': job['version'],
+                                'started': timestamp},
+        }}
+        if pbp < 0 or rng.random() < 0.8:
+            processing_charge['closed'] = True
+        charges['processing_charges'].append(processing_charge)
+    charges['processing_charges'].sort(key=lambda pc: pc['charge']['timestamp'])
+
+    items: List[Dict[str, Any]] = charges['storage_charges']['items']
+    for day_offset in range(num_days):
+        items.append({'date': str(period_from + timedelta(days=day_offset)),
+                      'coins': f'{rng.randint(0, 100) / 100:.2f}',
+                      'additional_data': {'peak_bytes': rng.randint(0, 10 ** 9)}})
+    if pbp == 0:
+        items[-1]['additional_data'] = {'current_bytes': rng.randint(0, 10 ** 9)}
+        items[-1]['burn_rate'] = items[-1]['coins']
+    return charges
+
+
+def _product_detail(dataset: Dataset, product_id: str, today: date) -> Dict[str, Any]:
+    product: Dict[str, Any] = dataset.products[product_id]
+    unit: Dict[str, Any] = dataset.units[product['unit_id']]
+    org: Dict[str, Any] = dataset.organisations[unit['organisation_id']]
+    created: date = _period_start(today, 1 - product['num_periods'])
+    return {'product': {'id': product_id, 'name': product['name'], 'type': 'DATA_MANAGER_PROJECT_TIER_SUBSCRIPTION',
+                        'created': f'{created}T09:00:00'},
+            'unit': {'id': unit['id'], 'name': unit['name']},
+            'organisation': {'id': org['id'], 'name': org['name']},
+            'coins': {'allowance': '100', 'allowance_multiplier': '1.5', 'limit': '1000',
+                      'billing_day': unit['billing_day'],
+                      'remaining_days': (_period_start(today, 1) - today).days,
+                      'billing_prediction': '0.00'}}
+
+
+def _token(username: str) -> str:
+    """An (unsigned) JWT access token, enough for tools that read its expiry."""
+    def encode(content: Dict[str, Any]) -> str:
+        return base64.urlsafe_b64encode(json.dumps(content).encode()).decode().rstrip('=')
+    payload: Dict[str, Any] = {'preferred_username': username, 'exp': int(time.time()) + _TOKEN_LIFETIME_S}
+    return f"{encode({'alg': 'none', 'typ': 'JWT'})}.{encode(payload)}.stand-in"
+
+
+# A route's handler is given the server's dataset, the path match,
+# the query parameters and the (JSON) body,
+# and returns the response status code and (JSON) content.
+Handler = Callable[[Dataset, re.Match, Dict[str, str], Dict[str, Any]], Tuple[int, Optional[Any]]]
+_ROUTES: List[Tuple[str, re.Pattern, str, Handler]] = []
+
+
+def _route(method: str, pattern: str) -> Callable[[Handler], Handler]:
+    def register(handler: Handler) -> Handler:
+        _ROUTES.append((method, re.compile(f'^{pattern}$'), f'{method} {pattern}', handler))
+        return handler
+    return register
+
+
+@_route('POST', rf'/auth/realms/{_KEYCLOAK_REALM}/protocol/openid-connect/token')
+def _keycloak_token(_dataset, _match, _params, body):
+    return 200, {'access_token': _token(body.get('username', 'admin')), 'expires_in': _TOKEN_LIFETIME_S}
+
+
+@_route('GET', f'{_AS_PREFIX}/organisation')
+def _get_organisations(dataset, _match, _params, _body):
+    return 200, {'organisations': list(dataset.organisations.values())}
+
+
+@_route('POST', f'{_AS_PREFIX}/organisation')
+def _create_organisation(dataset, _match, _params, body):
+    org_id: str = f'org-{uuid.uuid4()}'
+    dataset.organisations[org_id] = {'id': org_id, 'name': body['name'], 'owner': body['owner']}
+    return 201, {'id': org_id}
+
+
+@_route('GET', f'{_AS_PREFIX}/organisation/([^/]+)')
+def _get_organisation(dataset, match, _params, _body):
+    org: Optional[Dict[str, Any]] = dataset.organisations.get(match.group(1))
+    return (200, org) if org else (404, {'error': 'No such organisation'})
+
+
+@_route('GET', f'{_AS_PREFIX}/organisation/([^/]+)/unit')
+def _get_units(dataset, match, _params, _body):
+    if match.group(1) not in dataset.organisations:
+        return 404, {'error': 'No such organisation'}
+    return 200, {'units': [unit for unit in dataset.units.values() if unit['organisation_id'] == match.group(1)]}
+
+
+@_route('POST', f'{_AS_PREFIX}/organisation/([^/]+)/unit')
+def _create_unit(dataset, match, _params, body):
+    if match.group(1) not in dataset.organisations:
+        return 404, {'error': 'No such organisation'}
+    unit_id: str = f'unit-{uuid.uuid4()}'
+    dataset.units[unit_id] = {'id': unit_id, 'name': body['name'], 'organisation_id': match.group(1),
+                              'billing_day': body['billing_day']}
+    return 201, {'id': unit_id}
+
+
+@_route('GET', f'{_AS_PREFIX}/product/organisation/([^/]+)')
+def _get_products_for_organisation(dataset, match, _params, _body):
+    today: date = date.today()
+    return 200, {'products': [_product_detail(dataset, product_id, today)
+                              for product_id, product in dataset.products.items()
+                              if dataset.units[product['unit_id']]['organisation_id'] == match.group(1)]}
+
+
+@_route('GET', f'{_AS_PREFIX}/product/unit/([^/]+)')
+def _get_products_for_unit(dataset, match, _params, _body):
+    today: date = date.today()
+    return 200, {'products': [_product_detail(dataset, product_id, today)
+                              for product_id, product in dataset.products.items()
+                              if product['unit_id'] == match.group(1)]}
+
+
+@_route('GET', f'{_AS_PREFIX}/product/([^/]+)')
+def _get_product(dataset, match, _params, _body):
+    if match.group(1) not in dataset.products:
+        return 404, {'error': 'No such product'}
+    return 200, {'product': _product_detail(dataset, match.group(1), date.today())}
+
+
+@_route('GET', f'{_AS_PREFIX}/charges/product/([^/]+)')
+def _get_product_charges(dataset, match, params, _body):
+    product_id: str = match.group(1)
+    if product_id not in dataset.products:
+        return 404, {'error': 'No such product'}
+    today: date = date.today()
+    if 'from' not in params:
+        return 200, _period_charges(dataset, product_id, int(params.get('pbp', 0)), today)
+    # Charges from a date (to today)
+    from_: str = params['from']
+    charges: Dict[str, Any] = {'from': from_, 'until': str(today + timedelta(days=1)),
+                               'processing_charges': [], 'storage_charges': {'items': []}}
+    for pbp in range(1 - NUM_PERIODS, 1):
+        if str(_period_start(today, pbp + 1)) <= from_:
+            continue
+        period: Dict[str, Any] = _period_charges(dataset, product_id, pbp, today)
+        charges['processing_charges'].extend(pc for pc in period['processing_charges']
+                                             if pc['charge']['timestamp'] >= from_)
+        charges['storage_charges']['items'].extend(item for item in period['storage_charges']['items']
+                                                   if item['date'] >= from_)
+    return 200, charges
+
+
+@_route('PATCH', f'{_DM_PREFIX}/user/account')
+def _set_admin_state(_dataset, _match, _params, _body):
+    return 204, None
+
+
+@_route('GET', f'{_DM_PREFIX}/project')
+def _get_projects(dataset, _match, params, _body):
+    projects: List[Dict[str, Any]] = list(dataset.projects.values())
+    if 'project_name' in params:
+        projects = [project for project in projects if project['name'] == params['project_name']]
+    return 200, {'projects': projects}
+
+
+@_route('DELETE', f'{_DM_PREFIX}/project/([^/]+)')
+def _delete_project(dataset, match, _params, _body):
+    if not dataset.projects.pop(match.group(1), None):
+        return 404, {'error': 'No such project'}
+    for instance_id in [i_id for i_id, instance in dataset.instances.items()
+                        if instance['project_id'] == match.group(1)]:
+        del dataset.instances[instance_id]
+    return 200, {}
+
+
+@_route('GET', f'{_DM_PREFIX}/instance')
+def _get_instances(dataset, _match, params, _body):
+    instances: List[Dict[str, Any]] = list(dataset.instances.values())
+    if 'project_id' in params:
+        instances = [instance for instance in instances if instance['project_id'] == params['project_id']]
+    return 200, {'instances': instances}
+
+
+@_route('GET', f'{_DM_PREFIX}/instance/([^/]+)')
+def _get_instance(dataset, match, _params, _body):
+    instance: Optional[Dict[str, Any]] = dataset.instances.get(match.group(1))
+    return (200, instance) if instance else (404, {'error': 'No such instance'})
+
+
+@_route('DELETE', f'{_DM_PREFIX}/instance/([^/]+)')
+def _delete_instance(dataset, match, _params, _body):
+    if not dataset.instances.pop(match.group(1), None):
+        return 404, {'error': 'No such instance'}
+    return 200, {}
+
+
+@_route('GET', f'{_DM_PREFIX}/job/exchange-rate')
+def _get_exchange_rates(dataset, _match, params, _body):
+    if params.get('only_undefined'):
+        return 200, {'exchange_rates': [{key: job[key] for key in ('id', 'collection', 'job', 'version')}
+                                        for job in dataset.jobs.values() if 'rate' not in job]}
+    return 200, {'exchange_rates': [dict(job) for job in dataset.jobs.values() if 'rate' in job]}
+
+
+@_route('GET', f'{_DM_PREFIX}/job/get-by-version')
+def _get_job_by_version(dataset, _match, params, _body):
+    job_id: Optional[int] = dataset.job_ids.get((params.get('collection'), params.get('job'), params.get('version')))
+    return (200, {'id': job_id}) if job_id else (404, {'error': 'No such job'})
+
+
+@_route('PUT', rf'{_DM_PREFIX}/job/(\d+)/exchange-rate')
+def _set_exchange_rate(dataset, match, _params, body):
+    job: Optional[Dict[str, Any]] = dataset.jobs.get(int(match.group(1)))
+    if not job:
+        return 404, {'error': 'No such job'}
+    job['rate'] = body['rate']
+    if 'comment' in body:
+        job['comment'] = body['comment']
+    return 204, None
+
+
+@_route('PUT', f'{_DM_PREFIX}/admin/job-manifest')
+def _put_job_manifest(_dataset, _match, _params, _body):
+    return 200, {}
+
+
+class StandIn(ThreadingHTTPServer):
+    """The stand-in server. Each request is answered (in its own thread)
+    after the configured latency, and counted (by route). A fraction
+    (the error rate) of the API requests are failed with a 503.
+    Connections are kept alive (HTTP/1.1) and counted.
+    """
+    daemon_threads: bool = True
+
+    def __init__(self,
+                 address: Tuple[str, int],
+                 dataset: Dataset,
+                 *,
+                 latency_s: float = 0.0,
+                 error_rate: float = 0.0) -> None:
+        super().__init__(address, _RequestHandler)
+        self.dataset: Dataset = dataset
+        self.latency_s: float = latency_s
+        self.error_rate: float = error_rate
+        self.requests: Counter = Counter()
+        self.connections: int = 0
+        self.lock: threading.Lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        """The server's URL."""
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def reset(self, dataset: Dataset) -> None:
+        """Replaces the dataset and forgets the requests that have been counted."""
+        with self.lock:
+            self.dataset = dataset
+            self.requests.clear()
+            self.connections = 0
+
+    def environment(self) -> Dict[str, str]:
+        """The environments file entry for the stand-in."""
+        return {'keycloak-hostname': self.url,
+                'keycloak-realm': _KEYCLOAK_REALM,
+                'keycloak-as-client-id': 'account-server-api',
+                'keycloak-dm-client-id': 'data-manager-api',
+                'as-hostname': self.url,
+                'dm-hostname': self.url,
+                'admin-user': 'dmit-user-admin',
+                'admin-password': 'stand-in'}
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    server: StandIn
+    protocol_version: str = 'HTTP/1.1'
+    # Buffer each response (its headers and body are sent in one write, when
+    # the request has been handled) and send it without waiting. Otherwise, on
+    # a kept-alive connection, Nagle's algorithm holds the body back until the
+    # client's delayed ACK of the headers, adding ~40ms to every request.
+    wbufsize: int = -1
+    disable_nagle_algorithm: bool = True
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        self._handle('GET')
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        self._handle('POST')
+
+    def do_PUT(self) -> None:  # pylint: disable=invalid-name
+        self._handle('PUT')
+
+    def do_PATCH(self) -> None:  # pylint: disable=invalid-name
+        self._handle('PATCH')
+
+    def do_DELETE(self) -> None:  # pylint: disable=invalid-name
+        self._handle('DELETE')
+
+    def log_message(self, format: str, *args: Any) -> None:  # pylint: disable=redefined-builtin
+        pass
+
+    def _handle(self, method: str) -> None:
+        if self.server.latency_s:
+            time.sleep(self.server.latency_s)
+        url = urlsplit(self.path)
+        params: Dict[str, str] = {key: values[0] for key, values in parse_qs(url.query).items()}
+        content: bytes = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        body: Dict[str, Any] = {}
+        # (the DM API and Keycloak are sent forms, the AS API is sent JSON)
+        if self.headers.get('Content-Type') == 'application/x-www-form-urlencoded':
+            body = {key: values[0] for key, values in parse_qs(content.decode()).items()}
+        elif content:
+            body = json.loads(content)
+
+        status: int = 404
+        response: Optional[Any] = {'error': 'Not implemented by the stand-in'}
+        route_name: str = f'{method} (unknown)'
+        for route_method, pattern, name, handler in _ROUTES:
+            match: Optional[re.Match] = pattern.match(url.path)
+            if route_method != method or not match:
+                continue
+            route_name = name
+            if not url.path.startswith('/auth') and not self.headers.get('Authorization'):
+                status, response = 401, {'error': 'No token'}
+            elif not url.path.startswith('/auth') and random.random() < self.server.error_rate:
+                status, response = 503, {'error': 'Unavailable (stand-in error)'}
+            else:
+                with self.server.lock:
+                    status, response = handler(self.server.dataset, match, params, body)
+            break
+        with self.server.lock:
+            self.server.requests[route_name] += 1
+
+        self.send_response(status)
+        if response is None:
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        payload: bytes = json.dumps(response).encode()
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def write_environments(filename: str, server: StandIn, names: List[str]) -> None:
+    """Writes an environments file where each named environment is the stand-in."""
+    environments: Dict[str, Any] = {'default': names[0],
+                                    'environments': {name: server.environment() for name in names}}
+    Path(filename).write_text(yaml.dump(environments, default_flow_style=False), encoding='utf8')
+
+
+def main(c_args: argparse.Namespace) -> None:
+    """Main function."""
+
+    dataset: Dataset = generate(c_args.scale, seed=c_args.seed)
+    server: StandIn = StandIn((c_args.host, c_args.port), dataset,
+                              latency_s=c_args.latency_ms / 1000, error_rate=c_args.error_rate)
+    print(f"Serving scale {c_args.scale} at {server.url}"
+          f" (Benchmark Organisation {dataset.benchmark_org_id})")
+    print(yaml.dump({'environments': {'stand-in': server.environment()}}, default_flow_style=False))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    for route_name, count in sorted(server.requests.items()):
+        print(f"{count:>8} {route_name}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="A local stand-in for the Squonk2 AS, DM and Keycloak"
+    )
+    parser.add_argument('--scale', type=int, default=1, help='The size of the synthetic data')
+    parser.add_argument('--seed', type=int, default=0, help='The seed for the synthetic data')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='The address to serve on')
+    parser.add_argument('--port', type=int, default=8080, help='The port to serve on')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='A delay (milliseconds) added to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='The fraction (0 to 1) of API requests that fail (with a 503)')
+    args: argparse.Namespace = parser.parse_args()
+    if args.scale < 1:
+        parser.error("The scale must be at least 1")
+
+    main(args)
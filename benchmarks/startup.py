@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""Measures how long each tool takes to start (to import the modules it uses)
+using Python's '-X importtime' option, so import regressions can be found: -
+
+    ./benchmarks/startup.py --json startup.json
+    ./benchmarks/startup.py --baseline startup.json
+
+Each tool is run (with '--help', so it only imports its modules and parses
+its arguments) directly and through the squonk2-tools entry point.
+The import time reported is the total for the interpreter (including its own
+start-up) and the slowest modules are listed. With --baseline the results are
+compared with an earlier --json file, and the benchmark fails if a tool takes
+longer (by more than --tolerance) to import its modules than it did.
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+_TOOLS_DIRECTORY: Path = Path(__file__).resolve().parent.parent / 'tools'
+_ENTRY_POINT: str = 'squonk2-tools'
+
+
+def _import_times(stderr: str) -> Tuple[int, List[Tuple[int, str]]]:
+    """Parses '-X importtime' output, returning the total import time
+    (microseconds) and the (self) time of each module.
+    """
+    total_us: int = 0
+    modules: List[Tuple[int, str]] = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((int(self_us), name.strip()))
+        # (top-level imports are indented by a single space)
+        if not name.startswith('  '):
+            total_us += int(cumulative_us)
+    return total_us, modules
+
+
+def _run(label: str, command: List[str], c_args: argparse.Namespace) -> Dict[str, Any]:
+    """Runs a command (a number of times) with '-X importtime',
+    returning its fastest import time and slowest modules.
+    """
+    best_us: Optional[int] = None
+    modules: List[Tuple[int, str]] = []
+    with tempfile.TemporaryDirectory() as tmp_name:
+        env: Dict[str, str] = dict(os.environ,
+                                   SQUONK2_ENVIRONMENTS_FILE=str(Path(tmp_name) / 'environments'))
+        for _ in range(c_args.repeat):
+            completed: subprocess.CompletedProcess = subprocess.run(
+                [sys.executable, '-X', 'importtime', *command],
+                env=env, cwd=tmp_name, capture_output=True, text=True, check=False)
+            total_us, run_modules = _import_times(completed.stderr)
+            if best_us is None or total_us < best_us:
+                best_us = total_us
+                modules = run_modules
+    slowest: List[Tuple[int, str]] = sorted(modules, reverse=True)[:c_args.top]
+    return {'tool': label,
+            'import_ms': round((best_us or 0) / 1000, 1),
+            'modules': len(modules),
+            'slowest': [f'{name} ({self_us / 1000:.1f}ms)' for self_us, name in slowest]}
+
+
+def main(c_args: argparse.Namespace) -> None:
+    """Main function."""
+
+    # (the tools are the scripts, the modules that start with a '#!' line)
+    tools: List[str] = sorted(path.stem for path in _TOOLS_DIRECTORY.glob('*.py')
+                              if path.stem != _ENTRY_POINT and path.read_bytes().startswith(b'#!'))
+    entry_point: str = str(_TOOLS_DIRECTORY / f'{_ENTRY_POINT}.py')
+
+    results: List[Dict[str, Any]] = []
+    print(f"{'Tool':<46} | {'Import (ms)':>11} | {'Modules':>7} | Slowest")
+    print(f"{'-' * 47}+{'-' * 13}+{'-' * 9}+{'-' * 20}")
+    runs: List[Tuple[str, List[str]]] = [('python', ['-c', 'pass']),
+                                         (_ENTRY_POINT, [entry_point, '--help'])]
+    for tool in tools:
+        if c_args.tools and tool not in c_args.tools:
+            continue
+        runs.append((tool, [str(_TOOLS_DIRECTORY / f'{tool}.py'), '--help']))
+        runs.append((f'{_ENTRY_POINT} {tool}', [entry_point, tool, '--help']))
+    for label, command in runs:
+        result: Dict[str, Any] = _run(label, command, c_args)
+        results.append(result)
+        print(f"{label:<46} | {result['import_ms']:11.1f} | {result['modules']:>7}"
+              f" | {', '.join(result['slowest'])}", flush=True)
+
+    if c_args.json:
+        Path(c_args.json).write_text(json.dumps(results, indent=2), encoding='utf8')
+
+    if c_args.baseline:
+        baseline: Dict[str, Dict[str, Any]] = {
+            result['tool']: result for result in json.loads(Path(c_args.baseline).read_text(encoding='utf8'))
+        }
+        regressions: List[str] = []
+        for result in results:
+            previous: Optional[Dict[str, Any]] = baseline.get(result['tool'])
+            if previous and result['import_ms'] > previous['import_ms'] * c_args.tolerance:
+                regressions.append(f"{result['tool']} took {result['import_ms']}ms"
+                                   f" to import (was {previous['import_ms']}ms)")
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Times how long each tool takes to import its modules"
+    )
+    parser.add_argument('--tools', type=lambda value: value.split(','),
+                        help='Comma-separated tools to run (the default is all of them)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='How many times to run each tool (the fastest run is reported)')
+    parser.add_argument('--top', type=int, default=3, help='The number of slowest modules to list')
+    parser.add_argument('--json', type=str, help='A file to write the results to')
+    parser.add_argument('--baseline', type=str, help='A results file (see --json) to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='How many times slower than the baseline a tool can be (default 1.5)')
+    args: argparse.Namespace = parser.parse_args()
+    if args.repeat < 1:
+        parser.error("The number of repeats must be at least 1")
+
+    main(args)
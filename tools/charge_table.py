@@ -0,0 +1,268 @@
+"""A compact, columnar table of Job (processing) charges that can be
+grouped by any combination of Job, user, Unit, Product and month.
+
+Each charge is decoded once, when it's added, into a row of columns held
+in arrays: its coins (as an integer, fixed-point, number of millionths
+of a coin), its timestamp (its local time, as microseconds since the epoch,
+so its date and month are those the AS gave it) and a code for each of its
+Job, user, Unit and Product (an index into the column's list of values).
+Months are worked out from the timestamps when they're needed. The rare
+coins given to more decimal places than the columns hold keep the rest
+of their value (as a Decimal) to one side, so sums are always exact.
+Grouping does not need to touch the charges again, so one table can answer
+several groupings.
+
+If NumPy is installed it's used to group the rows (with vectorised
+sorts and reductions), otherwise the rows are grouped in Python.
+The results are the same.
+"""
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from decimal import Decimal
+import functools
+from itertools import repeat
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# The columns the charges can be grouped by
+GROUP_KEYS: Tuple[str, ...] = ("job", "user", "unit", "product", "month")
+
+# The number of decimal places coins are held to in the coins column
+# (enough for the AS, which charges to no more than a few)
+COIN_PLACES: int = 6
+
+# (timestamps are held as local times, i.e. without their timezone)
+_EPOCH: datetime = datetime(1970, 1, 1)
+_MICROSECOND: timedelta = timedelta(microseconds=1)
+
+# Groups, as columns: the codes of each key, and the count, coins,
+# decimal places, earliest and latest timestamp of each group
+_Groups = Tuple[List[List[int]], List[int], List[int], List[int], List[int], List[int]]
+
+
+@dataclass
+class GroupStats:
+    """The charges of one group (i.e. one Job, or one Job and user)."""
+    key: Tuple[str, ...]
+    count: int
+    coins: Decimal
+    earliest: datetime
+    latest: datetime
+
+
+class ChargeTable:
+    """Job charges, as columns. Only charges for Jobs (those with a
+    'job_collection' in their additional data) are added.
+    """
+
+    def __init__(self):
+        self.__coins: array = array("q")
+        # (the number of decimal places each charge's coins were given to,
+        # so the sum of a group is written just as the sum of Decimals would be)
+        self.__places: array = array("b")
+        self.__timestamps: array = array("q")
+        # The rest of the coins of the rows whose coins have more than
+        # COIN_PLACES decimal places (by row)
+        self.__excess_coins: Dict[int, Decimal] = {}
+        # The code of each row's Job, user, Unit and Product,
+        # and the values the codes are for
+        self.__codes: Dict[str, array] = {key: array("q") for key in GROUP_KEYS if key != "month"}
+        self.__values: Dict[str, List[str]] = {key: [] for key in self.__codes}
+        self.__value_codes: Dict[str, Dict[str, int]] = {key: {} for key in self.__codes}
+
+    def __len__(self) -> int:
+        return len(self.__coins)
+
+    def __code(self, key: str, value: str) -> int:
+        value_codes: Dict[str, int] = self.__value_codes[key]
+        code: Optional[int] = value_codes.get(value)
+        if code is None:
+            code = len(value_codes)
+            value_codes[value] = code
+            self.__values[key].append(value)
+        return code
+
+    def add_charges(self, charges: Dict[str, Any], *, unit: str = "", product: str = "") -> int:
+        """Adds the Job charges from a response from AsApi.get_product_charges(),
+        returning the number added. The Unit and Product are the names
+        they're grouped by.
+        """
+        unit_code: int = self.__code("unit", unit)
+        product_code: int = self.__code("product", product)
+        # This loop runs for every charge, so the codes are looked up here
+        # (and only added by __code() when they're new)
+        job_value_codes: Dict[str, int] = self.__value_codes["job"]
+        user_value_codes: Dict[str, int] = self.__value_codes["user"]
+        append_coins = self.__coins.append
+        append_places = self.__places.append
+        append_timestamp = self.__timestamps.append
+        append_job = self.__codes["job"].append
+        append_user = self.__codes["user"].append
+        num_added: int = 0
+        for processing_charge in charges.get("processing_charges") or []:
+            charge: Dict[str, Any] = processing_charge["charge"]
+            ad: Optional[Dict[str, Any]] = charge.get("additional_data")
+            if not ad or "job_collection" not in ad:
+                continue
+            coins, places = _parse_coins(charge["coins"])
+            if places > COIN_PLACES:
+                self.__excess_coins[len(self.__coins)] = _excess_coins(charge["coins"], coins)
+                places = COIN_PLACES
+            append_coins(coins)
+            append_places(places)
+            timestamp: datetime = datetime.fromisoformat(charge["timestamp"])
+            append_timestamp((timestamp.replace(tzinfo=None) - _EPOCH) // _MICROSECOND)
+            job: str = f'{ad["job_collection"]}|{ad["job_job"]}|{ad["job_version"]}'
+            job_code: Optional[int] = job_value_codes.get(job)
+            append_job(self.__code("job", job) if job_code is None else job_code)
+            user: str = charge.get("username") or ""
+            user_code: Optional[int] = user_value_codes.get(user)
+            append_user(self.__code("user", user) if user_code is None else user_code)
+            num_added += 1
+        self.__codes["unit"].extend([unit_code] * num_added)
+        self.__codes["product"].extend([product_code] * num_added)
+        return num_added
+
+    def group_by(self, *keys: str) -> List[GroupStats]:
+        """Groups the charges by one or more of the GROUP_KEYS,
+        returning the statistics of each group (in no particular order).
+        """
+        for key in keys:
+            if key not in GROUP_KEYS:
+                raise ValueError(f"Cannot group by '{key}' (choose from {', '.join(GROUP_KEYS)})")
+        if not self.__coins:
+            return []
+        if numpy is None:
+            groups: _Groups = self.__group_rows(keys)
+        else:
+            groups = self.__group_columns(keys)
+        key_codes, counts, coins, places, earliest, latest = groups
+        excess_coins: Dict[int, Decimal] = self.__group_excess_coins(keys, key_codes)
+        # The key (values) of each group
+        group_keys: List[Tuple[str, ...]] = list(zip(*(
+            [_month(code) for code in codes] if key == "month" else [self.__values[key][code] for code in codes]
+            for key, codes in zip(keys, key_codes)
+        ))) if keys else [()]
+        return [GroupStats(key=group_key,
+                           count=count,
+                           coins=_coins_decimal(group_coins, group_places) + excess_coins.get(index, 0),
+                           earliest=_EPOCH + group_earliest * _MICROSECOND,
+                           latest=_EPOCH + group_latest * _MICROSECOND)
+                for index, (group_key, count, group_coins, group_places, group_earliest, group_latest)
+                in enumerate(zip(group_keys, counts, coins, places, earliest, latest))]
+
+    def __group_excess_coins(self, keys: Tuple[str, ...], key_codes: List[List[int]]) -> Dict[int, Decimal]:
+        """The sum of the excess coins (see add_charges()) of each group
+        that has any, by the group's index.
+        """
+        if not self.__excess_coins:
+            return {}
+        group_indexes: Dict[Tuple[int, ...], int] = {
+            codes: index for index, codes in enumerate(zip(*key_codes) if keys else [()])
+        }
+        excess_coins: Dict[int, Decimal] = {}
+        for row, row_excess_coins in self.__excess_coins.items():
+            codes: Tuple[int, ...] = tuple(
+                _month_code(self.__timestamps[row]) if key == "month" else self.__codes[key][row] for key in keys
+            )
+            index: int = group_indexes[codes]
+            excess_coins[index] = excess_coins.get(index, 0) + row_excess_coins
+        return excess_coins
+
+    def __group_rows(self, keys: Tuple[str, ...]) -> _Groups:
+        """Groups the rows, one at a time, in Python."""
+        key_columns: List[Sequence[int]] = [
+            [_month_code(timestamp) for timestamp in self.__timestamps] if key == "month" else self.__codes[key]
+            for key in keys
+        ]
+        groups: Dict[Tuple[int, ...], List[int]] = {}
+        row_codes: Iterable[Tuple[int, ...]] = zip(*key_columns) if keys else repeat(())
+        for codes, coins, places, timestamp in zip(row_codes, self.__coins, self.__places, self.__timestamps):
+            group: Optional[List[int]] = groups.get(codes)
+            if group is None:
+                groups[codes] = [1, coins, places, timestamp, timestamp]
+                continue
+            group[0] += 1
+            group[1] += coins
+            if places > group[2]:
+                group[2] = places
+            if timestamp < group[3]:
+                group[3] = timestamp
+            if timestamp > group[4]:
+                group[4] = timestamp
+        key_codes: List[List[int]] = [list(codes) for codes in zip(*groups)] if keys else []
+        return key_codes, *(list(column) for column in zip(*groups.values()))
+
+    def __group_columns(self, keys: Tuple[str, ...]) -> _Groups:
+        """Groups the columns with NumPy, by sorting the rows by their
+        codes and reducing each run of rows that have the same codes.
+        """
+        timestamps: Any = numpy.frombuffer(self.__timestamps, dtype=numpy.int64)
+        key_columns: List[Any] = [
+            # (months since the epoch)
+            timestamps.astype("datetime64[us]").astype("datetime64[M]").astype(numpy.int64) if key == "month"
+            else numpy.frombuffer(self.__codes[key], dtype=numpy.int64)
+            for key in keys
+        ]
+        order: Any = numpy.lexsort(key_columns[::-1]) if keys else numpy.arange(len(self))
+        sorted_columns: List[Any] = [column[order] for column in key_columns]
+        # The first row of each group
+        new_group: Any = numpy.zeros(len(order), dtype=bool)
+        new_group[0] = True
+        for column in sorted_columns:
+            new_group[1:] |= column[1:] != column[:-1]
+        starts: Any = numpy.flatnonzero(new_group)
+
+        coins: Any = numpy.frombuffer(self.__coins, dtype=numpy.int64)[order]
+        places: Any = numpy.frombuffer(self.__places, dtype=numpy.int8)[order]
+        timestamps = timestamps[order]
+        return ([column[starts].tolist() for column in sorted_columns],
+                numpy.diff(numpy.append(starts, len(order))).tolist(),
+                numpy.add.reduceat(coins, starts).tolist(),
+                numpy.maximum.reduceat(places, starts).tolist(),
+                numpy.minimum.reduceat(timestamps, starts).tolist(),
+                numpy.maximum.reduceat(timestamps, starts).tolist())
+
+
+@functools.lru_cache(maxsize=65536)
+def _parse_coins(value: Any) -> Tuple[int, int]:
+    """Parses coins (a decimal string) into a fixed-point integer
+    (see COIN_PLACES) and the number of decimal places it was given to.
+    Places beyond COIN_PLACES are left out of the integer (see _excess_coins()).
+    Charges repeat the same few amounts, so parsed amounts are cached.
+    """
+    text: str = str(value)
+    if "e" in text or "E" in text:
+        text = format(Decimal(text), "f")
+    whole, _, fraction = text.partition(".")
+    return int(whole + fraction[:COIN_PLACES].ljust(COIN_PLACES, "0")), len(fraction)
+
+
+def _excess_coins(value: Any, coins: int) -> Decimal:
+    """The part of coins (given to more than COIN_PLACES decimal places)
+    that is not in their fixed-point integer.
+    """
+    return Decimal(str(value)) - Decimal(coins).scaleb(-COIN_PLACES)
+
+
+def _coins_decimal(coins: int, places: int) -> Decimal:
+    """The Decimal of fixed-point coins, to the given number of decimal places.
+    (every charge in a group has no more than its places, so this is exact)
+    """
+    return Decimal(coins // 10 ** (COIN_PLACES - places)).scaleb(-places)
+
+
+def _month_code(timestamp: int) -> int:
+    """The month (the number of months since the epoch) of a timestamp."""
+    date: datetime = _EPOCH + timestamp * _MICROSECOND
+    return (date.year - 1970) * 12 + date.month - 1
+
+
+def _month(code: int) -> str:
+    """The month (YYYY-MM) of a month code."""
+    return f"{1970 + code // 12}-{code % 12 + 1:02d}"
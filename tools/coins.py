@@ -1,23 +1,48 @@
 #!/usr/bin/env python
 """Calculates Coin charges for an AS Product.
+
+Alternatively, with --org or --unit, checks the billing prediction of every
+Product in an Organisation or Unit and reports those that do not match,
+or, with --pbp-range, reports a Product's coins for a range of billing periods
+(i.e. '--pbp-range 23:0', from 23 periods back to the current period).
 """
 import argparse
 from collections import namedtuple
+import csv
 import decimal
 from decimal import Decimal
+import json
+from pathlib import Path
+import sqlite3
 import sys
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from attr import dataclass
 import urllib3
 
 from rich.pretty import pprint
 from rich.console import Console
-from squonk2.auth import Auth
+from rich.table import Table
 from squonk2.as_api import AsApi, AsApiRv
 from squonk2.environment import Environment
 
+from common import ChargeCache, get_access_token, get_product_charges, run_in_parallel
+import metrics
+import warehouse
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# The columns of the --pbp-range report
+_TREND_COLUMNS: List[str] = [
+    "PBP",
+    "From",
+    "Until",
+    "Storage Coins",
+    "Committed Processing Coins",
+    "Uncommitted Processing Coins",
+    "Coins (Total Raw)",
+    "Coins (Adjusted)",
+]
+
 @dataclass
 class AdjustedCoins:
     coins: Decimal
@@ -26,6 +51,16 @@ class AdjustedCoins:
     aac: Decimal
 
 
+@dataclass
+class ChargeTotals:
+    num_storage_charges: int
+    burn_rate: Decimal
+    storage_coins: Decimal
+    num_processing_charges: int
+    uncommitted_processing_coins: Decimal
+    committed_processing_coins: Decimal
+
+
 def main(c_args: argparse.Namespace) -> None:
     """Main function."""
 
@@ -35,88 +70,195 @@ def main(c_args: argparse.Namespace) -> None:
     env: Environment = Environment(c_args.environment)
     AsApi.set_api_url(env.as_api)
 
-    token: str = Auth.get_access_token(
-        keycloak_url=env.keycloak_url,
-        keycloak_realm=env.keycloak_realm,
-        keycloak_client_id=env.keycloak_as_client_id,
-        username=env.admin_user,
-        password=env.admin_password,
-    )
+    token: str = get_access_token(env, client_id=env.keycloak_as_client_id)
     if not token:
         console.log("[bold red]ERROR[/bold red] Failed to get token")
         sys.exit(1)
 
+    # (charges for prior billing periods never change, so they can be cached)
+    cache: Optional[ChargeCache] = None if c_args.no_cache else ChargeCache(c_args.environment)
+
+    if c_args.pbp_range:
+        _report_product_trend(console, token, c_args, cache)
+    elif c_args.product:
+        _check_product(console, token, c_args, cache)
+    else:
+        _check_products(console, token, c_args, cache)
+
+
+def _check_product(console: Console,
+                   token: str,
+                   c_args: argparse.Namespace,
+                   cache: Optional[ChargeCache]) -> None:
+    """Prints the invoice for one Product, checking its billing prediction."""
+
     # Get the product details.
     # This gives us the product's allowance, limit and overspend multipliers
-    p_rv: AsApiRv = AsApi.get_product(token, product_id=args.product)
+    p_rv: AsApiRv = AsApi.get_product(token, product_id=c_args.product)
     if not p_rv.success:
         console.log(p_rv.msg)
-        console.log(f"[bold red]ERROR[/bold red] Failed to get [blue]{args.product}[/blue]")
+        console.log(f"[bold red]ERROR[/bold red] Failed to get [blue]{c_args.product}[/blue]")
         sys.exit(1)
-    if args.verbose:
+    if c_args.verbose:
         pprint(p_rv.msg)
 
-    product_id: str = p_rv.msg["product"]["product"]["id"]
-    product_name: str = p_rv.msg["product"]["product"]["name"]
+    # Get the product's charges...
+    pc_rv: AsApiRv = _get_product_charges(token, c_args.product, c_args.pbp, cache, c_args.from_db)
+    if not pc_rv.success:
+        console.log(pc_rv.msg)
+        console.log(f"[bold red]ERROR[/bold red] Failed to get [blue]{c_args.product}[/blue]")
+        sys.exit(1)
+    if c_args.verbose:
+        pprint(pc_rv.msg)
+
+    invoice, calculated_billing_prediction, product_response_billing_prediction = \
+        _calculate_invoice(p_rv.msg, pc_rv.msg)
+
+    # Now just pre-tty-print the invoice
+    pprint(invoice)
+
+    console.log(f"Calculated billing prediction is {calculated_billing_prediction}")
+    console.log(f"Product response billing prediction is {product_response_billing_prediction}")
+
+    if calculated_billing_prediction == product_response_billing_prediction:
+        console.log(":white_check_mark: CORRECT - Predictions match")
+    else:
+        discrepancy: Decimal = abs(calculated_billing_prediction - product_response_billing_prediction)
+        if calculated_billing_prediction > product_response_billing_prediction:
+            who_is_higher: str = "Calculated"
+        else:
+            who_is_higher: str = "Product response"
+        console.log(":cross_mark: ERROR - Predictions do not match.")
+        console.log(f"There's a discrepancy of {discrepancy} and the {who_is_higher} value is higher.")
+        sys.exit(1)
+
+
+def _report_product_trend(console: Console,
+                          token: str,
+                          c_args: argparse.Namespace,
+                          cache: Optional[ChargeCache]) -> None:
+    """Prints (and optionally writes as CSV) a Product's coins
+    for each billing period in a range of prior billing periods.
+    """
+    p_rv: AsApiRv = AsApi.get_product(token, product_id=c_args.product)
+    if not p_rv.success:
+        console.log(p_rv.msg)
+        console.log(f"[bold red]ERROR[/bold red] Failed to get [blue]{c_args.product}[/blue]")
+        sys.exit(1)
     allowance: Decimal = Decimal(p_rv.msg["product"]["coins"]["allowance"])
     allowance_multiplier: Decimal = Decimal(p_rv.msg["product"]["coins"]["allowance_multiplier"])
-    limit: Decimal = Decimal(p_rv.msg["product"]["coins"]["limit"])
 
-    remaining_days: int = p_rv.msg["product"]["coins"]["remaining_days"]
+    # Get the charges for every period (concurrently)
+    first_pbp, last_pbp = c_args.pbp_range
+    pbps: List[int] = list(range(first_pbp, last_pbp + 1))
+    pc_rvs: List[AsApiRv] = run_in_parallel(
+        _get_charges,
+        [(token, c_args.product, pbp, cache, c_args.from_db) for pbp in pbps],
+        environment=c_args.environment,
+        workers=c_args.workers,
+    )
+
+    rows: List[List[str]] = []
+    for pbp, pc_rv in zip(pbps, pc_rvs):
+        if not pc_rv.success:
+            console.log(pc_rv.msg)
+            console.log(f"[bold red]ERROR[/bold red] Failed to get [blue]{c_args.product}[/blue] (pbp {pbp})")
+            sys.exit(1)
+        totals: ChargeTotals = _total_charges(pc_rv.msg)
+        total_coins: Decimal = totals.storage_coins + totals.committed_processing_coins
+        ac: AdjustedCoins = _calculate_adjusted_coins(total_coins, allowance, allowance_multiplier)
+        rows.append([
+            str(pbp),
+            pc_rv.msg["from"],
+            pc_rv.msg["until"],
+            str(totals.storage_coins),
+            str(totals.committed_processing_coins),
+            str(totals.uncommitted_processing_coins),
+            str(total_coins),
+            str(ac.coins),
+        ])
+
+    table: Table = Table(title=f'{p_rv.msg["product"]["product"]["name"]} ({c_args.product})')
+    for column in _TREND_COLUMNS:
+        table.add_column(column, justify="right")
+    for row in rows:
+        table.add_row(*row)
+    console.print(table)
+
+    if c_args.csv:
+        with open(c_args.csv, 'w', encoding='utf8', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(_TREND_COLUMNS)
+            writer.writerows(rows)
+
+
+def _get_charges(request: Tuple[str, str, int, Optional[ChargeCache], Optional[str]]) -> AsApiRv:
+    """Gets the charges for a (token, product ID, pbp, cache, database) request."""
+    return _get_product_charges(*request)
+
+
+def _get_product_charges(token: str,
+                         product_id: str,
+                         pbp: int,
+                         cache: Optional[ChargeCache],
+                         database: Optional[str]) -> AsApiRv:
+    """Gets a Product's charges for a billing period, from the local database
+    (see sync-charges) if one's named, otherwise from the AS (or the cache).
+    """
+    if not database:
+        return get_product_charges(token, product_id=product_id, pbp=pbp, cache=cache)
+    conn: sqlite3.Connection = warehouse.connect(database)
+    try:
+        charges: Optional[Dict[str, Any]] = warehouse.get_product_charges(conn, product_id, pbp)
+    finally:
+        conn.close()
+    if charges is None:
+        return AsApiRv(success=False, msg={"error": f"The charges are not in {database} (pbp {pbp})"})
+    return AsApiRv(success=True, msg=charges)
+
+
+def _calculate_invoice(p_msg: Dict[str, Any],
+                       charges: Dict[str, Any]) -> Tuple[Dict[str, Any], Decimal, Decimal]:
+    """Calculates a Product's invoice from its product and charges responses,
+    returning the invoice, the calculated billing prediction and
+    the billing prediction in the product response.
+    """
+    product: Dict[str, Any] = p_msg["product"]
+
+    product_id: str = product["product"]["id"]
+    product_name: str = product["product"]["name"]
+    allowance: Decimal = Decimal(product["coins"]["allowance"])
+    allowance_multiplier: Decimal = Decimal(product["coins"]["allowance_multiplier"])
+    limit: Decimal = Decimal(product["coins"]["limit"])
+
+    remaining_days: int = product["coins"]["remaining_days"]
 
     # What's the 'billing prediction' in the /product response?
     # We'll compare this later to ensure it matches what we find
     # when we calculate the cost to the user using the product charges.
-    product_response_billing_prediction: Decimal = round(Decimal(p_rv.msg["product"]["coins"]["billing_prediction"]), 2)
-
-    # Get the product's charges...
-    pc_rv: AsApiRv = AsApi.get_product_charges(token, product_id=args.product, pbp=args.pbp)
-    if not pc_rv.success:
-        console.log(pc_rv.msg)
-        console.log(f"[bold red]ERROR[/bold red] Failed to get [blue]{args.product}[/blue]")
-        sys.exit(1)
-    if args.verbose:
-        pprint(pc_rv.msg)
+    product_response_billing_prediction: Decimal = round(Decimal(product["coins"]["billing_prediction"]), 2)
 
-    # Accumulate all the storage costs
-    # (the current record wil be used to set the future the "burn rate")
-    num_storage_charges: int = 0
-    burn_rate: Decimal = Decimal()
-    total_storage_coins: Decimal = Decimal()
-    if "items" in pc_rv.msg["storage_charges"]:
-        for item in pc_rv.msg["storage_charges"]["items"]:
-            total_storage_coins += Decimal(item["coins"])
-            if "current_bytes" in item["additional_data"]:
-                burn_rate = Decimal(item["burn_rate"])
-            else:
-                num_storage_charges += 1
-
-    # Accumulate all the processing costs
-    num_processing_charges: int = 0
-    total_uncommitted_processing_coins: Decimal = Decimal()
-    total_committed_processing_coins: Decimal = Decimal()
-    if pc_rv.msg["processing_charges"]:
-        for mp_charge in pc_rv.msg["processing_charges"]:
-            charge_coins: Decimal = Decimal(mp_charge["charge"]["coins"])
-            if "closed" in mp_charge:
-                total_committed_processing_coins += charge_coins
-            else:
-                total_uncommitted_processing_coins += charge_coins
-            num_processing_charges += 1
+    totals: ChargeTotals = _total_charges(charges)
+    num_storage_charges: int = totals.num_storage_charges
+    burn_rate: Decimal = totals.burn_rate
+    total_storage_coins: Decimal = totals.storage_coins
+    num_processing_charges: int = totals.num_processing_charges
+    total_uncommitted_processing_coins: Decimal = totals.uncommitted_processing_coins
+    total_committed_processing_coins: Decimal = totals.committed_processing_coins
 
     invoice: Dict[str, Any] = {
         "Product": (product_name, product_id),
-        "Unit": (p_rv.msg["product"]["unit"]["name"],
-                 p_rv.msg["product"]["unit"]["id"]),
-        "Organisation": (p_rv.msg["product"]["organisation"]["name"],
-                         p_rv.msg["product"]["organisation"]["id"]),
-        "Claim": (p_rv.msg["product"].get("claim", {}).get("name", "-"),
-                  p_rv.msg["product"].get("claim", {}).get("id", "-")),
+        "Unit": (product["unit"]["name"],
+                 product["unit"]["id"]),
+        "Organisation": (product["organisation"]["name"],
+                         product["organisation"]["id"]),
+        "Claim": (product.get("claim", {}).get("name", "-"),
+                  product.get("claim", {}).get("id", "-")),
         "Allowance": str(allowance),
         "Allowance Multiplier": str(allowance_multiplier),
         "Limit": str(limit),
-        "From": pc_rv.msg["from"], "Until": pc_rv.msg["until"],
-        "Billing Day": p_rv.msg["product"]["coins"]["billing_day"],
+        "From": charges["from"], "Until": charges["until"],
+        "Billing Day": product["coins"]["billing_day"],
         "Remaining Days": remaining_days,
         "Current Burn Rate": str(burn_rate),
         "Number of Storage Charges": num_storage_charges,
@@ -176,23 +318,133 @@ def main(c_args: argparse.Namespace) -> None:
 
         calculated_billing_prediction = p_ac.coins
 
-    # Now just pre-tty-print the invoice
-    pprint(invoice)
+    return invoice, calculated_billing_prediction, product_response_billing_prediction
 
-    console.log(f"Calculated billing prediction is {calculated_billing_prediction}")
-    console.log(f"Product response billing prediction is {product_response_billing_prediction}")
 
-    if calculated_billing_prediction == product_response_billing_prediction:
-        console.log(":white_check_mark: CORRECT - Predictions match")
+def _check_products(console: Console,
+                    token: str,
+                    c_args: argparse.Namespace,
+                    cache: Optional[ChargeCache]) -> None:
+    """Checks the billing prediction of every Product in an Organisation
+    (or Unit), reporting (as a table and optionally JSON) those that do not match.
+    """
+    if c_args.org:
+        pl_rv: AsApiRv = AsApi.get_products_for_organisation(token, org_id=c_args.org)
     else:
-        discrepancy: Decimal = abs(calculated_billing_prediction - product_response_billing_prediction)
-        if calculated_billing_prediction > product_response_billing_prediction:
-            who_is_higher: str = "Calculated"
-        else:
-            who_is_higher: str = "Product response"
-        console.log(":cross_mark: ERROR - Predictions do not match.")
-        console.log(f"There's a discrepancy of {discrepancy} and the {who_is_higher} value is higher.")
+        pl_rv = AsApi.get_products_for_unit(token, unit_id=c_args.unit)
+    if not pl_rv.success:
+        console.log(pl_rv.msg)
+        console.log(f"[bold red]ERROR[/bold red] Failed to get [blue]{c_args.org or c_args.unit}[/blue] Products")
         sys.exit(1)
+    product_ids: List[str] = [product["product"]["id"] for product in pl_rv.msg["products"]]
+
+    # Get the details and charges for every Product (concurrently)
+    rvs: List[Tuple[AsApiRv, AsApiRv]] = run_in_parallel(
+        _get_product_and_charges,
+        [(token, product_id, c_args.pbp, cache, c_args.from_db) for product_id in product_ids],
+        environment=c_args.environment,
+        workers=c_args.workers,
+    )
+
+    failures: List[str] = []
+    mismatches: List[Dict[str, Any]] = []
+    for product_id, (p_rv, pc_rv) in zip(product_ids, rvs):
+        if not p_rv.success or not pc_rv.success:
+            failures.append(product_id)
+            continue
+        invoice, calculated_billing_prediction, product_response_billing_prediction = \
+            _calculate_invoice(p_rv.msg, pc_rv.msg)
+        if calculated_billing_prediction != product_response_billing_prediction:
+            mismatches.append({
+                "Product": invoice["Product"],
+                "Unit": invoice["Unit"],
+                "Calculated": str(calculated_billing_prediction),
+                "Product response": str(product_response_billing_prediction),
+                "Discrepancy": str(calculated_billing_prediction - product_response_billing_prediction),
+                "Invoice": invoice,
+            })
+
+    table: Table = Table(title="Billing prediction mismatches")
+    table.add_column("Product")
+    table.add_column("Unit")
+    table.add_column("Calculated", justify="right")
+    table.add_column("Product response", justify="right")
+    table.add_column("Discrepancy", justify="right")
+    for mismatch in mismatches:
+        table.add_row(
+            f"{mismatch['Product'][0]} ({mismatch['Product'][1]})",
+            mismatch["Unit"][0],
+            mismatch["Calculated"],
+            mismatch["Product response"],
+            mismatch["Discrepancy"],
+        )
+    console.print(table)
+
+    if c_args.json:
+        report: Dict[str, Any] = {
+            "Environment": c_args.environment,
+            "Prior Billing Period": c_args.pbp,
+            "Products": len(product_ids),
+            "Failed": failures,
+            "Mismatches": mismatches,
+        }
+        Path(c_args.json).write_text(json.dumps(report, indent=2), encoding='utf8')
+
+    for product_id in failures:
+        console.log(f"[bold red]ERROR[/bold red] Failed to get [blue]{product_id}[/blue]")
+    console.log(f"Checked {len(product_ids) - len(failures)} of {len(product_ids)} Products")
+    if mismatches:
+        console.log(f":cross_mark: ERROR - {len(mismatches)} Predictions do not match.")
+    else:
+        console.log(":white_check_mark: CORRECT - Predictions match")
+    if mismatches or failures:
+        sys.exit(1)
+
+
+def _get_product_and_charges(
+        request: Tuple[str, str, int, Optional[ChargeCache], Optional[str]]) -> Tuple[AsApiRv, AsApiRv]:
+    """Gets the details and charges for a (token, product ID, pbp, cache, database) request."""
+    token, product_id, pbp, cache, database = request
+    p_rv: AsApiRv = AsApi.get_product(token, product_id=product_id)
+    pc_rv: AsApiRv = _get_product_charges(token, product_id, pbp, cache, database)
+    return p_rv, pc_rv
+
+
+def _total_charges(charges: Dict[str, Any]) -> ChargeTotals:
+    """Accumulates the storage and processing coins in a charges response."""
+
+    # Accumulate all the storage costs
+    # (the current record wil be used to set the future the "burn rate")
+    num_storage_charges: int = 0
+    burn_rate: Decimal = Decimal()
+    total_storage_coins: Decimal = Decimal()
+    if "items" in charges["storage_charges"]:
+        for item in charges["storage_charges"]["items"]:
+            total_storage_coins += Decimal(item["coins"])
+            if "current_bytes" in item["additional_data"]:
+                burn_rate = Decimal(item["burn_rate"])
+            else:
+                num_storage_charges += 1
+
+    # Accumulate all the processing costs
+    num_processing_charges: int = 0
+    total_uncommitted_processing_coins: Decimal = Decimal()
+    total_committed_processing_coins: Decimal = Decimal()
+    if charges["processing_charges"]:
+        for mp_charge in charges["processing_charges"]:
+            charge_coins: Decimal = Decimal(mp_charge["charge"]["coins"])
+            if "closed" in mp_charge:
+                total_committed_processing_coins += charge_coins
+            else:
+                total_uncommitted_processing_coins += charge_coins
+            num_processing_charges += 1
+
+    return ChargeTotals(num_storage_charges=num_storage_charges,
+                        burn_rate=burn_rate,
+                        storage_coins=total_storage_coins,
+                        num_processing_charges=num_processing_charges,
+                        uncommitted_processing_coins=total_uncommitted_processing_coins,
+                        committed_processing_coins=total_committed_processing_coins)
 
 
 def _calculate_adjusted_coins(total_coins: Decimal,
@@ -223,6 +475,22 @@ def _calculate_adjusted_coins(total_coins: Decimal,
                          aac=adjusted_allowance_coins)
 
 
+def _pbp_range(value: str) -> Tuple[int, int]:
+    """Parses a range of prior billing periods, i.e. '23:0' (periods back).
+    '-23:0' is also accepted, but argparse takes it to be an option
+    unless it's given as '--pbp-range=-23:0'.
+    """
+    try:
+        first, last = (-abs(int(pbp)) for pbp in value.split(':'))
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a range like 23:0") from ex
+    if first > last:
+        raise argparse.ArgumentTypeError(
+            f"'{value}' must start with the earliest period (i.e. 23:0)"
+        )
+    return first, last
+
+
 if __name__ == "__main__":
 
     # Parse command line arguments
@@ -231,21 +499,78 @@ if __name__ == "__main__":
         description="Calculates a Product's Coin Charges (actual and predicted)"
     )
     parser.add_argument('environment', type=str, help='The environment name')
-    parser.add_argument('product', type=str, help='The Product UUID')
+    parser.add_argument('product', type=str, nargs='?', help='The Product UUID')
+    parser.add_argument('--org', type=str, help='Check every Product in this Organisation (UUID)')
+    parser.add_argument('--unit', type=str, help='Check every Product in this Unit (UUID)')
+    parser.add_argument(
+        '--json',
+        help='A file to write the --org or --unit report to (as JSON)',
+        type=str,
+    )
+    parser.add_argument(
+        '--workers',
+        help='The number of concurrent requests (for --org, --unit or --pbp-range)',
+        type=int,
+        default=1,
+    )
     parser.add_argument(
         '--pbp',
         help='The prior billing period (default is 0, current)',
         type=int,
         default=0,
     )
+    parser.add_argument(
+        '--pbp-range',
+        help='A range of prior billing periods to report the Product coins for,'
+             ' i.e. 23:0 (from 23 periods back to the current period)',
+        type=_pbp_range,
+    )
+    parser.add_argument(
+        '--csv',
+        help='A file to write the --pbp-range report to (as CSV)',
+        type=str,
+    )
+    parser.add_argument(
+        '--no-cache',
+        help='Set to ignore cached prior billing period charges',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--from-db',
+        help='Use charges from a local database (see sync-charges), rather than the AS.'
+             ' Product details are still read from the AS',
+        type=str,
+        nargs='?',
+        const=warehouse.DEFAULT_DATABASE,
+    )
     parser.add_argument(
         '--verbose',
         help='Set to print extra information',
         action='store_true',
     )
+    parser.add_argument(
+        '--metrics',
+        help='Print a summary of the API calls made,'
+             ' or write them to this Prometheus textfile',
+        type=str,
+        nargs='?',
+        const=metrics.SUMMARY,
+    )
     args: argparse.Namespace = parser.parse_args()
 
     if args.pbp > 0:
         parser.error("The prior billing period must be less than or equal to 0")
+    if len([arg for arg in (args.product, args.org, args.unit) if arg]) != 1:
+        parser.error("You must provide a Product, or one of --org or --unit")
+    if args.pbp_range and not args.product:
+        parser.error("A --pbp-range needs a Product")
+    # (the range starts with its earliest period)
+    if args.pbp_range and args.pbp_range[0] < -23:
+        parser.error("The earliest Prior Billing Period cannot be less than -23")
+    if args.workers < 1:
+        parser.error("The number of workers must be at least 1")
+
+    if args.metrics:
+        metrics.enable(args.metrics)
 
     main(args)
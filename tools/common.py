@@ -1,8 +1,25 @@
 """Stuff that's used by more than one tool.
 """
 from collections import namedtuple
+import base64
+import contextlib
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass, field
+from datetime import date
+import gzip
+import json
 import os
-from typing import List, Optional
+from pathlib import Path
+import random
+import re
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from squonk2.as_api import AsApi, AsApiRv
+from squonk2.dm_api import DmApi, DmApiRv
+from squonk2.environment import Environment
+
+import metrics
 
 # The ID for an internal "test" unit
 TEST_UNIT: str = "unit-11111111-1111-1111-1111-111111111111"
@@ -15,3 +32,588 @@ TEST_USER_NAMES: List[str] = [
     "dmit-user-d",
     "dmit-user-admin",
 ]
+
+# Where charges for closed (prior) billing periods are cached,
+# and the maximum size of the cache (in megabytes).
+_CHARGE_CACHE_DIRECTORY: str = os.environ.get(
+    "SQUONK2_CHARGE_CACHE_DIRECTORY", "~/.squonk2/charge-cache"
+)
+_CHARGE_CACHE_MAX_MB: int = int(os.environ.get("SQUONK2_CHARGE_CACHE_MAX_MB", "256"))
+# This process's charge caches, indexed by environment, directory and size
+# (see get_charge_cache())
+_CHARGE_CACHES: Dict[Tuple[str, str, int], "ChargeCache"] = {}
+
+# Where access tokens are cached (between tool invocations)
+# and how long (seconds) a cached token must have left before it's used.
+_TOKEN_CACHE_FILE: str = os.environ.get("SQUONK2_TOKEN_CACHE_FILE", "~/.squonk2/tokens")
+_TOKEN_MIN_REMAINING_S: int = 60
+
+# Tokens already found (or obtained) by this process, indexed by
+# environment and Keycloak client (for tools run one after the other in
+# a single process, see squonk2-tools --script)
+_ACCESS_TOKENS: Dict[str, Dict[str, Any]] = {}
+
+# The client reports failed requests with an error message
+# that ends with the response, i.e. "(resp=<Response [503]>)" or "(resp=None)".
+_RE_ERROR_RESPONSE: re.Pattern = re.compile(r"\(resp=(?:<Response \[(\d+)\]>|None)\)$")
+
+# How many times a call is attempted (when it fails transiently),
+# and the delay (seconds) before the first retry (which doubles for each retry).
+_CALL_ATTEMPTS: int = 3
+_CALL_RETRY_DELAY_S: float = 1.0
+
+# A call is 'slow' (see RequestScheduler) if it takes longer than
+# this many times the fastest call (and longer than the minimum, in seconds).
+_SLOW_CALL_FACTOR: float = 3.0
+_SLOW_CALL_MIN_S: float = 1.0
+
+# True once share_connections() has been called
+# (so worker processes can share their connections too)
+_CONNECTIONS_SHARED: bool = False
+
+# The number of transient failures seen by call_with_retries()
+# (reset for each call run_in_parallel() makes)
+_NUM_TRANSIENT_FAILURES: int = 0
+
+
+def get_access_token(env: Environment, *, client_id: str) -> Optional[str]:
+    """Gets an access token for the environment's admin user and the given
+    Keycloak client ID. Tokens are cached in a file (only readable by you)
+    and re-used by later invocations until they're about to expire.
+    None is returned if Keycloak fails to provide a token.
+    """
+    key: str = f"{env.environment}|{client_id}"
+    cached: Optional[Dict[str, Any]] = _ACCESS_TOKENS.get(key)
+    if cached and cached["expires"] - time.time() >= _TOKEN_MIN_REMAINING_S:
+        return cached["token"]
+
+    cache_file: Path = Path(_TOKEN_CACHE_FILE).expanduser()
+    tokens: Dict[str, Dict[str, Any]] = {}
+    try:
+        tokens = json.loads(cache_file.read_text(encoding='utf8'))
+    except (OSError, ValueError):
+        pass
+    cached = tokens.get(key)
+    if cached and cached["expires"] - time.time() >= _TOKEN_MIN_REMAINING_S:
+        _ACCESS_TOKENS[key] = cached
+        return cached["token"]
+
+    # (imported here as it is slow to import and is not needed for a cached token)
+    from squonk2.auth import Auth  # pylint: disable=import-outside-toplevel
+
+    token: Optional[str] = Auth.get_access_token(
+        keycloak_url=env.keycloak_url,
+        keycloak_realm=env.keycloak_realm,
+        keycloak_client_id=client_id,
+        username=env.admin_user,
+        password=env.admin_password,
+    )
+    if not token:
+        return None
+
+    # Cache the new token (with its expiry time).
+    # The file is written, with user-only permissions, and then moved into place.
+    tokens[key] = {"token": token, "expires": _get_token_expiry(token)}
+    _ACCESS_TOKENS[key] = tokens[key]
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    new_cache_file: Path = cache_file.with_name(f"{cache_file.name}.{os.getpid()}")
+    fd: int = os.open(new_cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf8') as new_cache:
+        json.dump(tokens, new_cache)
+    os.replace(new_cache_file, cache_file)
+    return token
+
+
+def _get_token_expiry(token: str) -> int:
+    """Returns the expiry time of a (JWT) access token, or 0 if it cannot be found.
+    The token's signature is not checked, we only need to know when it expires.
+    """
+    try:
+        payload: str = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return 0
+
+
+def share_connections() -> None:
+    """Makes the AsApi and DmApi clients re-use their connections.
+    The client sends each request with requests.request(), which opens
+    (and closes) a new connection for every call. Its requests are sent
+    through a requests.Session (one for each process) instead.
+    """
+    # pylint: disable=import-outside-toplevel
+    from squonk2 import as_api, dm_api
+
+    global _CONNECTIONS_SHARED
+    shared: _SharedConnections = _SharedConnections()
+    as_api.requests = shared
+    dm_api.requests = shared
+    _CONNECTIONS_SHARED = True
+
+
+class _SharedConnections:
+    """Stands in for the requests module (in the client's modules),
+    sending requests through a Session that belongs to the process.
+    Forked processes (i.e. workers) must not share the parent's connections,
+    so they each get a Session of their own.
+    """
+
+    def __init__(self):
+        # pylint: disable=import-outside-toplevel
+        import requests
+
+        self.__requests = requests
+        self.__sessions: Dict[int, Any] = {}
+
+    def request(self, method: str, url: str, **kwargs: Any) -> Any:
+        """requests.request(), using the process's Session."""
+        session: Any = self.__sessions.get(os.getpid())
+        if session is None:
+            session = self.__requests.Session()
+            self.__sessions[os.getpid()] = session
+        return session.request(method, url, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.__requests, name)
+
+
+def _init_worker(environment: str, record_metrics: bool, connections_shared: bool) -> None:
+    """Initialises a worker process, setting the API URLs for the named
+    environment (the Squonk2 client holds these as class variables).
+    The worker records API metrics, and shares its connections, if the tool's
+    process does. (a forked worker inherits these, but a spawned one does not)
+    """
+    _ = Environment.load()
+    env: Environment = Environment(environment)
+    if env.as_api:
+        AsApi.set_api_url(env.as_api)
+    if env.dm_api:
+        DmApi.set_api_url(env.dm_api)
+    if record_metrics:
+        metrics.record()
+    if connections_shared and not _CONNECTIONS_SHARED:
+        share_connections()
+    # Forget any API metrics inherited from the tool's process
+    _ = metrics.take()
+
+
+class RequestScheduler:
+    """Decides how many of a ParallelRunner's calls can be in flight
+    and paces them to an optional requests-per-second cap.
+
+    The in-flight limit starts at its maximum (the number of workers)
+    and is adjusted using AIMD (additive increase, multiplicative decrease).
+    It's halved when a call fails transiently (see is_transient_failure())
+    or is slow (taking more than three times the fastest call, and more than
+    a second), but no more than once for each 'window' of calls (the current
+    limit). Each call that's fast and successful adds 1/limit to it
+    (so it grows by about one for each window).
+    """
+
+    def __init__(self, max_in_flight: int, *, max_rps: Optional[float] = None):
+        self.__max_in_flight: int = max(1, max_in_flight)
+        self.__limit: float = float(self.__max_in_flight)
+        self.__interval_s: float = 1.0 / max_rps if max_rps else 0.0
+        self.__next_call: float = 0.0
+        self.__fastest_s: Optional[float] = None
+        self.__calls_since_decrease: int = self.__max_in_flight
+        self.num_decreases: int = 0
+
+    @property
+    def limit(self) -> int:
+        """The number of calls that can be in flight."""
+        return int(self.__limit)
+
+    def wait(self) -> None:
+        """Waits until the next call can be made (if there's a rate cap)."""
+        if not self.__interval_s:
+            return
+        now: float = time.monotonic()
+        if self.__next_call > now:
+            time.sleep(self.__next_call - now)
+            now = self.__next_call
+        self.__next_call = now + self.__interval_s
+
+    def record(self, latency_s: float, num_transient_failures: int) -> None:
+        """Adjusts the in-flight limit using the outcome of a call."""
+        if self.__fastest_s is None or latency_s < self.__fastest_s:
+            self.__fastest_s = latency_s
+        self.__calls_since_decrease += 1
+        slow: bool = latency_s > max(_SLOW_CALL_FACTOR * self.__fastest_s, _SLOW_CALL_MIN_S)
+        if num_transient_failures or slow:
+            if self.__calls_since_decrease >= self.limit:
+                self.__limit = max(1.0, self.__limit / 2)
+                self.__calls_since_decrease = 0
+                self.num_decreases += 1
+        else:
+            self.__limit = min(float(self.__max_in_flight), self.__limit + 1 / self.__limit)
+
+
+class ParallelRunner:
+    """Runs calls in parallel (see run()) for a tool, sharing one
+    RequestScheduler (so its in-flight limit and any requests-per-second cap
+    carry from one run() to the next) and, with more than one worker,
+    one pool of worker processes (started by the first run()).
+    Use it as a context manager, which stops the pool when it's done: -
+
+        with ParallelRunner(environment=..., workers=...) as runner:
+            for owner, items in ...:
+                results = runner.run(func, items)
+
+    The Squonk2 client serialises every call made from a process
+    (its API methods are synchronised) so, with more than one worker,
+    the calls are made from a pool of processes. A run()'s 'func' must
+    therefore be a module-level function and its items and results must be
+    picklable. With one worker the items are handled in the calling process.
+    """
+
+    def __init__(self, *, environment: str, workers: int, max_rps: Optional[float] = None):
+        self.__environment: str = environment
+        self.__workers: int = workers
+        self.__scheduler: RequestScheduler = RequestScheduler(workers, max_rps=max_rps)
+        self.__executor: Any = None
+
+    def __enter__(self) -> "ParallelRunner":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        if self.__executor:
+            self.__executor.shutdown()
+            self.__executor = None
+
+    def run(self,
+            func: Callable[[Any], Any],
+            items: Iterable[Any],
+            *,
+            on_result: Optional[Callable[[Any], None]] = None,
+            attempts: int = _CALL_ATTEMPTS) -> List[Any]:
+        """Calls 'func' for each item, returning the results in item order
+        (so they can be merged just as they would be in a sequential run).
+        If provided, 'on_result' is called with each result as it's collected
+        (useful for reporting progress).
+
+        Calls that return a transient failure (an AsApiRv or DmApiRv, see
+        is_transient_failure()) are retried (see call_with_retries()). Use an
+        'attempts' of 1 for calls that are not safe to repeat.
+        """
+        scheduler: RequestScheduler = self.__scheduler
+        requests: List[Tuple[Callable[[Any], Any], Any, int]] = [(func, item, attempts) for item in items]
+        results: List[Any] = [None] * len(requests)
+
+        if self.__workers <= 1:
+            for index, request in enumerate(requests):
+                scheduler.wait()
+                results[index], _, _ = _call_scheduled(request)
+                if on_result:
+                    on_result(results[index])
+            return results
+
+        if not requests:
+            return results
+        if self.__executor is None:
+            # (imported here as it is only needed for a pool of workers)
+            from concurrent.futures import ProcessPoolExecutor  # pylint: disable=import-outside-toplevel
+
+            self.__executor = ProcessPoolExecutor(
+                max_workers=self.__workers,
+                initializer=_init_worker,
+                initargs=(self.__environment, metrics.is_enabled(), _CONNECTIONS_SHARED))
+        in_flight: Dict[Future, int] = {}
+        next_index: int = 0
+        while next_index < len(requests) or in_flight:
+            while next_index < len(requests) and len(in_flight) < scheduler.limit:
+                scheduler.wait()
+                in_flight[self.__executor.submit(_call_in_worker, requests[next_index])] = next_index
+                next_index += 1
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                index: int = in_flight.pop(future)
+                result, latency_s, num_transient_failures, taken = future.result()
+                scheduler.record(latency_s, num_transient_failures)
+                if taken:
+                    metrics.merge(taken)
+                if on_result:
+                    on_result(result)
+                results[index] = result
+        return results
+
+
+def run_in_parallel(func: Callable[[Any], Any],
+                    items: Iterable[Any],
+                    *,
+                    environment: str,
+                    workers: int,
+                    on_result: Optional[Callable[[Any], None]] = None,
+                    max_rps: Optional[float] = None,
+                    attempts: int = _CALL_ATTEMPTS) -> List[Any]:
+    """Calls 'func' for each item (see ParallelRunner.run()) with a runner
+    of its own. The number of calls in flight is adjusted by a RequestScheduler,
+    and 'max_rps' caps the number of calls (items) started each second.
+    Tools that make more than one set of calls should use one ParallelRunner
+    for all of them.
+    """
+    with ParallelRunner(environment=environment, workers=workers, max_rps=max_rps) as runner:
+        return runner.run(func, items, on_result=on_result, attempts=attempts)
+
+
+def _call_scheduled(request: Tuple[Callable[[Any], Any], Any, int]) -> Tuple[Any, float, int]:
+    """Calls a (func, item, attempts) request, returning the result,
+    how long it took and the number of transient failures it saw.
+    """
+    global _NUM_TRANSIENT_FAILURES
+    func, item, attempts = request
+    _NUM_TRANSIENT_FAILURES = 0
+    start: float = time.perf_counter()
+    result: Any = call_with_retries(lambda: func(item), attempts=attempts)
+    return result, time.perf_counter() - start, _NUM_TRANSIENT_FAILURES
+
+
+def _call_in_worker(request: Tuple[Callable[[Any], Any], Any, int]) -> Tuple[Any, float, int, Any]:
+    """_call_scheduled() in a worker process, also returning the API metrics
+    of the call (if they're being recorded).
+    """
+    result, latency_s, num_transient_failures = _call_scheduled(request)
+    return result, latency_s, num_transient_failures, metrics.take() if metrics.is_enabled() else None
+
+
+def is_transient_failure(rv: Any) -> bool:
+    """True if a failed AsApiRv or DmApiRv is worth retrying,
+    i.e. there was no response, or it was a 429 or 5xx.
+    Anything else (i.e. a successful call, or a tuple of results) is not.
+    """
+    if getattr(rv, "success", True):
+        return False
+    match: Optional[re.Match] = _RE_ERROR_RESPONSE.search(str(rv.msg.get("error", "")))
+    if not match:
+        return False
+    return match.group(1) is None or match.group(1) == "429" or match.group(1).startswith("5")
+
+
+def call_with_retries(call: Callable[[], Any],
+                      *,
+                      attempts: int = _CALL_ATTEMPTS,
+                      delay_s: float = _CALL_RETRY_DELAY_S) -> Any:
+    """Makes an API call (a function returning an AsApiRv or DmApiRv),
+    retrying transient failures after an exponentially increasing delay
+    (with jitter, so that clients that failed together don't retry together).
+    """
+    global _NUM_TRANSIENT_FAILURES
+    attempt: int = 1
+    rv: Any = call()
+    while is_transient_failure(rv):
+        _NUM_TRANSIENT_FAILURES += 1
+        if attempt >= attempts:
+            break
+        backoff_s: float = delay_s * 2 ** (attempt - 1)
+        time.sleep(random.uniform(backoff_s / 2, backoff_s))
+        attempt += 1
+        rv = call()
+    return rv
+
+
+class ChargeCache:
+    """A compressed on-disk cache of Product charges for closed (prior)
+    billing periods, keyed by environment, product ID and prior billing period.
+    Charges for the open billing period (a 'pbp' of 0) are never cached.
+    A prior billing period names a different period once a new period starts,
+    so an entry is only used if its charges are 'from' the period the 'pbp'
+    names today (otherwise it's a miss, and is replaced when it's put).
+
+    Each entry is a gzipped JSON file. The file modification time records
+    when an entry was last used, and the least recently used entries are
+    removed when the cache grows beyond its maximum size. The cache is only
+    measured once (its size is then tracked as entries are added) so putting
+    an entry does not have to walk the whole cache. Entries are written to
+    a temporary file that is then moved into place, so an interrupted write
+    never leaves a partial entry behind.
+
+    A cache that's sent to a worker process (pickled) only sends its
+    environment, directory and size, and becomes that process's cache
+    (see get_charge_cache()), so each process measures the cache once.
+    """
+
+    def __init__(self,
+                 environment: str,
+                 *,
+                 directory: str = _CHARGE_CACHE_DIRECTORY,
+                 max_mb: int = _CHARGE_CACHE_MAX_MB):
+        self.__environment: str = environment
+        self.__root: Path = Path(directory).expanduser()
+        self.__directory: Path = self.__root / environment
+        self.__max_mb: int = max_mb
+        self.__max_bytes: int = max_mb * 1024 * 1024
+        self.__total_bytes: Optional[int] = None
+
+    def __reduce__(self) -> Tuple[Callable[..., "ChargeCache"], Tuple[str, str, int]]:
+        return get_charge_cache, (self.__environment, str(self.__root), self.__max_mb)
+
+    def __entry(self, product_id: str, pbp: int) -> Path:
+        return self.__directory / product_id / f"{pbp}.json.gz"
+
+    def get(self, product_id: str, pbp: int) -> Optional[Dict[str, Any]]:
+        """Returns the cached charges, or None if they're not cached."""
+        if pbp >= 0:
+            return None
+        entry: Path = self.__entry(product_id, pbp)
+        try:
+            with gzip.open(entry, 'rt', encoding='utf8') as entry_file:
+                charges: Dict[str, Any] = json.load(entry_file)
+        except (OSError, EOFError, ValueError):
+            return None
+        if get_pbp(charges.get("from"), date.today()) != pbp:
+            return None
+        # Mark the entry as recently used
+        entry.touch()
+        return charges
+
+    def put(self, product_id: str, pbp: int, charges: Dict[str, Any]) -> None:
+        """Caches the charges for a closed billing period,
+        removing the least recently used entries if the cache is too big.
+        """
+        if pbp >= 0:
+            return
+        if self.__total_bytes is None:
+            self.__total_bytes = sum(stat.st_size for stat, _ in self.__entries())
+        entry: Path = self.__entry(product_id, pbp)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        with contextlib.suppress(OSError):
+            self.__total_bytes -= entry.stat().st_size
+        new_entry: Path = entry.with_name(f"{entry.name}.{os.getpid()}")
+        with gzip.open(new_entry, 'wt', encoding='utf8') as entry_file:
+            json.dump(charges, entry_file)
+        os.replace(new_entry, entry)
+        self.__total_bytes += entry.stat().st_size
+        if self.__total_bytes > self.__max_bytes:
+            self.__evict()
+
+    def __entries(self) -> List[Tuple[os.stat_result, Path]]:
+        return [(path.stat(), path) for path in self.__root.rglob("*.json.gz")]
+
+    def __evict(self) -> None:
+        entries: List[Tuple[os.stat_result, Path]] = self.__entries()
+        total_bytes: int = sum(stat.st_size for stat, _ in entries)
+        for stat, path in sorted(entries, key=lambda entry: entry[0].st_mtime):
+            if total_bytes <= self.__max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= stat.st_size
+        self.__total_bytes = total_bytes
+
+
+def get_charge_cache(environment: str,
+                     directory: str = _CHARGE_CACHE_DIRECTORY,
+                     max_mb: int = _CHARGE_CACHE_MAX_MB) -> ChargeCache:
+    """Returns this process's ChargeCache for an environment (and cache
+    directory and size), creating it the first time it's asked for.
+    """
+    key: Tuple[str, str, int] = (environment, directory, max_mb)
+    cache: Optional[ChargeCache] = _CHARGE_CACHES.get(key)
+    if cache is None:
+        cache = ChargeCache(environment, directory=directory, max_mb=max_mb)
+        _CHARGE_CACHES[key] = cache
+    return cache
+
+
+def get_pbp(period_from: Any, today: date) -> Optional[int]:
+    """Returns the prior billing period (0 for today's period, -1 for the one
+    before it...) of the billing period that starts on a date (a 'from' date),
+    or None if it's not a date. Periods start on the same day (the billing day)
+    of each month, which is the day of the 'from' date.
+    """
+    try:
+        from_date: date = date.fromisoformat(str(period_from)[:10])
+    except ValueError:
+        return None
+    # (months since year 0 of today's period and of the period that starts on the date)
+    period: int = today.year * 12 + today.month - 1 - (1 if today.day < from_date.day else 0)
+    return from_date.year * 12 + from_date.month - 1 - period
+
+
+def get_product_charges(token: str,
+                        *,
+                        product_id: str,
+                        pbp: int,
+                        cache: Optional[ChargeCache] = None) -> AsApiRv:
+    """Gets a Product's charges for a billing period, using (and filling)
+    the cache if one is provided.
+    """
+    if cache:
+        charges: Optional[Dict[str, Any]] = cache.get(product_id, pbp)
+        if charges is not None:
+            return AsApiRv(success=True, msg=charges)
+    pc_rv: AsApiRv = AsApi.get_product_charges(token, product_id=product_id, pbp=pbp)
+    if cache and pc_rv.success:
+        cache.put(product_id, pbp, pc_rv.msg)
+    return pc_rv
+
+
+@dataclass
+class DeletionSummary:
+    """The outcome of delete_instances()."""
+    num_deleted: int
+    num_failed: int
+    duration_s: float
+    # The owners that could not be impersonated
+    # (none of their instances were deleted)
+    failed_owners: List[str] = field(default_factory=list)
+
+    @property
+    def rate(self) -> float:
+        """Deletions per second."""
+        return self.num_deleted / self.duration_s if self.duration_s else 0.0
+
+
+def delete_instances(token: str,
+                     instances: List[Tuple[str, str]],
+                     *,
+                     runner: ParallelRunner) -> DeletionSummary:
+    """Deletes a list of (instance ID, owner) instances. We need to impersonate
+    the owner of an instance to delete it, and impersonation is a property of
+    the (admin) user's account, not of the token or request. So instances are
+    grouped by owner, the owner is impersonated once, and that owner's
+    instances are then deleted in parallel (by the tool's runner)
+    before moving to the next owner. The caller is expected to have set
+    the admin state.
+    """
+    owner_instances: Dict[str, List[str]] = {}
+    for i_id, i_owner in instances:
+        owner_instances.setdefault(i_owner, []).append(i_id)
+
+    num_deleted: int = 0
+    num_failed: int = 0
+    failed_owners: List[str] = []
+    start: float = time.perf_counter()
+    for i_owner, i_ids in owner_instances.items():
+        rv: DmApiRv = call_with_retries(
+            lambda: DmApi.set_admin_state(token, admin=True, impersonate=i_owner)  # pylint: disable=cell-var-from-loop
+        )
+        if not rv.success:
+            failed_owners.append(i_owner)
+            num_failed += len(i_ids)
+            continue
+        d_rvs: List[DmApiRv] = runner.run(_delete_instance, [(token, i_id) for i_id in i_ids])
+        for d_rv in d_rvs:
+            if d_rv.success:
+                num_deleted += 1
+            else:
+                num_failed += 1
+
+    return DeletionSummary(num_deleted=num_deleted,
+                           num_failed=num_failed,
+                           duration_s=time.perf_counter() - start,
+                           failed_owners=failed_owners)
+
+
+def _delete_instance(request: Tuple[str, str]) -> DmApiRv:
+    """Deletes the instance of a (token, instance ID) request."""
+    token, i_id = request
+    return DmApi.delete_instance(token, instance_id=i_id)
+
+
+def set_job_exchange_rate(request: Tuple[str, Dict[str, Any]]) -> DmApiRv:
+    """Sets the rate of a (token, rate) request.
+    Suitable for use with run_in_parallel() (which retries transient failures).
+    """
+    token, rate = request
+    return DmApi.set_job_exchange_rates(token, rates=rate)
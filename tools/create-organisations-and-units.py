@@ -3,23 +3,29 @@
 The file is simply a list of organisations that have a `name`, and `owner`
 with an optional list of `units` with names and billing days (with a default of '3)
 (which are created in the same way).
+
+The existing organisations and units are collected first so the tool can
+plan what needs to be created (see --dry-run) before creating the
+organisations, and then their units.
 """
 import argparse
 from pathlib import Path
 import sys
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List, Set, Tuple
 import urllib3
 
 from rich.console import Console
-from squonk2.auth import Auth
 from squonk2.as_api import AsApi, AsApiRv
 from squonk2.environment import Environment
+
+from common import ParallelRunner, get_access_token
+import metrics
 import yaml
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
-def main(c_args: argparse.Namespace, filename: str) -> None:
+def main(c_args: argparse.Namespace, filename: str, runner: ParallelRunner) -> None:
     """Main function."""
 
     console = Console()
@@ -28,73 +34,124 @@ def main(c_args: argparse.Namespace, filename: str) -> None:
     env: Environment = Environment(c_args.environment)
     AsApi.set_api_url(env.as_api)
 
-    token: str = Auth.get_access_token(
-        keycloak_url=env.keycloak_url,
-        keycloak_realm=env.keycloak_realm,
-        keycloak_client_id=env.keycloak_as_client_id,
-        username=env.admin_user,
-        password=env.
-        admin_password,
-    )
+    token: str = get_access_token(env, client_id=env.keycloak_as_client_id)
     if not token:
         print("Failed to get token")
         sys.exit(1)
 
+    # Just read the list from the chosen file
+    # (checking it before we make any changes)
+    file_content: str = Path(filename).read_text(encoding='utf8')
+    orgs: List[Dict[str, Any]] = yaml.load(file_content, Loader=yaml.FullLoader)
+    for org in orgs:
+        if not org.get('name'):
+            console.log(':boom: File has an organisation without a name')
+            sys.exit(1)
+        if not org.get('owner'):
+            console.log(':boom: File has an organisation without an owner')
+            sys.exit(1)
+        for unit in org.get('units', []):
+            if not unit.get('name'):
+                console.log(':boom: File has a unit without a name')
+                sys.exit(1)
+
     # Get the current organisations (as an admin user you should see them all)
     org_rv: AsApiRv = AsApi.get_organisations(token)
     if not org_rv.success:
         console.log(':boom: Failed to get existing organisations')
         sys.exit(1)
-    existing_org_names: List[str] = []
     existing_orgs: Dict[str, str] = {}
     for org in org_rv.msg['organisations']:
         if org['name'] not in ['Default']:
             existing_orgs[org['name']] = org['id']
-            existing_org_names.append(org['name'])
 
-    # Just read the list from the chosen file
-    file_content: str = Path(filename).read_text(encoding='utf8')
-    orgs: List[Dict[str, Any]] = yaml.load(file_content, Loader=yaml.FullLoader)
-    # Create the organisations one at a time (to handle any errors gracefully)
-    for org in orgs:
-        org_name: str = org.get('name')
-        if not org_name:
-            console.log(':boom: File has an organisation without a name')
-            sys.exit(1)
-        owner: str = org.get('owner')
-        if not owner:
-            console.log(':boom: File has an organisation without an owner')
+    # Get the units of every existing organisation that has units in the file
+    # (all at once) to build an index of existing unit names
+    unit_org_names: List[str] = sorted({org['name'] for org in orgs
+                                        if 'units' in org and org['name'] in existing_orgs})
+    unit_rvs: List[AsApiRv] = runner.run(
+        _get_units,
+        [(token, existing_orgs[org_name]) for org_name in unit_org_names],
+    )
+    existing_unit_names: Dict[str, Set[str]] = {}
+    for org_name, unit_rv in zip(unit_org_names, unit_rvs):
+        if not unit_rv.success:
+            console.log(f':boom: Failed to get units for "{org_name}"')
             sys.exit(1)
-        # Now try and create the organisation (if it's new)...
-        if org_name in existing_org_names:
+        existing_unit_names[org_name] = {unit['name'] for unit in unit_rv.msg['units']}
+
+    # Plan the organisations and units that need to be created...
+    org_plan: Dict[str, str] = {}
+    unit_plan: List[Tuple[str, str, int]] = []
+    for org in orgs:
+        org_name: str = org['name']
+        if org_name in existing_orgs:
             console.log(f':white_check_mark: Skipping organisation "{org_name}" - it already exists')
-        else:
-            org_rv: AsApiRv = AsApi.create_organisation(token, org_name=org_name, org_owner=owner)
-            if org_rv.success:
-                emoji = ':white_check_mark:'
-                existing_orgs[org_name] = org_rv.msg['id']
+        elif org_name not in org_plan:
+            org_plan[org_name] = org['owner']
+        for unit in org.get('units', []):
+            unit_name: str = unit['name']
+            if unit_name in existing_unit_names.get(org_name, set()):
+                console.log(f':white_check_mark: Skipping unit "{org_name}/{unit_name}" - it already exists')
             else:
-                emoji = ':cross_mark:'
-            # Log
-            console.log(f'{emoji} {org_name} ({owner})')
-        # Units?
-        if 'units' in org:
-            org_rv: AsApiRv = AsApi.get_units(token, org_id=existing_orgs[org_name])
-            existing_unit_names: List[str] = [unit['name'] for unit in org_rv.msg['units']]
-            for unit in org['units']:
-                unit_name: str = unit.get('name')
-                if not unit_name:
-                    console.log(':boom: File has a unit without a name')
-                    sys.exit(1)
-                if unit_name in existing_unit_names:
-                    console.log(f':white_check_mark: Skipping unit "{org_name}/{unit_name}" - it already exists')
-                else:
-                    billing_day: int = unit.get('billing_day', 3)
-                    # Now try and create the unit (if it's new)...
-                    unit_rv: AsApiRv = AsApi.create_unit(token, org_id=existing_orgs[org_name], unit_name=unit_name, billing_day=billing_day)
-                    emoji = ':white_check_mark:' if unit_rv.success else ':cross_mark:'
-                    # Log
-                    console.log(f'  {emoji} {unit_name} (billing day {billing_day})')
+                existing_unit_names.setdefault(org_name, set()).add(unit_name)
+                unit_plan.append((org_name, unit_name, unit.get('billing_day', 3)))
+    for org_name, owner in org_plan.items():
+        console.log(f':heavy_plus_sign: Organisation {org_name} ({owner})')
+    for org_name, unit_name, billing_day in unit_plan:
+        console.log(f':heavy_plus_sign: Unit {org_name}/{unit_name} (billing day {billing_day})')
+    if c_args.dry_run:
+        console.log(f'Plan: {len(org_plan)} organisations and {len(unit_plan)} units to create')
+        return
+
+    # Create the organisations (in parallel)
+    # and then their units (which depend on them)...
+    # (creation is not retried, a failed request might still have created something)
+    org_rvs: List[AsApiRv] = runner.run(
+        _create_organisation,
+        [(token, org_name, owner) for org_name, owner in org_plan.items()],
+        attempts=1,
+    )
+    for (org_name, owner), org_rv in zip(org_plan.items(), org_rvs):
+        if org_rv.success:
+            emoji = ':white_check_mark:'
+            existing_orgs[org_name] = org_rv.msg['id']
+        else:
+            emoji = ':cross_mark:'
+        # Log
+        console.log(f'{emoji} {org_name} ({owner})')
+
+    unit_rvs = runner.run(
+        _create_unit,
+        [(token, existing_orgs[org_name], unit_name, billing_day)
+         for org_name, unit_name, billing_day in unit_plan if org_name in existing_orgs],
+        attempts=1,
+    )
+    unit_rv_iter: Iterator[AsApiRv] = iter(unit_rvs)
+    for org_name, unit_name, billing_day in unit_plan:
+        # Units of an organisation we failed to create are not attempted
+        unit_success: bool = org_name in existing_orgs and next(unit_rv_iter).success
+        emoji = ':white_check_mark:' if unit_success else ':cross_mark:'
+        # Log
+        console.log(f'  {emoji} {org_name}/{unit_name} (billing day {billing_day})')
+
+
+def _get_units(request: Tuple[str, str]) -> AsApiRv:
+    """Gets the units for a (token, organisation ID) request."""
+    token, org_id = request
+    return AsApi.get_units(token, org_id=org_id)
+
+
+def _create_organisation(request: Tuple[str, str, str]) -> AsApiRv:
+    """Creates the organisation of a (token, name, owner) request."""
+    token, org_name, owner = request
+    return AsApi.create_organisation(token, org_name=org_name, org_owner=owner)
+
+
+def _create_unit(request: Tuple[str, str, str, int]) -> AsApiRv:
+    """Creates the unit of a (token, organisation ID, name, billing day) request."""
+    token, org_id, unit_name, billing_day = request
+    return AsApi.create_unit(token, org_id=org_id, unit_name=unit_name, billing_day=billing_day)
 
 
 if __name__ == "__main__":
@@ -106,7 +163,23 @@ if __name__ == "__main__":
     )
     parser.add_argument('environment', type=str, help='The environment name')
     parser.add_argument('file', type=str, help='The source file')
+    parser.add_argument('--workers', type=int, help='The number of concurrent requests', default=1)
+    parser.add_argument(
+        '--dry-run',
+        help='Set to only display the organisations and units that would be created',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--metrics',
+        help='Print a summary of the API calls made,'
+             ' or write them to this Prometheus textfile',
+        type=str,
+        nargs='?',
+        const=metrics.SUMMARY,
+    )
     args: argparse.Namespace = parser.parse_args()
+    if args.workers < 1:
+        parser.error("The number of workers must be at least 1")
 
     filename: str = args.file
     if not filename.endswith('.yaml'):
@@ -116,4 +189,9 @@ if __name__ == "__main__":
     if not Path(filename).is_file():
         parser.error(f"File '{filename}' does not exist")
 
-    main(args, filename)
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    # (one runner, its pool of workers and request pacing, for every request)
+    with ParallelRunner(environment=args.environment, workers=args.workers) as runner:
+        main(args, filename, runner)
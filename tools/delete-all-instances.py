@@ -15,10 +15,12 @@ import sys
 from typing import Dict, List, Optional, Tuple
 import urllib3
 
-from squonk2.auth import Auth
 from squonk2.dm_api import DmApi, DmApiRv
 from squonk2.environment import Environment
 
+from common import DeletionSummary, ParallelRunner, call_with_retries, delete_instances, get_access_token
+import metrics
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
@@ -28,13 +30,7 @@ def main(c_args: argparse.Namespace) -> None:
     env: Environment = Environment(c_args.environment)
     DmApi.set_api_url(env.dm_api)
 
-    token: str = Auth.get_access_token(
-        keycloak_url=env.keycloak_url,
-        keycloak_realm=env.keycloak_realm,
-        keycloak_client_id=env.keycloak_dm_client_id,
-        username=env.admin_user,
-        password=env.admin_password,
-    )
+    token: str = get_access_token(env, client_id=env.keycloak_dm_client_id)
     if not token:
         print("Failed to get token")
         sys.exit(1)
@@ -43,58 +39,78 @@ def main(c_args: argparse.Namespace) -> None:
     project_instances: Dict[str, List[Tuple[str, str]]] = {}
 
     # To see everything we need to become admin...
-    rv: DmApiRv = DmApi.set_admin_state(token, admin=True)
+    rv: DmApiRv = call_with_retries(lambda: DmApi.set_admin_state(token, admin=True))
     if not rv.success:
         print("Failed to set admin state")
         sys.exit(1)
 
     # Iterate through projects to get instances...
     num_instances: int = 0
-    p_rv = DmApi.get_available_projects(token)
-    if p_rv.success:
-        for project in p_rv.msg['projects']:
-            p_id: str = project['project_id']
-            p_name: str = project['name']
-            print(f"+ Found project '{p_name}' [{p_id}]")
-            pi_rv = DmApi.get_project_instances(token, project_id=p_id)
-            instances: List[str] = []
-            if pi_rv.success:
-                for instance in pi_rv.msg['instances']:
-                    i_id: str = instance['id']
-                    i_name: str = instance['name']
-                    i_owner: str = instance['owner']
-                    print(f"  Found instance '{i_name}' [{i_id}] ({i_owner})")
-                    instances.append((i_id, i_owner))
-                    num_instances += 1
-            if instances:
-                project_instances[p_id] = instances
+    p_rv: DmApiRv = call_with_retries(lambda: DmApi.get_available_projects(token))
+    if not p_rv.success:
+        print("Failed to get projects")
+        _unset_admin_state(token)
+        sys.exit(1)
+    for project in p_rv.msg['projects']:
+        p_id: str = project['project_id']
+        p_name: str = project['name']
+        print(f"+ Found project '{p_name}' [{p_id}]")
+        pi_rv: DmApiRv = call_with_retries(
+            lambda: DmApi.get_project_instances(token, project_id=p_id)  # pylint: disable=cell-var-from-loop
+        )
+        if not pi_rv.success:
+            print(f"Failed to get instances for project '{p_name}' [{p_id}]")
+            _unset_admin_state(token)
+            sys.exit(1)
+        instances: List[str] = []
+        for instance in pi_rv.msg['instances']:
+            i_id: str = instance['id']
+            i_name: str = instance['name']
+            i_owner: str = instance['owner']
+            print(f"  Found instance '{i_name}' [{i_id}] ({i_owner})")
+            instances.append((i_id, i_owner))
+            num_instances += 1
+        if instances:
+            project_instances[p_id] = instances
 
     num_deleted: int = 0
     num_failed: int = 0
+    rate: float = 0.0
     if c_args.do_it:
         print("Deleting...")
-        for p_id, i_items in project_instances.items():
-            for i_id, i_owner in i_items:
-                # To delete we need to impersonate the owner of the instance...
-                rv = DmApi.set_admin_state(token, admin=True, impersonate=i_owner)
-                assert rv.success
-                rv = DmApi.delete_instance(token, instance_id=i_id)
-                if rv.success:
-                    num_deleted += 1
-                else:
-                    num_failed += 1
+        # To delete we need to impersonate the owner of each instance...
+        with ParallelRunner(environment=c_args.environment,
+                            workers=c_args.workers,
+                            max_rps=c_args.max_rps) as runner:
+            summary: DeletionSummary = delete_instances(
+                token,
+                [i_item for i_items in project_instances.values() for i_item in i_items],
+                runner=runner,
+            )
+        num_deleted = summary.num_deleted
+        num_failed = summary.num_failed
+        rate = summary.rate
+        for i_owner in summary.failed_owners:
+            print(f"Failed to impersonate {i_owner}")
         print("Deleted")
 
     # Revert to a non-admin state
-    # To see everything we need to become admin...
-    rv = DmApi.set_admin_state(token, admin=False)
-    if not rv.success:
-        print("Failed to unset admin state")
+    if not _unset_admin_state(token):
         sys.exit(1)
 
     print(f"Found {num_instances}")
     print(f"Deleted {num_deleted}")
     print(f"Failed to deleted {num_failed}")
+    if c_args.do_it:
+        print(f"Deleted {rate:.1f} instances/second")
+
+
+def _unset_admin_state(token: str) -> bool:
+    """Reverts to a non-admin state, returning False (and saying so) if it fails."""
+    rv: DmApiRv = call_with_retries(lambda: DmApi.set_admin_state(token, admin=False))
+    if not rv.success:
+        print("Failed to unset admin state")
+    return rv.success
 
 
 if __name__ == '__main__':
@@ -102,11 +118,37 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Delete All DM Project Instances')
     parser.add_argument('environment', type=str, help='The environment name')
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help='The number of concurrent deletions (for each instance owner)',
+    )
+    parser.add_argument(
+        '--max-rps',
+        help='The most deletion requests to start each second (the default is no limit)',
+        type=float,
+    )
     parser.add_argument(
         '--do-it',
         help='Set to actually delete, if not set the instances are listed',
         action='store_true',
     )
+    parser.add_argument(
+        '--metrics',
+        help='Print a summary of the API calls made,'
+             ' or write them to this Prometheus textfile',
+        type=str,
+        nargs='?',
+        const=metrics.SUMMARY,
+    )
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("The number of workers must be at least 1")
+    if args.max_rps is not None and args.max_rps <= 0:
+        parser.error("The maximum requests per second must be greater than zero")
+
+    if args.metrics:
+        metrics.enable(args.metrics)
 
     main(args)
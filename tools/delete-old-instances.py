@@ -10,14 +10,23 @@ is that the user has admin rights.
 import argparse
 import sys
 from datetime import datetime, timedelta
-from typing import List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 import urllib3
 
 from dateutil.parser import parse
-from squonk2.auth import Auth
 from squonk2.dm_api import DmApi, DmApiRv
 from squonk2.environment import Environment
 
+from common import (
+    DeletionSummary,
+    ParallelRunner,
+    call_with_retries,
+    delete_instances,
+    get_access_token,
+    is_transient_failure,
+)
+import metrics
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
@@ -27,19 +36,13 @@ def main(c_args: argparse.Namespace) -> None:
     env: Environment = Environment(c_args.environment)
     DmApi.set_api_url(env.dm_api)
 
-    token: str = Auth.get_access_token(
-        keycloak_url=env.keycloak_url,
-        keycloak_realm=env.keycloak_realm,
-        keycloak_client_id=env.keycloak_dm_client_id,
-        username=env.admin_user,
-        password=env.admin_password,
-    )
+    token: str = get_access_token(env, client_id=env.keycloak_dm_client_id)
     if not token:
         print("Failed to get token")
         sys.exit(1)
 
     # To see everything we need to become admin...
-    rv: DmApiRv = DmApi.set_admin_state(token, admin=True)
+    rv: DmApiRv = call_with_retries(lambda: DmApi.set_admin_state(token, admin=True))
     if not rv.success:
         print("Failed to set admin state")
         sys.exit(1)
@@ -50,45 +53,81 @@ def main(c_args: argparse.Namespace) -> None:
     # The collection of instances
     old_instances: List[Tuple[str, str]] = []
 
-    p_rv = DmApi.get_available_instances(token)
-    now: datetime = datetime.utcnow()
-    if p_rv.success:
-        for instance in p_rv.msg['instances']:
-            i_id: str = instance['id']
-            i_rv = DmApi.get_instance(token, instance_id=i_id)
-            if i_rv.success and 'stopped' in i_rv.msg:
-                i_stopped: datetime = parse(i_rv.msg['stopped'])
+    # One runner (its pool of workers and request pacing)
+    # for the instance detail requests and the deletions
+    with ParallelRunner(environment=c_args.environment,
+                        workers=c_args.workers,
+                        max_rps=c_args.max_rps) as runner:
+        p_rv: DmApiRv = call_with_retries(lambda: DmApi.get_available_instances(token))
+        if not p_rv.success:
+            print("Failed to get instances")
+            _unset_admin_state(token)
+            sys.exit(1)
+        now: datetime = datetime.utcnow()
+        num_detail_calls_saved: int = 0
+        instances: List[Dict[str, Any]] = p_rv.msg['instances']
+        # If any listed instance carries a 'stopped' value then the list
+        # has everything we need - instances without one have not stopped.
+        # Otherwise we have to get the details of each instance.
+        if any('stopped' in instance for instance in instances):
+            details: List[Dict[str, Any]] = instances
+            num_detail_calls_saved = len(instances)
+        else:
+            i_rvs: List[DmApiRv] = runner.run(_get_instance, [(token, instance['id']) for instance in instances])
+            # (an instance that's gone since it was listed is not a failure)
+            if any(is_transient_failure(i_rv) for i_rv in i_rvs):
+                print("Failed to get the details of every instance")
+                _unset_admin_state(token)
+                sys.exit(1)
+            details = [i_rv.msg for i_rv in i_rvs if i_rv.success]
+        for detail in details:
+            if 'stopped' in detail:
+                i_id: str = detail['id']
+                i_stopped: datetime = parse(detail['stopped'])
                 i_stopped_age: timedelta = now - i_stopped
                 if i_stopped_age >= max_stopped_age:
-                    i_name: str = i_rv.msg['name']
+                    i_name: str = detail['name']
                     print(f"+ Found instance '{i_name}' [{i_id}] (Stopped {i_stopped_age})")
-                    old_instances.append((i_id, i_rv.msg['owner']))
-
-    num_deleted: int = 0
-    num_failed: int = 0
-    if c_args.do_it:
-        print("Deleting...")
-        for i_id, i_owner in old_instances:
-            # To delete we need to impersonate the owner of the instance...
-            rv = DmApi.set_admin_state(token, admin=True, impersonate=i_owner)
-            assert rv.success
-            rv = DmApi.delete_instance(token, instance_id=i_id)
-            if rv.success:
-                num_deleted += 1
-            else:
-                num_failed += 1
-        print("Deleted")
+                    old_instances.append((i_id, detail['owner']))
+
+        num_deleted: int = 0
+        num_failed: int = 0
+        rate: float = 0.0
+        if c_args.do_it:
+            print("Deleting...")
+            # To delete we need to impersonate the owner of each instance...
+            summary: DeletionSummary = delete_instances(token, old_instances, runner=runner)
+            num_deleted = summary.num_deleted
+            num_failed = summary.num_failed
+            rate = summary.rate
+            for i_owner in summary.failed_owners:
+                print(f"Failed to impersonate {i_owner}")
+            print("Deleted")
 
     # Revert to a non-admin state
-    # To see everything we need to become admin...
-    rv = DmApi.set_admin_state(token, admin=False)
-    if not rv.success:
-        print("Failed to unset admin state")
+    if not _unset_admin_state(token):
         sys.exit(1)
 
     print(f"Found {len(old_instances)}")
+    print(f"Saved {num_detail_calls_saved} instance detail calls")
     print(f"Deleted {num_deleted}")
     print(f"Failed to deleted {num_failed}")
+    if c_args.do_it:
+        print(f"Deleted {rate:.1f} instances/second")
+
+
+def _unset_admin_state(token: str) -> bool:
+    """Reverts to a non-admin state, returning False (and saying so) if it fails."""
+    rv: DmApiRv = call_with_retries(lambda: DmApi.set_admin_state(token, admin=False))
+    if not rv.success:
+        print("Failed to unset admin state")
+    return rv.success
+
+
+def _get_instance(request: Tuple[str, str]) -> DmApiRv:
+    """Gets the details of a (token, instance ID) request."""
+    token, i_id = request
+    return DmApi.get_instance(token, instance_id=i_id)
 
 
 if __name__ == '__main__':
@@ -103,11 +142,38 @@ if __name__ == '__main__':
         type=int,
         help='Age (hours) when an instance is considered "old"',
     )
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help='The number of concurrent instance detail requests and deletions',
+    )
+    parser.add_argument(
+        '--max-rps',
+        help='The most instance detail and deletion requests to start each second'
+             ' (the default is no limit)',
+        type=float,
+    )
     parser.add_argument(
         '--do-it',
         help='Set to actually delete, if not set the old instances are listed',
         action='store_true',
     )
+    parser.add_argument(
+        '--metrics',
+        help='Print a summary of the API calls made,'
+             ' or write them to this Prometheus textfile',
+        type=str,
+        nargs='?',
+        const=metrics.SUMMARY,
+    )
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("The number of workers must be at least 1")
+    if args.max_rps is not None and args.max_rps <= 0:
+        parser.error("The maximum requests per second must be greater than zero")
+
+    if args.metrics:
+        metrics.enable(args.metrics)
 
     main(args)
@@ -5,14 +5,23 @@
 """
 import argparse
 import sys
-from typing import Any, Dict, List, Optional
+import time
+from typing import Any, Dict, List, Optional, Tuple
 import urllib3
 
-from squonk2.auth import Auth
+from rich.progress import (
+    BarColumn,
+    MofNCompleteColumn,
+    Progress,
+    TaskID,
+    TextColumn,
+    TimeRemainingColumn,
+)
 from squonk2.dm_api import DmApi, DmApiRv
 from squonk2.environment import Environment
 
-from common import TEST_UNIT, TEST_USER_NAMES
+from common import TEST_UNIT, TEST_USER_NAMES, ParallelRunner, call_with_retries, get_access_token
+import metrics
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -23,22 +32,20 @@ def main(c_args: argparse.Namespace) -> None:
     env: Environment = Environment(c_args.environment)
     DmApi.set_api_url(env.dm_api)
 
-    token: str = Auth.get_access_token(
-        keycloak_url=env.keycloak_url,
-        keycloak_realm=env.keycloak_realm,
-        keycloak_client_id=env.keycloak_dm_client_id,
-        username=env.admin_user,
-        password=env.admin_password,
-    )
+    token: str = get_access_token(env, client_id=env.keycloak_dm_client_id)
     if not token:
         print("Failed to get token")
         sys.exit(1)
 
-    ret_val: DmApiRv = DmApi.get_available_projects(token)
-    assert ret_val.success
+    ret_val: DmApiRv = call_with_retries(lambda: DmApi.get_available_projects(token))
+    if not ret_val.success:
+        print("Failed to get projects")
+        sys.exit(1)
     num_projects: int = 0
     num_projects_of_interest: int = 0
-    num_deleted: int = 0
+    # Test projects, batched by owner (in TEST_USER_NAMES order)
+    # so that we only need to impersonate each owner once.
+    owner_projects: Dict[str, List[Tuple[str, str]]] = {owner: [] for owner in TEST_USER_NAMES}
     projects: List[Dict[str, Any]] = ret_val.msg["projects"]
     for project in projects:
         num_projects += 1
@@ -54,34 +61,87 @@ def main(c_args: argparse.Namespace) -> None:
             else:
                 p_claimed = False
 
-            # Do delete something that's not ours
-            # we need to switch to the Project owner
-            ret_val = DmApi.set_admin_state(token, admin=True, impersonate=p_owner)
-            assert ret_val.success
-
             num_projects_of_interest += 1
-            msg: str = (
-                f"project '{p_name}' (owner={p_owner} id={p_id} has_claim={p_claimed})"
+            print(
+                f"Found project '{p_name}' (owner={p_owner} id={p_id} has_claim={p_claimed})"
             )
-            if c_args.do_it:
-                print(f"Deleting {msg}...")
-                ret_val = DmApi.delete_project(token, project_id=p_id)
-                if not ret_val.success:
-                    print(f"ERROR: {ret_val.msg}")
-                num_deleted += 1
-            else:
-                print(f"Found {msg}")
+            owner_projects[p_owner].append((p_id, p_name))
+
+    num_deleted: int = 0
+    # A list of failures, as (project name, project ID, error) tuples
+    failures: List[Tuple[str, str, str]] = []
+    if c_args.do_it and num_projects_of_interest:
+        with Progress(
+            TextColumn("Deleting {task.fields[owner]}"),
+            BarColumn(),
+            MofNCompleteColumn(),
+            TextColumn("{task.fields[rate]:.1f} projects/s"),
+            TextColumn("ETA"),
+            TimeRemainingColumn(),
+        ) as progress:
+            task_id: TaskID = progress.add_task(
+                "Deleting", total=num_projects_of_interest, owner="", rate=0.0
+            )
+            start: float = time.perf_counter()
+
+            def on_result(_: Any) -> None:
+                completed: int = progress.tasks[0].completed + 1
+                progress.update(
+                    task_id,
+                    completed=completed,
+                    rate=completed / (time.perf_counter() - start),
+                )
+
+            # (one runner, its pool of workers and request pacing, for every owner)
+            with ParallelRunner(environment=c_args.environment,
+                                workers=c_args.workers,
+                                max_rps=c_args.max_rps) as runner:
+                for p_owner, p_items in owner_projects.items():
+                    if not p_items:
+                        continue
+                    progress.update(task_id, owner=p_owner)
+                    # To delete something that's not ours
+                    # we need to switch to the Project owner
+                    ret_val = call_with_retries(
+                        lambda: DmApi.set_admin_state(token, admin=True, impersonate=p_owner)  # pylint: disable=cell-var-from-loop
+                    )
+                    if not ret_val.success:
+                        for p_id, p_name in p_items:
+                            failures.append((p_name, p_id, f"Failed to impersonate {p_owner}"))
+                        progress.advance(task_id, len(p_items))
+                        continue
+                    d_rvs: List[DmApiRv] = runner.run(
+                        _delete_project,
+                        [(token, p_id) for p_id, _ in p_items],
+                        on_result=on_result,
+                    )
+                    for (p_id, p_name), d_rv in zip(p_items, d_rvs):
+                        if d_rv.success:
+                            num_deleted += 1
+                        else:
+                            failures.append((p_name, p_id, d_rv.msg.get("error", "")))
 
     print(
         "Done.\n"
         f"# Inspected {num_projects} projects\n"
         f"# {num_projects_of_interest} owned by a test user\n"
-        f"# {num_deleted} deleted"
+        f"# {num_deleted} deleted\n"
+        f"# {len(failures)} failed"
     )
+    for p_name, p_id, error in failures:
+        print(f"ERROR: project '{p_name}' (id={p_id}) {error}")
 
     # Undo impersonation
-    ret_val = DmApi.set_admin_state(token, admin=False)
-    assert ret_val.success
+    ret_val = call_with_retries(lambda: DmApi.set_admin_state(token, admin=False))
+    if not ret_val.success:
+        print("Failed to unset admin state")
+        sys.exit(1)
+
+
+def _delete_project(request: Tuple[str, str]) -> DmApiRv:
+    """Deletes the project of a (token, project ID) request."""
+    token, p_id = request
+    return DmApi.delete_project(token, project_id=p_id)
 
 
 if __name__ == "__main__":
@@ -91,11 +151,37 @@ if __name__ == "__main__":
         description="Delete all Projects owned by test users"
     )
     parser.add_argument('environment', type=str, help='The environment name')
+    parser.add_argument(
+        "--workers",
+        help="The number of concurrent deletions (for each project owner)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--max-rps",
+        help="The most deletion requests to start each second (the default is no limit)",
+        type=float,
+    )
     parser.add_argument(
         "--do-it",
         help="Set to actually delete, if not set the projects are listed",
         action="store_true",
     )
+    parser.add_argument(
+        '--metrics',
+        help='Print a summary of the API calls made,'
+             ' or write them to this Prometheus textfile',
+        type=str,
+        nargs='?',
+        const=metrics.SUMMARY,
+    )
     args: argparse.Namespace = parser.parse_args()
+    if args.workers < 1:
+        parser.error("The number of workers must be at least 1")
+    if args.max_rps is not None and args.max_rps <= 0:
+        parser.error("The maximum requests per second must be greater than zero")
+
+    if args.metrics:
+        metrics.enable(args.metrics)
 
     main(args)
@@ -13,82 +13,165 @@ Displays the results in table form (like PSQL) with columns: -
 - Unit name
 - Product name
 
-In this version "Project X" units are excluded.
+Use '--filter' (as often as you need) to only get the executions that match
+a field, i.e. '--filter user=alice' or '--filter "collection=im-*"'. The fields
+are unit, product, user, collection, job and version, tested with '=' or '!='
+and a glob pattern, and started, tested with '>=' or '<' and a date
+(or date and time), i.e. '--filter "started<2024-01-01"' (quote comparisons,
+or the shell takes '<' and '>' as redirections). An execution must
+match every filter. Charges are only fetched for the Products whose Unit and
+Product match, and only from the latest 'started>=' date, and executions
+that do not match are dropped as the charges are read (rather than collected).
+
+"Project X" units are excluded, unless there is a unit filter.
+
+Use '--format csv' or '--format jsonl' to stream the executions
+(as each product's charges are collected) rather than print a table.
+
+Use '--summary user', '--summary job' or '--summary unit-user' to print
+the number of executions, their coins and the first and last started
+of each user, Job (or Unit and user) instead, i.e. the top 20 by coins: -
+
+    get-job-executions.py syg <org> 2023-12-01 --summary user --top 20
+
+The executions are summarised as they're collected (they are not kept)
+and only the top groups are ranked (with a heap), not all of them.
 """
 import argparse
+import csv
+from datetime import datetime
+from decimal import Decimal
+from fnmatch import fnmatchcase
+import heapq
+import json
+import re
+import sqlite3
 import sys
-from typing import Dict, List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import urllib3
 
-from squonk2.auth import Auth
 from squonk2.as_api import AsApi, AsApiRv
 from squonk2.environment import Environment
 
+from common import get_access_token
+import metrics
+import warehouse
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-_UNITS_TO_EXCLUDE: List[str] = ["Project X"]
+# The filters used unless there's a unit filter
+_DEFAULT_FILTERS: List[str] = ["unit!=Project X"]
+
+# The fields that can be filtered that are tested before any charges are fetched
+_PRODUCT_FIELDS: Tuple[str, ...] = ("unit", "product")
+# The fields that are tested as the charges are read,
+# and the charge (or additional data) key (and database column) of each
+_CHARGE_FIELDS: Dict[str, str] = {"user": "username",
+                                  "collection": "job_collection",
+                                  "job": "job_job",
+                                  "version": "job_version",
+                                  "started": "started"}
+# The operators of each field (dates are compared, everything else is a pattern)
+_DATE_OPERATORS: Tuple[str, ...] = (">=", "<")
+_PATTERN_OPERATORS: Tuple[str, ...] = ("=", "!=")
+
+_FILTER_RE: re.Pattern = re.compile(r"^\s*(\w+)\s*(!=|>=|=|<)(.*)$")
+
+# A filter's (field or charge key, operator, value)
+_Filter = Tuple[str, str, str]
+
+# The names of the columns (used in the CSV header and as JSONL keys)
+_COLUMNS: List[str] = ["username", "job", "started", "unit", "product"]
+# (each execution is followed by its coins, which are only summarised)
+_COINS: int = len(_COLUMNS)
+
+# The columns each summary groups the executions by
+_SUMMARY_KEYS: Dict[str, List[str]] = {"user": ["username"],
+                                       "job": ["job"],
+                                       "unit-user": ["unit", "username"]}
+# The columns of each group's statistics
+_SUMMARY_COLUMNS: List[str] = ["count", "coins", "first", "last"]
 
 
 def main(c_args: argparse.Namespace) -> None:
 
-    _ = Environment.load()
-    env: Environment = Environment(c_args.environment)
-    AsApi.set_api_url(env.as_api)
-
-    token: str = Auth.get_access_token(
-        keycloak_url=env.keycloak_url,
-        keycloak_realm=env.keycloak_realm,
-        keycloak_client_id=env.keycloak_as_client_id,
-        username=env.admin_user,
-        password=env.admin_password,
-    )
-    if not token:
-        print("Failed to get token")
-        sys.exit(1)
-
-    # Get all the Products (and Units) for the Organisation
+    # Get all the Products (and Units) for the Organisation,
+    # from the local database or the AS
+    if c_args.from_db:
+        conn: sqlite3.Connection = warehouse.connect(c_args.from_db)
+        products: List[tuple] = warehouse.get_organisation_products(conn, c_args.organisation)
+    else:
+        _ = Environment.load()
+        env: Environment = Environment(c_args.environment)
+        AsApi.set_api_url(env.as_api)
+
+        token: str = get_access_token(env, client_id=env.keycloak_as_client_id)
+        if not token:
+            print("Failed to get token")
+            sys.exit(1)
+
+        j_rv: AsApiRv = AsApi.get_products_for_organisation(token, org_id=c_args.organisation)
+        products = [(product['product']['id'], product['product']['name'], product['unit']['name'])
+                    for product in j_rv.msg['products']]
+
+    # Split the filters into those tested against each Product (now)
+    # and those tested against each charge
+    filters: List[_Filter] = c_args.filter or []
+    if not any(field == "unit" for field, _, _ in filters):
+        filters = [_filter(text) for text in _DEFAULT_FILTERS] + filters
+    product_filters: List[_Filter] = [f for f in filters if f[0] in _PRODUCT_FIELDS]
+    charge_filters: List[_Filter] = [(_CHARGE_FIELDS[field], operator, value)
+                                     for field, operator, value in filters if field in _CHARGE_FIELDS]
+    # Charges are not fetched from before the latest 'started>=' date
+    # (a Job is charged after it's started)
+    from_date: str = max([c_args.from_date] + [value[:10] for key, operator, value in charge_filters
+                                               if key == "started" and operator == ">="])
+
     organisation_products: Dict[str, Dict[str, str]] = {}
-    j_rv: AsApiRv = AsApi.get_products_for_organisation(token, org_id=args.organisation)
     max_unit_length = 0
     max_product_length = 0
-    for product in j_rv.msg['products']:
+    for product_id, product_name, unit_name in products:
 
-        unit_name = product['unit']['name']
-        if unit_name in _UNITS_TO_EXCLUDE:
+        if not _matches({'unit': unit_name, 'product': product_name}, product_filters):
             continue
 
         if len(unit_name) > max_unit_length:
             max_unit_length = len(unit_name)
 
-        product_name = product['product']['name']
         if len(product_name) > max_product_length:
             max_product_length = len(product_name)
-        organisation_products[product['product']['id']] = {'unit': unit_name, 'product': product_name}
+        organisation_products[product_id] = {'unit': unit_name, 'product': product_name}
+
+    # Get all the Jobs for each Product.
+    # CSV and JSONL rows are written as each Product's charges arrive,
+    # the table needs all the rows (to size the columns) before it's printed.
+    if c_args.from_db:
+        executions: Iterator[List[str]] = _get_db_executions(conn, organisation_products, from_date, charge_filters)
+    else:
+        executions = _get_executions(token, organisation_products, from_date, charge_filters)
+    if c_args.summary:
+        _print_summary(executions, c_args)
+        return
+    if c_args.format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(_COLUMNS)
+        for execution in executions:
+            writer.writerow(execution[:_COINS])
+        return
+    if c_args.format == 'jsonl':
+        for execution in executions:
+            print(json.dumps(dict(zip(_COLUMNS, execution))))
+        return
 
-    # Get all the Jobs for each Product
     results: List[List[str]] = []
     max_username_length = 0
     max_job_length = 0
-    for organisation_product in organisation_products.keys():
-        j_rv = AsApi.get_product_charges(token, product_id=organisation_product, from_=args.from_date)
-        for processing_charge in j_rv.msg['processing_charges']:
-
-            username: str = processing_charge['charge']['username']
-            if len(username) > max_username_length:
-                max_username_length = len(username)
-
-            collection: str = processing_charge['charge']['additional_data']['job_collection']
-            job_name: str = processing_charge['charge']['additional_data']['job_job']
-            version: str = processing_charge['charge']['additional_data']['job_version']
-            job: str = f"{collection}/{job_name}/{version}"
-            if len(job) > max_job_length:
-                max_job_length = len(job)
-
-            started: str = processing_charge['charge']['additional_data']['started']
-
-            unit_name = organisation_products[organisation_product]['unit']
-            product_name = organisation_products[organisation_product]['product']
-            results.append([username, job, started, unit_name, product_name])
+    for result in executions:
+        if len(result[0]) > max_username_length:
+            max_username_length = len(result[0])
+        if len(result[1]) > max_job_length:
+            max_job_length = len(result[1])
+        results.append(result)
 
     col1 = "Username"
     col2 = "Job (collection/name/version)"
@@ -106,6 +189,157 @@ def main(c_args: argparse.Namespace) -> None:
     print(f"({len(results)} rows)")
 
 
+def _filter(text: str) -> _Filter:
+    """Parses a filter (i.e. 'user=alice') into its (field, operator, value)."""
+    match = _FILTER_RE.match(text)
+    if not match:
+        raise argparse.ArgumentTypeError(f"'{text}' is not a filter (i.e. user=alice)")
+    field, operator, value = match.group(1), match.group(2), match.group(3).strip()
+    if field not in _PRODUCT_FIELDS and field not in _CHARGE_FIELDS:
+        raise argparse.ArgumentTypeError(
+            f"Cannot filter on '{field}' (choose from {', '.join(_PRODUCT_FIELDS + tuple(_CHARGE_FIELDS))})")
+    operators: Tuple[str, ...] = _DATE_OPERATORS if field == "started" else _PATTERN_OPERATORS
+    if operator not in operators:
+        raise argparse.ArgumentTypeError(f"A {field} filter must use {' or '.join(operators)}")
+    if field == "started":
+        # Dates are compared as text, with the AS's started timestamps
+        # (i.e. 2024-01-31T09:00:00), so they're written the same way
+        try:
+            value = datetime.fromisoformat(value).isoformat()
+        except ValueError as ex:
+            raise argparse.ArgumentTypeError(f"'{value}' is not a date (i.e. 2024-01-31)") from ex
+    return field, operator, value
+
+
+def _matches(values: Dict[str, Any], filters: List[_Filter]) -> bool:
+    """True if the values (of each filter's field or key) match every filter.
+    (a missing value is an empty string)
+    """
+    for key, operator, pattern in filters:
+        value: str = values.get(key) or ""
+        if operator == "=":
+            matched: bool = fnmatchcase(value, pattern)
+        elif operator == "!=":
+            matched = not fnmatchcase(value, pattern)
+        elif operator == ">=":
+            matched = value >= pattern
+        else:
+            matched = value < pattern
+        if not matched:
+            return False
+    return True
+
+
+def _summarise(executions: Iterator[List[str]], summary: str) -> Dict[Tuple[str, ...], List[Any]]:
+    """Summarises executions as they're collected, returning the
+    [count, coins, first, last] (started) of each group (see _SUMMARY_KEYS).
+    """
+    key_columns: List[int] = [_COLUMNS.index(column) for column in _SUMMARY_KEYS[summary]]
+    groups: Dict[Tuple[str, ...], List[Any]] = {}
+    for execution in executions:
+        key: Tuple[str, ...] = tuple(execution[column] for column in key_columns)
+        coins: Decimal = Decimal(execution[_COINS])
+        started: str = execution[2]
+        group: Optional[List[Any]] = groups.get(key)
+        if group is None:
+            groups[key] = [1, coins, started, started]
+            continue
+        group[0] += 1
+        group[1] += coins
+        if started < group[2]:
+            group[2] = started
+        if started > group[3]:
+            group[3] = started
+    return groups
+
+
+def _print_summary(executions: Iterator[List[str]], c_args: argparse.Namespace) -> None:
+    """Prints the top groups of a summary (by count or coins), in the chosen format."""
+    groups: Dict[Tuple[str, ...], List[Any]] = _summarise(executions, c_args.summary)
+    rank: int = _SUMMARY_COLUMNS.index(c_args.rank_by)
+    # A heap of the top groups, rather than sorting all of them
+    # (ties keep the order the groups were found in)
+    if c_args.top:
+        top: List[Tuple[Tuple[str, ...], List[Any]]] = heapq.nlargest(
+            c_args.top, groups.items(), key=lambda item: item[1][rank])
+    else:
+        top = sorted(groups.items(), key=lambda item: item[1][rank], reverse=True)
+    header: List[str] = _SUMMARY_KEYS[c_args.summary] + _SUMMARY_COLUMNS
+    rows: List[List[str]] = [[*key, str(count), str(coins), first, last]
+                             for key, (count, coins, first, last) in top]
+
+    if c_args.format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(header)
+        writer.writerows(rows)
+        return
+    if c_args.format == 'jsonl':
+        for key, (count, coins, first, last) in top:
+            print(json.dumps(dict(zip(header, [*key, count, str(coins), first, last]))))
+        return
+
+    # The table (numbers are right-aligned)
+    num_keys: int = len(_SUMMARY_KEYS[c_args.summary])
+    widths: List[int] = [max([len(header[column])] + [len(row[column]) for row in rows])
+                         for column in range(len(header))]
+    print(" | ".join(f"{title:<{width}}" for title, width in zip(header, widths)))
+    print("+".join("-" * (width + 2) for width in widths)[1:-1])
+    for row in rows:
+        print(" | ".join(f"{value:<{width}}" if column < num_keys or column > num_keys + 1 else f"{value:>{width}}"
+                         for column, (value, width) in enumerate(zip(row, widths))))
+    print(f"({len(rows)} of {len(groups)} rows)")
+
+
+def _get_executions(token: str,
+                    organisation_products: Dict[str, Dict[str, str]],
+                    from_date: str,
+                    charge_filters: List[_Filter]) -> Iterator[List[str]]:
+    """Yields the [username, job, started, unit, product, coins] of each Job execution
+    (that matches the charge filters), one Product's charges at a time.
+    """
+    for organisation_product in organisation_products.keys():
+        j_rv = AsApi.get_product_charges(token, product_id=organisation_product, from_=from_date)
+        for processing_charge in j_rv.msg['processing_charges']:
+
+            username: str = processing_charge['charge']['username']
+            additional_data: Dict[str, Any] = processing_charge['charge']['additional_data']
+            if charge_filters and not _matches(dict(additional_data, username=username), charge_filters):
+                continue
+
+            collection: str = additional_data['job_collection']
+            job_name: str = additional_data['job_job']
+            version: str = additional_data['job_version']
+            job: str = f"{collection}/{job_name}/{version}"
+
+            started: str = additional_data['started']
+
+            unit_name = organisation_products[organisation_product]['unit']
+            product_name = organisation_products[organisation_product]['product']
+            yield [username, job, started, unit_name, product_name, processing_charge['charge']['coins']]
+        sys.stdout.flush()
+
+
+def _get_db_executions(conn: sqlite3.Connection,
+                       organisation_products: Dict[str, Dict[str, str]],
+                       from_date: str,
+                       charge_filters: List[_Filter]) -> Iterator[List[str]]:
+    """Yields the [username, job, started, unit, product, coins] of each Job execution
+    (that matches the charge filters) from the local database (see sync-charges),
+    one Product at a time. The filters are tested by the database, and the
+    connection is closed once the executions have been read.
+    """
+    try:
+        for organisation_product in organisation_products.keys():
+            unit_name = organisation_products[organisation_product]['unit']
+            product_name = organisation_products[organisation_product]['product']
+            for username, collection, job_name, version, started, coins in \
+                    warehouse.get_executions(conn, organisation_product, from_date, charge_filters):
+                yield [username, f"{collection}/{job_name}/{version}", started, unit_name, product_name, coins]
+            sys.stdout.flush()
+    finally:
+        conn.close()
+
+
 if __name__ == '__main__':
     # Build a command-line parser and parse it...
     parser = argparse.ArgumentParser(
@@ -113,6 +347,29 @@ if __name__ == '__main__':
     parser.add_argument('environment', type=str, help='The environment name')
     parser.add_argument('organisation', type=str, help='The organisation ID')
     parser.add_argument('from_date', type=str, help='The date to start from (inclusive)')
+    parser.add_argument('--format', choices=['table', 'csv', 'jsonl'], default='table',
+                        help='The output format (csv and jsonl rows are written as they are collected)')
+    parser.add_argument('--from-db', type=str, nargs='?', const=warehouse.DEFAULT_DATABASE,
+                        help='Use charges from a local database (see sync-charges), rather than the AS')
+    parser.add_argument('--filter', type=_filter, action='append',
+                        help='Only get the executions that match a filter, i.e. user=alice'
+                             ' or "started<2024-01-01" (quoted, so the shell does not take'
+                             ' the "<" as a redirection). Can be repeated')
+    parser.add_argument('--summary', choices=list(_SUMMARY_KEYS),
+                        help='Print the count, coins and first and last started'
+                             ' of the executions of each user, Job or Unit and user')
+    parser.add_argument('--top', type=int, default=20,
+                        help='The number of groups a summary prints (default 20, 0 for all of them)')
+    parser.add_argument('--rank-by', choices=['count', 'coins'], default='coins',
+                        help='What the groups of a summary are ranked by (default coins)')
+    parser.add_argument('--metrics', type=str, nargs='?', const=metrics.SUMMARY,
+                        help='Print a summary of the API calls made,'
+                             ' or write them to this Prometheus textfile')
     args = parser.parse_args()
+    if args.top < 0:
+        parser.error("The number of top groups cannot be negative")
+
+    if args.metrics:
+        metrics.enable(args.metrics)
 
     main(args)
@@ -1,35 +1,41 @@
 #!/usr/bin/env python
-"""Gets organisations and units.
+"""Gets organisations, units and products.
+
+The hierarchy can be written to a JSON snapshot (--snapshot)
+and two snapshots can be compared (--diff).
 """
 import argparse
+from datetime import datetime
+import json
+from pathlib import Path
 import sys
+from typing import Any
 import urllib3
 
 from rich.console import Console
-from squonk2.auth import Auth
 from squonk2.as_api import AsApi, AsApiRv
 from squonk2.environment import Environment
 
+from common import ParallelRunner, get_access_token
+import metrics
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
-def main(c_args: argparse.Namespace) -> None:
+def main(c_args: argparse.Namespace, runner: ParallelRunner) -> None:
     """Main function."""
 
     console = Console()
 
+    if c_args.diff:
+        _diff_snapshots(console, c_args.diff[0], c_args.diff[1])
+        return
+
     _ = Environment.load()
     env: Environment = Environment(c_args.environment)
     AsApi.set_api_url(env.as_api)
 
-    token: str = Auth.get_access_token(
-        keycloak_url=env.keycloak_url,
-        keycloak_realm=env.keycloak_realm,
-        keycloak_client_id=env.keycloak_as_client_id,
-        username=env.admin_user,
-        password=env.
-        admin_password,
-    )
+    token: str = get_access_token(env, client_id=env.keycloak_as_client_id)
     if not token:
         print("Failed to get token")
         sys.exit(1)
@@ -39,50 +45,110 @@ def main(c_args: argparse.Namespace) -> None:
     if not org_rv.success:
         console.log(':boom: Failed to get existing organisations')
         sys.exit(1)
-    existing_org_names: list[str] = []
-    existing_orgs: dict[str, str] = {}
-    for org in org_rv.msg['organisations']:
-        if org['name'] not in ['Default']:
-            existing_orgs[org['name']] = org['id']
-            existing_org_names.append(org['name'])
-
-    org_count: int = 0
-    unit_count: int = 0
+    orgs: list[dict[str, Any]] = [{'id': org['id'], 'name': org['name'], 'units': []}
+                                  for org in org_rv.msg['organisations']
+                                  if org['name'] not in ['Default']]
+    orgs.sort(key=lambda org: org['name'])
+
+    # Get every organisation's units, and then every unit's products
+    # (each set of requests is made concurrently)
+    unit_rvs: list[AsApiRv] = runner.run(
+        _get_units,
+        [(token, org['id']) for org in orgs],
+    )
+    units: list[dict[str, Any]] = []
+    for org, unit_rv in zip(orgs, unit_rvs):
+        org['units'] = sorted(({'id': unit['id'], 'name': unit['name'], 'products': []}
+                               for unit in unit_rv.msg['units']),
+                              key=lambda unit: unit['name'])
+        units.extend(org['units'])
+    products_rvs: list[AsApiRv] = runner.run(
+        _get_products_for_unit,
+        [(token, unit['id']) for unit in units],
+    )
+    for unit, products_rv in zip(units, products_rvs):
+        unit['products'] = sorted(({'id': product['product']['id'], 'name': product['product']['name']}
+                                   for product in products_rv.msg['products']),
+                                  key=lambda product: product['name'])
+
     product_count: int = 0
-    existing_org_names.sort()
-    for existing_org_name in existing_org_names:
-        org_count += 1
-        org_id: str = existing_orgs[existing_org_name]
-        console.log(f'ORG={existing_org_name} / {org_id}')
-        unit_names: list[str] = []
-        units: dict[str, str] = {}
-        unit_rv: AsApiRv = AsApi.get_units(token, org_id=org_id)
-        for unit in unit_rv.msg["units"]:
-            unit_names.append(unit["name"])
-            units[unit["name"]] = unit["id"]
-        unit_names.sort()
-        for unit_name in unit_names:
-            unit_count += 1
-            unit_id = units[unit_name]
-            console.log(f'  UNIT={unit_name} / {unit_id}')
-            products_rv: AsApiRv = AsApi.get_products_for_unit(token, unit_id=unit_id)
-            product_names: list[str] = []
-            products: dict[str, str] = {}
-            for product in products_rv.msg["products"]:
-                product_id: str = product["product"]["id"]
-                product_name: str = product["product"]["name"]
-                product_names.append(product_name)
-                products[product_name] = product_id
-            product_names.sort()
-            for product_name in product_names:
+    for org in orgs:
+        console.log(f'ORG={org["name"]} / {org["id"]}')
+        for unit in org['units']:
+            console.log(f'  UNIT={unit["name"]} / {unit["id"]}')
+            for product in unit['products']:
                 product_count += 1
-                product_id = products[product_name]
-                console.log(f'    PRODUCT="{product_name}" / {product_id}')
+                console.log(f'    PRODUCT="{product["name"]}" / {product["id"]}')
 
-    console.log(f'{org_count} Organisations')
-    console.log(f'{unit_count} Units')
+    console.log(f'{len(orgs)} Organisations')
+    console.log(f'{len(units)} Units')
     console.log(f'{product_count} Products')
 
+    if c_args.snapshot:
+        snapshot: dict[str, Any] = {
+            'environment': c_args.environment,
+            'time': str(datetime.utcnow()),
+            'organisations': orgs,
+        }
+        Path(c_args.snapshot).write_text(json.dumps(snapshot, indent=2), encoding='utf8')
+        console.log(f'Snapshot written to {c_args.snapshot}')
+
+
+def _get_units(request: tuple[str, str]) -> AsApiRv:
+    """Gets the units for a (token, organisation ID) request."""
+    token, org_id = request
+    return AsApi.get_units(token, org_id=org_id)
+
+
+def _get_products_for_unit(request: tuple[str, str]) -> AsApiRv:
+    """Gets the products for a (token, unit ID) request."""
+    token, unit_id = request
+    return AsApi.get_products_for_unit(token, unit_id=unit_id)
+
+
+def _index_snapshot(filename: str) -> dict[str, tuple[str, str, str]]:
+    """Reads a snapshot, returning its organisations, units and products
+    indexed by ID, with their kind, name and parent ID.
+    """
+    snapshot: dict[str, Any] = json.loads(Path(filename).read_text(encoding='utf8'))
+    index: dict[str, tuple[str, str, str]] = {}
+    for org in snapshot['organisations']:
+        index[org['id']] = ('ORG', org['name'], '')
+        for unit in org['units']:
+            index[unit['id']] = ('UNIT', unit['name'], org['id'])
+            for product in unit['products']:
+                index[product['id']] = ('PRODUCT', product['name'], unit['id'])
+    return index
+
+
+def _diff_snapshots(console: Console, old_filename: str, new_filename: str) -> None:
+    """Displays the organisations, units and products that have been
+    added, removed, renamed or moved between two snapshots.
+    """
+    old: dict[str, tuple[str, str, str]] = _index_snapshot(old_filename)
+    new: dict[str, tuple[str, str, str]] = _index_snapshot(new_filename)
+
+    num_changes: int = 0
+    for item_id in sorted(old.keys() | new.keys()):
+        if item_id not in new:
+            kind, name, _ = old[item_id]
+            console.log(f'- {kind}="{name}" / {item_id}')
+        elif item_id not in old:
+            kind, name, _ = new[item_id]
+            console.log(f'+ {kind}="{name}" / {item_id}')
+        elif old[item_id] != new[item_id]:
+            kind, old_name, old_parent = old[item_id]
+            _, new_name, new_parent = new[item_id]
+            if old_name != new_name:
+                console.log(f'~ {kind}="{old_name}" -> "{new_name}" / {item_id}')
+            if old_parent != new_parent:
+                console.log(f'~ {kind}="{new_name}" moved from {old_parent} to {new_parent} / {item_id}')
+        else:
+            continue
+        num_changes += 1
+
+    console.log(f'{num_changes} Changes')
+
 
 if __name__ == "__main__":
 
@@ -91,7 +157,32 @@ if __name__ == "__main__":
         prog="get-orgs-and-units",
         description="Get Organisations, Units, and Products. You will need admin privileges to use this tool."
     )
-    parser.add_argument('environment', type=str, help='The environment name')
+    parser.add_argument('environment', type=str, nargs='?', help='The environment name')
+    parser.add_argument('--workers', type=int, help='The number of concurrent requests', default=1)
+    parser.add_argument('--snapshot', type=str, help='A file to write the hierarchy to (as JSON)')
+    parser.add_argument(
+        '--diff',
+        nargs=2,
+        metavar=('OLD', 'NEW'),
+        help='Compare two snapshots (no environment is needed)',
+    )
+    parser.add_argument(
+        '--metrics',
+        help='Print a summary of the API calls made,'
+             ' or write them to this Prometheus textfile',
+        type=str,
+        nargs='?',
+        const=metrics.SUMMARY,
+    )
     args: argparse.Namespace = parser.parse_args()
+    if not args.environment and not args.diff:
+        parser.error("You must provide an environment (or use --diff)")
+    if args.workers < 1:
+        parser.error("The number of workers must be at least 1")
+
+    if args.metrics:
+        metrics.enable(args.metrics)
 
-    main(args)
+    # (one runner, its pool of workers and request pacing, for every request)
+    with ParallelRunner(environment=args.environment, workers=args.workers) as runner:
+        main(args, runner)
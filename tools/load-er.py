@@ -8,10 +8,12 @@ from typing import Any, Dict, List, Optional
 import urllib3
 
 from rich.console import Console
-from squonk2.auth import Auth
 from squonk2.dm_api import DmApi, DmApiRv
 from squonk2.environment import Environment
-import yaml
+
+from common import get_access_token, run_in_parallel, set_job_exchange_rate
+import metrics
+from rate_files import rate_filename, read_rates
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -21,47 +23,33 @@ def main(c_args: argparse.Namespace, filename: str) -> None:
 
     console = Console()
 
+    # Just read the list from the chosen file
+    # and check every rate before we talk to the server
+    rates: List[Dict[str, Any]] = list(read_rates(filename))
+    if not _rates_are_valid(console, rates):
+        sys.exit(1)
+
     _ = Environment.load()
     env: Environment = Environment(c_args.environment)
     DmApi.set_api_url(env.dm_api)
 
-    token: str = Auth.get_access_token(
-        keycloak_url=env.keycloak_url,
-        keycloak_realm=env.keycloak_realm,
-        keycloak_client_id=env.keycloak_dm_client_id,
-        username=env.admin_user,
-        password=env.admin_password,
-    )
+    token: str = get_access_token(env, client_id=env.keycloak_dm_client_id)
     if not token:
         print("Failed to get token")
         sys.exit(1)
 
-    # Just read the list from the chosen file
-    file_content: str = Path(filename).read_text(encoding='utf8')
-    rates: List[Dict[str, Any]] = yaml.load(file_content, Loader=yaml.FullLoader)
-    # Load the rates one at a time (to handle any errors gracefully)
+    # Load the rates using a pool of workers
+    # (each rate is loaded individually to handle any errors gracefully)
+    er_rvs: List[DmApiRv] = run_in_parallel(
+        set_job_exchange_rate,
+        [(token, rate) for rate in rates],
+        environment=c_args.environment,
+        workers=c_args.workers,
+        max_rps=c_args.max_rps,
+    )
     num_rates: int = 0
     num_rates_failed: int = 0
-    for rate in rates:
-        # A rate must have a collection, job and version
-        collection: str = rate.get('collection')
-        if not collection:
-            console.log(':boom: File has a rate without a collection')
-            sys.exit(1)
-        job: str = rate.get('job')
-        if not job:
-            console.log(':boom:  File has a rate without a job')
-            sys.exit(1)
-        version: str = rate.get('version')
-        if not version:
-            console.log(':boom: File has a rate without a version')
-            sys.exit(1)
-        rate_value: str = rate.get('rate')
-        if not rate_value:
-            console.log(':boom: File has a rate without a rate value')
-            sys.exit(1)
-        # Now try and set the rate...
-        er_rv: DmApiRv = DmApi.set_job_exchange_rates(token, rates=rate)
+    for rate, er_rv in zip(rates, er_rvs):
         if er_rv.success:
             num_rates += 1
             emoji = ':white_check_mark:'
@@ -69,8 +57,8 @@ def main(c_args: argparse.Namespace, filename: str) -> None:
             num_rates_failed += 1
             emoji = ':cross_mark:'
         # Log
-        console.log(f'{emoji} {collection}/{job}/{version}'
-                    f' :moneybag:[gold3]{rate_value}[/gold3]')
+        console.log(f'{emoji} {rate["collection"]}/{rate["job"]}/{rate["version"]}'
+                    f' :moneybag:[gold3]{rate["rate"]}[/gold3]')
 
     # Now report all the Jobs that still have no rates
     er_rv: DmApiRv = DmApi.get_job_exchange_rates(token, only_undefined=True)
@@ -98,23 +86,51 @@ def main(c_args: argparse.Namespace, filename: str) -> None:
         sys.exit(1)
 
 
+def _rates_are_valid(console: Console, rates: List[Dict[str, Any]]) -> bool:
+    """Checks that every rate has a collection, job, version and rate value,
+    logging every problem found.
+    """
+    valid: bool = True
+    for index, rate in enumerate(rates or [], 1):
+        # A rate must have a collection, job and version
+        for key in ('collection', 'job', 'version', 'rate'):
+            if not isinstance(rate, dict) or not rate.get(key):
+                console.log(f':boom: File has a rate (#{index}) without a {key}')
+                valid = False
+    if not rates:
+        console.log(':boom: File has no rates')
+        valid = False
+    return valid
+
+
 if __name__ == "__main__":
 
     # Parse command line arguments
     parser = argparse.ArgumentParser(
         prog="load-er",
-        description="Loads exchange rates (from a YAML file)"
+        description="Loads exchange rates (from a YAML or JSONL file)"
     )
     parser.add_argument('environment', type=str, help='The environment name')
-    parser.add_argument('file', type=str, help='The source file')
+    parser.add_argument('file', type=str, help='The source file (.yaml, .yml or .jsonl, the default is .yaml)')
+    parser.add_argument('--workers', type=int, help='The number of concurrent rate requests', default=1)
+    parser.add_argument('--max-rps', type=float,
+                        help='The most rate requests to start each second (the default is no limit)')
+    parser.add_argument('--metrics', type=str, nargs='?', const=metrics.SUMMARY,
+                        help='Print a summary of the API calls made,'
+                             ' or write them to this Prometheus textfile')
     args: argparse.Namespace = parser.parse_args()
+    if args.workers < 1:
+        parser.error("The number of workers must be at least 1")
+    if args.max_rps is not None and args.max_rps <= 0:
+        parser.error("The maximum requests per second must be greater than zero")
 
-    filename: str = args.file
-    if not filename.endswith('.yaml'):
-        filename += '.yaml'
+    filename: str = rate_filename(args.file)
 
     # File must exist
     if not Path(filename).is_file():
         parser.error(f"File '{filename}' does not exist")
 
+    if args.metrics:
+        metrics.enable(args.metrics)
+
     main(args, filename)
@@ -2,21 +2,40 @@
 """Loads Job Manifests using a YAML file to define their origin.
 The file is simply a list of manifests that have a `url`, optional `header`,
 and `params` (both of which are expected to be JSON strings of keys and values).
+
+The manifests that are successfully put are recorded (in ~/.squonk2/manifests)
+and are skipped on later runs unless they change, or were put more than
+--max-age hours ago (or --force is used). Only the url, header and params
+are recorded, not the content the DM fetches from the url, so the age
+ensures a manifest whose content has changed (at the same url) is put
+again by the next (i.e. nightly) run.
 """
 import argparse
+from datetime import datetime, timedelta
+import hashlib
+import json
+import os
 from pathlib import Path
 import sys
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 import urllib3
 
 from rich.console import Console
-from squonk2.auth import Auth
 from squonk2.dm_api import DmApi, DmApiRv
 from squonk2.environment import Environment
+
+from common import get_access_token, run_in_parallel
+import metrics
 import yaml
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Where we record (for each environment) the manifests that have been put
+_STATE_FILE: str = os.environ.get("SQUONK2_MANIFEST_STATE_FILE", "~/.squonk2/manifests")
+# How long (hours) an unchanged manifest is skipped for, after it's put
+# (less than a day, so a nightly run puts every manifest again)
+_DEFAULT_MAX_AGE_H: float = 12.0
+
 
 def main(c_args: argparse.Namespace, filename: str) -> None:
     """Main function."""
@@ -27,13 +46,7 @@ def main(c_args: argparse.Namespace, filename: str) -> None:
     env: Environment = Environment(c_args.environment)
     DmApi.set_api_url(env.dm_api)
 
-    token: str = Auth.get_access_token(
-        keycloak_url=env.keycloak_url,
-        keycloak_realm=env.keycloak_realm,
-        keycloak_client_id=env.keycloak_dm_client_id,
-        username=env.admin_user,
-        password=env.admin_password,
-    )
+    token: str = get_access_token(env, client_id=env.keycloak_dm_client_id)
     if not token:
         print("Failed to get token")
         sys.exit(1)
@@ -41,36 +54,94 @@ def main(c_args: argparse.Namespace, filename: str) -> None:
     # Just read the list from the chosen file
     file_content: str = Path(filename).read_text(encoding='utf8')
     manifests: List[Dict[str, Any]] = yaml.load(file_content, Loader=yaml.FullLoader)
-    # Load the manifests one at a time (to handle any errors gracefully)
-    num_manifests: int = 0
-    num_manifests_failed: int = 0
+    # Collect the manifests by URL (a later entry replaces an earlier one)
+    url_manifests: Dict[str, Dict[str, Any]] = {}
     for manifest in manifests:
         # A manifest must have a url and optional header and params
         url: str = manifest.get('url')
         if not url:
             console.log(':boom: File has a manifest without a URL')
             sys.exit(1)
+        if url in url_manifests:
+            console.log(f':heavy_minus_sign: Duplicate {url}')
+        url_manifests[url] = manifest
+
+    # Skip the manifests that have not changed since they were (recently) put
+    state_file: Path = Path(_STATE_FILE).expanduser()
+    state: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    try:
+        state = json.loads(state_file.read_text(encoding='utf8'))
+    except (OSError, ValueError):
+        pass
+    env_state: Dict[str, Dict[str, Any]] = state.setdefault(c_args.environment, {})
+    put_after: str = str(datetime.utcnow() - timedelta(hours=c_args.max_age))
+    put_requests: List[Tuple[str, str, str, str]] = []
+    for url, manifest in url_manifests.items():
         header: str = manifest.get('header')
         params: str = manifest.get('params')
-        # Now try and set the rate...
-        jm_rv: DmApiRv = DmApi.put_job_manifest(token, url=url, header=header, params=params)
+        url_state: Dict[str, Any] = env_state.get(url, {})
+        if not c_args.force \
+                and url_state.get('hash') == _manifest_hash(url, header, params) \
+                and url_state.get('put', '') > put_after:
+            console.log(f':white_circle: {url} (unchanged)')
+            continue
+        put_requests.append((token, url, header, params))
+
+    # Put the changed manifests using a pool of workers
+    # (each manifest is put individually to handle any errors gracefully)
+    jm_rvs: List[DmApiRv] = run_in_parallel(
+        _put_manifest,
+        put_requests,
+        environment=c_args.environment,
+        workers=c_args.workers,
+        max_rps=c_args.max_rps,
+    )
+    num_manifests: int = 0
+    num_manifests_failed: int = 0
+    for (_, url, header, params), jm_rv in zip(put_requests, jm_rvs):
         if jm_rv.success:
             num_manifests += 1
             emoji = ':white_check_mark:'
+            env_state[url] = {'hash': _manifest_hash(url, header, params),
+                              'put': str(datetime.utcnow())}
         else:
             num_manifests_failed += 1
             emoji = ':cross_mark:'
+            env_state.pop(url, None)
         # Log
         console.log(f'{emoji} {url}')
 
+    # The file is written and then moved into place
+    state_file.parent.mkdir(parents=True, exist_ok=True)
+    new_state_file: Path = state_file.with_name(f"{state_file.name}.{os.getpid()}")
+    new_state_file.write_text(json.dumps(state, indent=2), encoding='utf8')
+    os.replace(new_state_file, state_file)
+
     # Summary
     if num_manifests:
         console.log(f'Job manifests loaded {num_manifests}')
+    num_manifests_unchanged: int = len(url_manifests) - len(put_requests)
+    if num_manifests_unchanged:
+        console.log(f'Job manifests unchanged {num_manifests_unchanged}')
     # Error states
     if num_manifests_failed:
         console.log(f'Job manifest failures {num_manifests_failed}')
 
 
+def _manifest_hash(url: str, header: Optional[str], params: Optional[str]) -> str:
+    """A hash of a manifest's content."""
+    content: str = json.dumps([url, header, params])
+    return hashlib.sha256(content.encode('utf8')).hexdigest()
+
+
+def _put_manifest(request: Tuple[str, str, Optional[str], Optional[str]]) -> DmApiRv:
+    """Puts the manifest of a (token, url, header, params) request
+    (run_in_parallel() retries transient failures).
+    """
+    token, url, header, params = request
+    return DmApi.put_job_manifest(token, url=url, header=header, params=params)
+
+
 if __name__ == "__main__":
 
     # Parse command line arguments
@@ -80,7 +151,36 @@ if __name__ == "__main__":
     )
     parser.add_argument('environment', type=str, help='The environment name')
     parser.add_argument('file', type=str, help='The source file')
+    parser.add_argument('--workers', type=int, help='The number of concurrent manifest requests', default=1)
+    parser.add_argument('--max-rps', type=float,
+                        help='The most manifest requests to start each second (the default is no limit)')
+    parser.add_argument(
+        '--force',
+        help='Set to put every manifest, even those that have not changed',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--max-age',
+        help='Put unchanged manifests again if they were put more than this many hours ago'
+             f' (the default, {_DEFAULT_MAX_AGE_H:g}, puts every manifest on a nightly run)',
+        type=float,
+        default=_DEFAULT_MAX_AGE_H,
+    )
+    parser.add_argument(
+        '--metrics',
+        help='Print a summary of the API calls made,'
+             ' or write them to this Prometheus textfile',
+        type=str,
+        nargs='?',
+        const=metrics.SUMMARY,
+    )
     args: argparse.Namespace = parser.parse_args()
+    if args.workers < 1:
+        parser.error("The number of workers must be at least 1")
+    if args.max_rps is not None and args.max_rps <= 0:
+        parser.error("The maximum requests per second must be greater than zero")
+    if args.max_age < 0:
+        parser.error("The maximum age cannot be less than zero")
 
     filename: str = args.file
     if not filename.endswith('.yaml'):
@@ -90,4 +190,7 @@ if __name__ == "__main__":
     if not Path(filename).is_file():
         parser.error(f"File '{filename}' does not exist")
 
+    if args.metrics:
+        metrics.enable(args.metrics)
+
     main(args, filename)
@@ -0,0 +1,209 @@
+"""Records the Squonk2 client calls (AsApi, DmApi and Auth) a tool makes.
+
+Tools enable it with their '--metrics' option, which replaces the client's
+methods with ones that record the number of calls, failed calls and latency
+of each endpoint. When the tool exits the metrics are either printed
+(as a summary table) or written to a Prometheus textfile
+(which can be collected by the node-exporter textfile collector).
+Tools run by a squonk2-tools script report (see report()) as each step ends.
+"""
+import atexit
+import functools
+import math
+import os
+from pathlib import Path
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# The '--metrics' value that prints a summary (rather than writing a file)
+SUMMARY: str = "-"
+
+# Client methods that do not make a request
+_UNTIMED: Tuple[str, ...] = ("set_api_url", "get_api_url")
+
+# The latency quantiles that are reported
+_QUANTILES: Tuple[float, ...] = (0.5, 0.95)
+
+_PROMETHEUS_PREFIX: str = "squonk2_tools_api"
+
+# The latency (seconds) of every call, and the number of failed calls,
+# indexed by endpoint (i.e. "AsApi.get_units")
+_LATENCIES: Dict[str, List[float]] = {}
+_ERRORS: Dict[str, int] = {}
+_RECORDING: bool = False
+# Where (and for which tool) the calls are reported, see enable()
+_DESTINATION: Optional[str] = None
+_TOOL: str = ""
+_REPORT_AT_EXIT: bool = False
+
+
+def enable(destination: str) -> None:
+    """Records the client calls made from now on and reports them when the
+    tool exits, printing a summary if the destination is SUMMARY
+    or otherwise writing a Prometheus textfile. It can be called again
+    (by the next tool in a squonk2-tools script) to change the destination.
+    """
+    global _DESTINATION, _TOOL, _REPORT_AT_EXIT
+    record()
+    _DESTINATION = destination
+    _TOOL = Path(sys.argv[0]).stem
+    if not _REPORT_AT_EXIT:
+        atexit.register(report)
+        _REPORT_AT_EXIT = True
+
+
+def record() -> None:
+    """Records the client calls made from now on (without reporting them).
+    Used by worker processes, whose calls are returned to the tool's process.
+    """
+    global _RECORDING
+    if _RECORDING:
+        return
+    _RECORDING = True
+    # (every tool imports this module, so the slow client and rich imports
+    # are left until they're needed)
+    # pylint: disable=import-outside-toplevel
+    from squonk2.auth import Auth
+    from squonk2.as_api import AsApi
+    from squonk2.dm_api import DmApi
+
+    for cls in (AsApi, DmApi, Auth):
+        for name, attr in list(vars(cls).items()):
+            if name.startswith("_") or name in _UNTIMED or not isinstance(attr, classmethod):
+                continue
+            setattr(cls, name, staticmethod(_timed(f"{cls.__name__}.{name}", getattr(cls, name))))
+
+
+def is_enabled() -> bool:
+    """True if the client calls are being recorded."""
+    return _RECORDING
+
+
+def report() -> None:
+    """Reports (and forgets) the calls recorded, if enable() has been called
+    since they were last reported. Called when the tool exits,
+    or when each step of a squonk2-tools script ends.
+    """
+    global _DESTINATION
+    destination: Optional[str] = _DESTINATION
+    _DESTINATION = None
+    if destination == SUMMARY:
+        _print_summary()
+    elif destination:
+        _write_textfile(destination, _TOOL)
+    _ = take()
+
+
+def take() -> Dict[str, Tuple[List[float], int]]:
+    """Returns (and forgets) the (latencies, errors) recorded for each endpoint.
+    Used to return the calls made by a worker process to the tool's process.
+    """
+    taken: Dict[str, Tuple[List[float], int]] = {
+        endpoint: (latencies, _ERRORS.get(endpoint, 0)) for endpoint, latencies in _LATENCIES.items()
+    }
+    _LATENCIES.clear()
+    _ERRORS.clear()
+    return taken
+
+
+def merge(taken: Dict[str, Tuple[List[float], int]]) -> None:
+    """Adds metrics returned by take() (in another process) to this process's."""
+    for endpoint, (latencies, errors) in taken.items():
+        _LATENCIES.setdefault(endpoint, []).extend(latencies)
+        _ERRORS[endpoint] = _ERRORS.get(endpoint, 0) + errors
+
+
+def _timed(endpoint: str, method: Callable[..., Any]) -> Callable[..., Any]:
+    """Wraps a client method so its calls are recorded.
+    Calls fail if they return None (Auth) or an unsuccessful AsApiRv/DmApiRv.
+    """
+    @functools.wraps(method)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        failed: bool = True
+        start: float = time.perf_counter()
+        try:
+            rv: Any = method(*args, **kwargs)
+            failed = rv is None or not getattr(rv, "success", True)
+            return rv
+        finally:
+            _LATENCIES.setdefault(endpoint, []).append(time.perf_counter() - start)
+            if failed:
+                _ERRORS[endpoint] = _ERRORS.get(endpoint, 0) + 1
+    return wrapper
+
+
+def _quantile(latencies: List[float], quantile: float) -> float:
+    """The (nearest-rank) quantile of a sorted list of latencies."""
+    return latencies[max(0, math.ceil(quantile * len(latencies)) - 1)]
+
+
+def _print_summary() -> None:
+    # pylint: disable=import-outside-toplevel
+    from rich.console import Console
+    from rich.table import Table
+
+    table: Table = Table(title="API calls")
+    table.add_column("Endpoint", overflow="fold")
+    for column in ("Calls", "Errors", "p50 (ms)", "p95 (ms)", "Max (ms)", "Total (s)"):
+        table.add_column(column, justify="right")
+    for endpoint in sorted(_LATENCIES):
+        latencies: List[float] = sorted(_LATENCIES[endpoint])
+        table.add_row(
+            endpoint,
+            str(len(latencies)),
+            str(_ERRORS.get(endpoint, 0)),
+            *[f"{_quantile(latencies, quantile) * 1000:.1f}" for quantile in _QUANTILES],
+            f"{latencies[-1] * 1000:.1f}",
+            f"{sum(latencies):.2f}",
+        )
+    # (to stderr, so it doesn't mix with output that's written to stdout)
+    Console(stderr=True).print(table)
+
+
+def _write_textfile(filename: str, tool: str) -> None:
+    """Writes the metrics in the Prometheus text format. The file is replaced
+    (rather than re-written) so the collector never sees a partial file.
+    """
+    lines: List[str] = [
+        f"# HELP {_PROMETHEUS_PREFIX}_calls_total The number of API calls made.",
+        f"# TYPE {_PROMETHEUS_PREFIX}_calls_total counter",
+    ]
+    labels: Dict[str, str] = {
+        endpoint: f'tool="{tool}",endpoint="{endpoint}"' for endpoint in sorted(_LATENCIES)
+    }
+    for endpoint, label in labels.items():
+        lines.append(f"{_PROMETHEUS_PREFIX}_calls_total{{{label}}} {len(_LATENCIES[endpoint])}")
+    lines.extend([
+        f"# HELP {_PROMETHEUS_PREFIX}_errors_total The number of API calls that failed.",
+        f"# TYPE {_PROMETHEUS_PREFIX}_errors_total counter",
+    ])
+    for endpoint, label in labels.items():
+        lines.append(f"{_PROMETHEUS_PREFIX}_errors_total{{{label}}} {_ERRORS.get(endpoint, 0)}")
+    lines.extend([
+        f"# HELP {_PROMETHEUS_PREFIX}_latency_seconds The latency of API calls.",
+        f"# TYPE {_PROMETHEUS_PREFIX}_latency_seconds summary",
+    ])
+    for endpoint, label in labels.items():
+        latencies: List[float] = sorted(_LATENCIES[endpoint])
+        for quantile in _QUANTILES:
+            lines.append(f'{_PROMETHEUS_PREFIX}_latency_seconds{{{label},quantile="{quantile}"}}'
+                         f' {_quantile(latencies, quantile):.6f}')
+        lines.append(f"{_PROMETHEUS_PREFIX}_latency_seconds_sum{{{label}}} {sum(latencies):.6f}")
+        lines.append(f"{_PROMETHEUS_PREFIX}_latency_seconds_count{{{label}}} {len(latencies)}")
+    lines.extend([
+        f"# HELP {_PROMETHEUS_PREFIX}_latency_max_seconds The latency of the slowest API call.",
+        f"# TYPE {_PROMETHEUS_PREFIX}_latency_max_seconds gauge",
+    ])
+    for endpoint, label in labels.items():
+        lines.append(f"{_PROMETHEUS_PREFIX}_latency_max_seconds{{{label}}} {max(_LATENCIES[endpoint]):.6f}")
+    lines.extend([
+        "# HELP squonk2_tools_last_run_timestamp_seconds When the tool last finished.",
+        "# TYPE squonk2_tools_last_run_timestamp_seconds gauge",
+        f'squonk2_tools_last_run_timestamp_seconds{{tool="{tool}"}} {time.time():.0f}',
+    ])
+
+    path: Path = Path(filename).expanduser()
+    tmp_path: Path = path.with_name(f".{path.name}.{os.getpid()}")
+    tmp_path.write_text("\n".join(lines) + "\n", encoding="utf8")
+    os.replace(tmp_path, path)
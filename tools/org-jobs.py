@@ -3,20 +3,38 @@
 The results are presented as a on ordered list of job (collection,
 job and version) with the number of times the job was run and the
 earliest and latest dates the Job was executed.
+
+Each Product's billing periods are searched from the current one back to
+the period the Product was created in (or '--max-pbp'). The creation date is
+taken from the Product's 'created' field, if the AS gives it one, otherwise
+its periods are searched back to '--max-pbp'. The search can optionally stop
+early, after a run of periods without any Job charges (see
+'--max-empty-periods'), and the Products it stopped early for are reported,
+as their older charges are not counted. The number of charge requests that
+were avoided is reported too (on stderr).
+
+The charges can also be grouped by any combination of job, user, unit,
+product and month (i.e. '--group-by job,user'), and '--group-by' can be
+repeated to present several groupings of the same charges.
 """
 import argparse
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import date, datetime, timezone
 from decimal import Decimal
+import sqlite3
 import sys
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 import urllib3
 
 from rich.console import Console
-from squonk2.auth import Auth
 from squonk2.as_api import AsApi, AsApiRv
 from squonk2.environment import Environment
 
+from charge_table import GROUP_KEYS, ChargeTable, GroupStats
+from common import ChargeCache, ParallelRunner, get_access_token
+import metrics
+import warehouse
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
@@ -35,60 +53,191 @@ class JobStats:
 def main(c_args: argparse.Namespace) -> None:
     """Main function."""
 
+    # The charges for each Product (for each possible billing period),
+    # from the local database or the AS
+    if c_args.from_db:
+        c_rvs: List[Tuple[str, str, AsApiRv]] = _get_db_charges(c_args)
+    else:
+        # (one runner, its pool of workers and request pacing, for every request)
+        with ParallelRunner(environment=c_args.environment, workers=c_args.workers) as runner:
+            c_rvs = _get_api_charges(c_args, runner)
+
+    # All the Job charges (decoded once), which are then grouped
+    charge_table: ChargeTable = ChargeTable()
+    for unit_name, product_name, c_rv in c_rvs:
+        charge_table.add_charges(c_rv.msg, unit=unit_name, product=product_name)
+
+    for group_by in c_args.group_by or [["job"]]:
+        if len(c_args.group_by or []) > 1:
+            print(f'# By {", ".join(group_by)}')
+        org_jobs: Dict[str, JobStats] = {}
+        for group in charge_table.group_by(*group_by):
+            org_jobs['|'.join(group.key)] = _job_stats(group)
+        for job in sorted(org_jobs):
+            print(f'{job}: ({org_jobs[job]})')
+
+
+def _job_stats(group: GroupStats) -> JobStats:
+    """The JobStats (for presentation) of a group of charges."""
+    return JobStats(count=group.count, coins=group.coins, earliest=group.earliest, latest=group.latest)
+
+
+def _group_by(value: str) -> List[str]:
+    """Parses a (comma-separated) '--group-by' value."""
+    keys: List[str] = [key.strip() for key in value.split(',')]
+    for key in keys:
+        if key not in GROUP_KEYS:
+            raise argparse.ArgumentTypeError(f"'{key}' is not one of {', '.join(GROUP_KEYS)}")
+    return keys
+
+
+def _get_api_charges(c_args: argparse.Namespace, runner: ParallelRunner) -> List[Tuple[str, str, AsApiRv]]:
+    """Gets the charges for each billing period of each of the Organisation's
+    Products from the AS (or the charge cache), with the name of the Unit
+    and Product they're for.
+    """
     console = Console()
 
     _ = Environment.load()
     env: Environment = Environment(c_args.environment)
     AsApi.set_api_url(env.as_api)
 
-    token: str = Auth.get_access_token(
-        keycloak_url=env.keycloak_url,
-        keycloak_realm=env.keycloak_realm,
-        keycloak_client_id=env.keycloak_as_client_id,
-        username=env.admin_user,
-        password=env.admin_password,
-    )
-
-    # A set of all the collected Jobs...
-    org_jobs: Dict[str, JobStats] = {}
+    token: str = get_access_token(env, client_id=env.keycloak_as_client_id)
 
     # First, we start with all the Units in an Organisation
-    u_rv: AsApiRv = AsApi.get_units(token, org_id=args.org)
+    u_rv: AsApiRv = AsApi.get_units(token, org_id=c_args.org)
     if not u_rv.success:
         console.log(u_rv.msg)
-        console.log(f"[bold red]ERROR[/bold red] Failed to get [blue]{args.org}[/blue]")
+        console.log(f"[bold red]ERROR[/bold red] Failed to get [blue]{c_args.org}[/blue]")
         sys.exit(1)
     # Then we get all the Products for each Unit
-    for unit in u_rv.msg["units"]:
-        p_rv: AsApiRv = AsApi.get_products_for_unit(token, unit_id=unit['id'])
-        # And then we get the charges for each Product (for each possible billing period)
+    # and then the charges for each Product (for each possible billing period).
+    # The requests are made by a pool of workers, with the results returned
+    # in request order so the Job statistics match those of a sequential run.
+    p_rvs: List[AsApiRv] = runner.run(_get_products_for_unit, [(token, unit['id']) for unit in u_rv.msg["units"]])
+    # The Products (and their Unit), and the earliest billing period
+    # each Product can have charges in (the one it was created in)
+    today: date = datetime.now(timezone.utc).date()
+    products: List[Tuple[str, str, str]] = []
+    earliest_pbps: List[int] = []
+    num_not_dated: int = 0
+    for unit, p_rv in zip(u_rv.msg["units"], p_rvs):
         for product in p_rv.msg["products"]:
-            for pbp in range(0, args.max_pbp - 1, -1):
-                c_rv: AsApiRv = AsApi.get_product_charges(token, product_id=product['product']['id'], pbp=pbp)
-                # iterate through the 'processing_charges' list
-                # to print the collection, Job and Version
-                if "processing_charges" in c_rv.msg:
-                    for processing_charge in c_rv.msg["processing_charges"]:
-                        if "additional_data" in processing_charge["charge"]:
-                            coins: Decimal = Decimal(processing_charge["charge"]["coins"])
-                            timestamp: datetime = datetime.fromisoformat(processing_charge["charge"]["timestamp"])
-                            ad: Dict[str, Any] = processing_charge["charge"]["additional_data"]
-                            if "job_collection" in ad:
-                                job_str: str = f'{ad["job_collection"]}|{ad["job_job"]}|{ad["job_version"]}'
-                                if job_str in org_jobs:
-                                    job_stats = org_jobs[job_str]
-                                    job_stats.count += 1
-                                    job_stats.coins += coins
-                                    if timestamp < job_stats.earliest:
-                                        job_stats.earliest = timestamp
-                                    elif timestamp > job_stats.latest:
-                                        job_stats.latest = timestamp
-                                    org_jobs[job_str] = job_stats
-                                else:
-                                    org_jobs[job_str] = JobStats(count=1, coins=coins, earliest=timestamp, latest=timestamp)
-    jobs: List[str] = org_jobs.keys()
-    for job in sorted(jobs):
-        print(f'{job}: ({org_jobs[job]})')
+            products.append((unit['name'], product['product']['name'], product['product']['id']))
+            earliest_pbp: Optional[int] = _get_earliest_pbp(product, today)
+            if earliest_pbp is None:
+                # (without a creation date every period, back to --max-pbp, is searched)
+                num_not_dated += 1
+            earliest_pbps.append(c_args.max_pbp if earliest_pbp is None else max(earliest_pbp, c_args.max_pbp))
+
+    # Walk back through the billing periods of every Product (a period at a time),
+    # until we reach the earliest period or (if asked) a run of periods without any Job charges.
+    # Charges for prior billing periods are taken from the cache (if present)
+    # so we only need to ask for the ones we don't have, caching them as we go.
+    cache: Optional[ChargeCache] = None if c_args.no_cache else ChargeCache(c_args.environment)
+    c_rvs: List[Tuple[str, str, AsApiRv]] = []
+    num_empty: List[int] = [0] * len(products)
+    walking: List[int] = list(range(len(products)))
+    # The Products we stopped walking before their earliest period (and the period)
+    stopped_early: List[Tuple[int, int]] = []
+    num_requests: int = 0
+    num_cached: int = 0
+    pbp: int = 0
+    while walking:
+        period_rvs: Dict[int, AsApiRv] = {}
+        charge_requests: List[Tuple[str, str, int]] = []
+        for index in walking:
+            charges: Optional[Dict[str, Any]] = cache.get(products[index][2], pbp) if cache else None
+            if charges is None:
+                charge_requests.append((token, products[index][2], pbp))
+            else:
+                period_rvs[index] = AsApiRv(success=True, msg=charges)
+        num_cached += len(period_rvs)
+        num_requests += len(charge_requests)
+        requested_c_rvs: List[AsApiRv] = runner.run(_get_product_charges, charge_requests)
+        requested_indices: List[int] = [index for index in walking if index not in period_rvs]
+        for index, c_rv in zip(requested_indices, requested_c_rvs):
+            if cache and c_rv.success:
+                cache.put(products[index][2], pbp, c_rv.msg)
+            period_rvs[index] = c_rv
+
+        still_walking: List[int] = []
+        for index in walking:
+            c_rv = period_rvs[index]
+            c_rvs.append((products[index][0], products[index][1], c_rv))
+            num_empty[index] = num_empty[index] + 1 if c_rv.success and not c_rv.msg.get("processing_charges") else 0
+            if pbp <= earliest_pbps[index]:
+                continue
+            if 0 < c_args.max_empty_periods <= num_empty[index]:
+                stopped_early.append((index, pbp))
+            else:
+                still_walking.append(index)
+        walking = still_walking
+        pbp -= 1
+
+    # Report the requests we did not need to make, and the Products
+    # whose older periods were not searched (and so whose older charges are missing)
+    # (on stderr, so it's not mixed with the Job statistics)
+    num_possible: int = len(products) * (1 - c_args.max_pbp)
+    num_not_created: int = sum(earliest_pbp - c_args.max_pbp for earliest_pbp in earliest_pbps)
+    err_console: Console = Console(stderr=True)
+    err_console.log(
+        f"Charge requests {num_requests} (of {num_possible}), {num_cached} from the cache,"
+        f" {num_possible - num_requests - num_cached} avoided ({num_not_created} for periods"
+        f" before Products were created, {num_not_dated} Products without a creation date)")
+    for index, stopped_pbp in stopped_early:
+        err_console.log(
+            f"[bold yellow]WARNING[/bold yellow] Stopped searching [blue]{products[index][0]}[/blue]"
+            f" Product [blue]{products[index][1]}[/blue] after {c_args.max_empty_periods} empty periods,"
+            f" periods {stopped_pbp - 1} to {earliest_pbps[index]} were not searched")
+
+    return c_rvs
+
+
+def _get_earliest_pbp(product: Dict[str, Any], today: date) -> Optional[int]:
+    """Returns the prior billing period a Product was created in (the earliest
+    period it can have charges in), using its creation date and billing day.
+    None is returned if they're not known (the AS client does not describe
+    the Product's fields, so 'created' is only used if the AS gives it).
+    """
+    try:
+        created: date = datetime.fromisoformat(product['product']['created']).date()
+        billing_day: int = int(product['coins']['billing_day'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    # Billing periods start on the billing day (of each month),
+    # so count the months, less one if the billing day's not been reached.
+    created_period: int = created.year * 12 + created.month - (1 if created.day < billing_day else 0)
+    today_period: int = today.year * 12 + today.month - (1 if today.day < billing_day else 0)
+    return min(0, created_period - today_period)
+
+
+def _get_db_charges(c_args: argparse.Namespace) -> List[Tuple[str, str, AsApiRv]]:
+    """Gets the charges for each billing period of each of the Organisation's
+    Products from the local database (see sync-charges), with the name of the
+    Unit and Product they're for.
+    """
+    conn: sqlite3.Connection = warehouse.connect(c_args.from_db)
+    c_rvs: List[Tuple[str, str, AsApiRv]] = []
+    for product_id, product_name, unit_name in warehouse.get_organisation_products(conn, c_args.org):
+        for pbp in range(0, c_args.max_pbp - 1, -1):
+            charges: Optional[Dict[str, Any]] = warehouse.get_product_charges(conn, product_id, pbp)
+            if charges is not None:
+                c_rvs.append((unit_name, product_name, AsApiRv(success=True, msg=charges)))
+    conn.close()
+    return c_rvs
+
+
+def _get_products_for_unit(request: Tuple[str, str]) -> AsApiRv:
+    """Gets the Products for a (token, unit ID) request."""
+    token, unit_id = request
+    return AsApi.get_products_for_unit(token, unit_id=unit_id)
+
+
+def _get_product_charges(request: Tuple[str, str, int]) -> AsApiRv:
+    """Gets the charges for a (token, product ID, prior billing period) request."""
+    token, product_id, pbp = request
+    return AsApi.get_product_charges(token, product_id=product_id, pbp=pbp)
 
 
 if __name__ == "__main__":
@@ -101,10 +250,32 @@ if __name__ == "__main__":
     parser.add_argument('environment', type=str, help='The environment name')
     parser.add_argument('org', type=str, help='The Organisation UUID')
     parser.add_argument('--max-pbp', type=int, help='The maximum Prior Billing Period to search', default=-23)
+    parser.add_argument('--max-empty-periods', type=int, default=0,
+                        help='Stop searching a Product after this many consecutive billing periods'
+                             ' without Job charges (the Products that are stopped early are reported).'
+                             ' The default, 0, searches every period')
+    parser.add_argument('--workers', type=int, help='The number of concurrent requests', default=1)
+    parser.add_argument('--no-cache', action='store_true', help='Set to ignore cached prior billing period charges')
+    parser.add_argument('--from-db', type=str, nargs='?', const=warehouse.DEFAULT_DATABASE,
+                        help='Use charges from a local database (see sync-charges), rather than the AS')
+    parser.add_argument('--group-by', type=_group_by, action='append',
+                        help='Group the charges by a comma-separated combination of'
+                             f' {", ".join(GROUP_KEYS)} (the default is job).'
+                             ' Repeat to present more than one grouping')
+    parser.add_argument('--metrics', type=str, nargs='?', const=metrics.SUMMARY,
+                        help='Print a summary of the API calls made,'
+                             ' or write them to this Prometheus textfile')
     args: argparse.Namespace = parser.parse_args()
     if args.max_pbp > 0:
         parser.error("The maximum Prior Billing Period cannot be greater than zero")
     elif args.max_pbp < -23:
         parser.error("The earliest Prior Billing Period cannot be less than -23")
+    if args.max_empty_periods < 0:
+        parser.error("The maximum number of empty periods cannot be less than zero")
+    if args.workers < 1:
+        parser.error("The number of workers must be at least 1")
+
+    if args.metrics:
+        metrics.enable(args.metrics)
 
     main(args)
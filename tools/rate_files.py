@@ -0,0 +1,104 @@
+"""Reading and writing Job Exchange Rate files.
+
+The file format is chosen from the file's extension: -
+
+- '.yaml' (or '.yml') files contain a YAML list of rates
+- '.jsonl' files contain one JSON rate per line
+
+Each format has a reader (yielding rates) and a writer (consuming an
+iterable of rates). JSONL files are read and written one rate at a time.
+YAML uses the libyaml-backed (C) safe loader and dumper when they are available.
+"""
+import json
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+import yaml
+
+# Use the fast (libyaml) safe loader and dumper if we can
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# The number of rates written to a YAML file with each call to the dumper
+_YAML_DUMP_BATCH_SIZE: int = 1000
+
+# The extension used when a rate file has no (recognised) extension
+DEFAULT_RATE_FILE_EXTENSION: str = '.yaml'
+
+Rate = Dict[str, Any]
+
+
+def _read_yaml(filename: str) -> Iterator[Rate]:
+    with open(filename, 'rt', encoding='utf8') as rate_file:
+        yield from yaml.load(rate_file, Loader=_YAML_LOADER) or []
+
+
+def _write_yaml(filename: str, rates: Iterable[Rate], header: List[str]) -> int:
+    num_rates: int = 0
+    with open(filename, 'wt', encoding='utf8') as rate_file:
+        rate_file.write("---\n")
+        for line in header:
+            rate_file.write(f"# {line}\n")
+        rate_file.write("\n")
+        batch: List[Rate] = []
+        for rate in rates:
+            batch.append(rate)
+            if len(batch) == _YAML_DUMP_BATCH_SIZE:
+                yaml.dump(batch, rate_file, Dumper=_YAML_DUMPER, default_flow_style=False)
+                num_rates += len(batch)
+                batch = []
+        if batch or not num_rates:
+            yaml.dump(batch, rate_file, Dumper=_YAML_DUMPER, default_flow_style=False)
+            num_rates += len(batch)
+    return num_rates
+
+
+def _read_jsonl(filename: str) -> Iterator[Rate]:
+    with open(filename, 'rt', encoding='utf8') as rate_file:
+        for line in rate_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _write_jsonl(filename: str, rates: Iterable[Rate], header: List[str]) -> int:
+    # JSONL has no comments, so there's nowhere to put the header
+    del header
+    num_rates: int = 0
+    with open(filename, 'wt', encoding='utf8') as rate_file:
+        for rate in rates:
+            rate_file.write(json.dumps(rate))
+            rate_file.write("\n")
+            num_rates += 1
+    return num_rates
+
+
+# The reader and writer for each rate file extension
+_FORMATS: Dict[str, Tuple[Callable[[str], Iterator[Rate]],
+                          Callable[[str, Iterable[Rate], List[str]], int]]] = {
+    '.yaml': (_read_yaml, _write_yaml),
+    '.yml': (_read_yaml, _write_yaml),
+    '.jsonl': (_read_jsonl, _write_jsonl),
+}
+
+
+def rate_filename(filename: str) -> str:
+    """Returns the filename, adding the default extension
+    if it does not have a recognised one.
+    """
+    if Path(filename).suffix in _FORMATS:
+        return filename
+    return filename + DEFAULT_RATE_FILE_EXTENSION
+
+
+def read_rates(filename: str) -> Iterator[Rate]:
+    """Yields the rates in a rate file."""
+    reader, _ = _FORMATS[Path(filename).suffix]
+    return reader(filename)
+
+
+def write_rates(filename: str, rates: Iterable[Rate], *, header: List[str]) -> int:
+    """Writes rates to a rate file, returning the number written.
+    The header lines are written as comments (if the format permits).
+    """
+    _, writer = _FORMATS[Path(filename).suffix]
+    return writer(filename, rates, header)
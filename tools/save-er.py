@@ -3,15 +3,17 @@
 """
 from datetime import datetime
 import argparse
-from pathlib import Path
 import sys
+from typing import List
 import urllib3
 
 from rich.console import Console
-from squonk2.auth import Auth
 from squonk2.dm_api import DmApi, DmApiRv
 from squonk2.environment import Environment
-import yaml
+
+from common import get_access_token
+import metrics
+from rate_files import rate_filename, write_rates
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -25,13 +27,7 @@ def main(c_args: argparse.Namespace) -> None:
     env: Environment = Environment(c_args.environment)
     DmApi.set_api_url(env.dm_api)
 
-    token: str = Auth.get_access_token(
-        keycloak_url=env.keycloak_url,
-        keycloak_realm=env.keycloak_realm,
-        keycloak_client_id=env.keycloak_dm_client_id,
-        username=env.admin_user,
-        password=env.admin_password,
-    )
+    token: str = get_access_token(env, client_id=env.keycloak_dm_client_id)
     if not token:
         print("Failed to get token")
         sys.exit(1)
@@ -41,27 +37,21 @@ def main(c_args: argparse.Namespace) -> None:
         console.log(f'[bold red]ERROR[/bold red] {er_rv.msg["error"]}')
         sys.exit(1)
 
-    filename: str = c_args.file
-    if not filename.endswith('.yaml'):
-        filename += '.yaml'
+    filename: str = rate_filename(c_args.file)
 
     # Just write the list to the chosen file,
-    # with a handy header detailing the source
-    header: str = "---"
-    header += "\n# Saved Job Exchange Rates (using save-er.py)"
-    header += "\n# From Keycloak: " + env.keycloak_url
-    header += "\n#        Client: " + env.keycloak_dm_client_id
-    header += "\n#    Time (UTC): " + str(datetime.utcnow())
-    header += "\n\n"
-
-    num_rates: int = len(er_rv.msg['exchange_rates'])
+    # with a handy header detailing the source.
     # Before saving, remove the 'id' from each rate
     # - this is distracting and of no real use
+    header: List[str] = [
+        "Saved Job Exchange Rates (using save-er.py)",
+        "From Keycloak: " + env.keycloak_url,
+        "       Client: " + env.keycloak_dm_client_id,
+        "   Time (UTC): " + str(datetime.utcnow()),
+    ]
     for rate in er_rv.msg['exchange_rates']:
         del rate['id']
-
-    rates: str = yaml.dump(er_rv.msg['exchange_rates'], default_flow_style=False)
-    Path(filename).write_text(header + rates, encoding='utf8')
+    num_rates: int = write_rates(filename, er_rv.msg['exchange_rates'], header=header)
 
     if num_rates:
         console.log(f'Saved {num_rates} (to {filename})')
@@ -74,10 +64,16 @@ if __name__ == "__main__":
     # Parse command line arguments
     parser = argparse.ArgumentParser(
         prog="save-er",
-        description="Saves existing exchange rates (to a YAML file)"
+        description="Saves existing exchange rates (to a YAML or JSONL file)"
     )
     parser.add_argument('environment', type=str, help='The environment name')
-    parser.add_argument('file', type=str, help='The destination file')
+    parser.add_argument('file', type=str, help='The destination file (.yaml, .yml or .jsonl, the default is .yaml)')
+    parser.add_argument('--metrics', type=str, nargs='?', const=metrics.SUMMARY,
+                        help='Print a summary of the API calls made,'
+                             ' or write them to this Prometheus textfile')
     args: argparse.Namespace = parser.parse_args()
 
+    if args.metrics:
+        metrics.enable(args.metrics)
+
     main(args)
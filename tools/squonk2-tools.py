@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""Runs any of the tools as a sub-command, i.e. -
+
+    ./tools/squonk2-tools.py list-environments
+    ./tools/squonk2-tools.py org-jobs dls-test <org> --workers 4
+
+Run it without a sub-command (or with --help) to list the tools.
+
+Only the tool that's run is imported (along with the modules it uses),
+so this is no slower to start than running the tool itself. It's one
+script to install (or link to) and wrap (in cron jobs for example)
+rather than one for each tool.
+
+It also runs a script of tools (one after the other) in one process: -
+
+    ./tools/squonk2-tools.py --script steps.yaml
+
+A YAML script is a list of steps, each a tool (and its arguments) or a
+'parallel' list of steps that are run at the same time: -
+
+    - save-er dls-test rates.yaml
+    - parallel:
+      - load-er dls-test rates.yaml
+      - load-job-manifests dls-test manifests.yaml
+    - get-orgs-units-products dls-test
+
+Any other script is a text file with a step on each line (and '#' comments).
+Consecutive steps that end with ' &' are run at the same time, and the step
+that follows them (if it does not end with ' &') waits for them to finish.
+
+Steps share the loaded environments file, the access tokens (one for each
+environment and Keycloak client) and their connections to the AS and DM.
+Parallel steps are run in (forked) processes of their own. The script stops
+at the first step that fails.
+"""
+from pathlib import Path
+import runpy
+import shlex
+import sys
+import time
+from typing import Any, Dict, List
+
+# The tools are the scripts (the modules with a '#!' line) alongside this one
+_TOOLS_DIRECTORY: Path = Path(__file__).resolve().parent
+_TOOLS: Dict[str, Path] = {}
+for _path in sorted(_TOOLS_DIRECTORY.glob("*.py")):
+    if _path.stem != Path(__file__).stem:
+        with open(_path, "rb") as _script:
+            if _script.read(2) == b"#!":
+                _TOOLS[_path.stem] = _path
+
+
+def _summary(path: Path) -> str:
+    """The first line of a tool's docstring (found without importing it)."""
+    # pylint: disable=import-outside-toplevel
+    import ast
+
+    docstring: str = ast.get_docstring(ast.parse(path.read_text(encoding="utf8"))) or ""
+    return docstring.strip().split("\n")[0].rstrip(" :-")
+
+
+def _print_tools() -> None:
+    print(f"usage: {Path(sys.argv[0]).name} <tool> [<args>]")
+    print(f"       {Path(sys.argv[0]).name} --script <file>\n")
+    print("tools:")
+    width: int = max(len(tool) for tool in _TOOLS)
+    for tool, path in _TOOLS.items():
+        print(f"  {tool:<{width}}  {_summary(path)}")
+    print("\nUse '<tool> --help' for the tool's help")
+
+
+def _error(message: str) -> None:
+    print(f"{Path(sys.argv[0]).name}: error: {message}", file=sys.stderr)
+    sys.exit(2)
+
+
+def _step(text: str, where: str) -> List[str]:
+    """Splits a step into its tool (without any '.py') and arguments."""
+    argv: List[str] = shlex.split(text, comments=True)
+    if not argv:
+        _error(f"{where}: the step is empty")
+    argv[0] = argv[0].removesuffix(".py")
+    if argv[0] not in _TOOLS:
+        _error(f"{where}: unknown tool '{argv[0]}'")
+    return argv
+
+
+def _read_script(filename: str) -> List[List[List[str]]]:
+    """Reads a script (see the module docstring), returning its steps
+    as groups of steps that are run at the same time.
+    """
+    groups: List[List[List[str]]] = []
+    path: Path = Path(filename)
+    if not path.is_file():
+        _error(f"{filename} does not exist")
+
+    if path.suffix in (".yaml", ".yml"):
+        # pylint: disable=import-outside-toplevel
+        import yaml
+
+        steps: Any = yaml.safe_load(path.read_text(encoding="utf8"))
+        if not isinstance(steps, list):
+            _error(f"{filename} is not a list of steps")
+        for number, step in enumerate(steps, start=1):
+            where: str = f"{filename} step {number}"
+            if isinstance(step, str):
+                groups.append([_step(step, where)])
+            elif isinstance(step, dict) and list(step) == ["parallel"] and isinstance(step["parallel"], list):
+                groups.append([_step(str(parallel_step), where) for parallel_step in step["parallel"]])
+            else:
+                _error(f"{where}: a step must be a tool or a 'parallel' list of tools")
+        return groups
+
+    background: List[List[str]] = []
+    for number, line in enumerate(path.read_text(encoding="utf8").splitlines(), start=1):
+        if not shlex.split(line, comments=True):
+            continue
+        argv: List[str] = _step(line, f"{filename} line {number}")
+        if argv[-1] == "&":
+            background.append(argv[:-1])
+            continue
+        if background:
+            groups.append(background)
+            background = []
+        groups.append([argv])
+    if background:
+        groups.append(background)
+    return groups
+
+
+def _run_step(argv: List[str]) -> int:
+    """Runs a tool (in this process) as if it had been run directly,
+    returning its exit code. Any API metrics the tool records (see its
+    '--metrics' option) are reported when it ends.
+    """
+    # pylint: disable=import-outside-toplevel
+    import metrics
+
+    saved_argv: List[str] = sys.argv
+    sys.argv = [str(_TOOLS[argv[0]]), *argv[1:]]
+    try:
+        runpy.run_path(str(_TOOLS[argv[0]]), run_name="__main__")
+    except SystemExit as exit_ex:
+        if exit_ex.code is None or isinstance(exit_ex.code, int):
+            return exit_ex.code or 0
+        print(exit_ex.code, file=sys.stderr)
+        return 1
+    finally:
+        sys.argv = saved_argv
+        metrics.report()
+    return 0
+
+
+def _run_script(filename: str) -> None:
+    """Runs the steps of a script."""
+    groups: List[List[List[str]]] = _read_script(filename)
+
+    # pylint: disable=import-outside-toplevel
+    import multiprocessing
+    from rich.console import Console
+    from rich.markup import escape
+    from squonk2.environment import Environment
+
+    from common import share_connections
+
+    console = Console()
+
+    # Load the environments once, re-using them for every step
+    environments: List[str] = Environment.load()
+    Environment.load = classmethod(lambda cls: environments)
+    share_connections()
+
+    start: float = time.perf_counter()
+    num_steps: int = 0
+    for group in groups:
+        for argv in group:
+            console.log(f"[bold]{escape(shlex.join(argv))}[/bold]")
+        num_steps += len(group)
+        if len(group) == 1:
+            exit_code: int = _run_step(group[0])
+        else:
+            processes: List[Any] = [
+                multiprocessing.get_context("fork").Process(target=lambda argv=argv: sys.exit(_run_step(argv)))
+                for argv in group
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            # (a process killed by a signal has a negative exit code)
+            exit_code = max((abs(process.exitcode) for process in processes), default=0)
+        if exit_code:
+            console.log(f"[bold red]ERROR[/bold red] Step failed (exit code {exit_code})")
+            sys.exit(exit_code)
+    console.log(f"Ran {num_steps} steps in {time.perf_counter() - start:.1f}s")
+
+
+def main(argv: List[str]) -> None:
+    """Main function."""
+
+    if not argv or argv[0] in ("-h", "--help"):
+        _print_tools()
+        return
+    if argv[0] == "--script":
+        if len(argv) != 2:
+            _error("--script expects one script file")
+        _run_script(argv[1])
+        return
+    tool: str = argv[0].removesuffix(".py")
+    if tool not in _TOOLS:
+        _error(f"unknown tool '{argv[0]}' (choose from {', '.join(_TOOLS)})")
+
+    # Run the tool as if it had been run directly
+    sys.argv = [str(_TOOLS[tool]), *argv[1:]]
+    runpy.run_path(str(_TOOLS[tool]), run_name="__main__")
+
+
+if __name__ == "__main__":
+
+    main(sys.argv[1:])
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""Copies AS Organisations, Units, Products and their charges
+into a local SQLite database (see warehouse.py) that can then be used
+by reporting tools (like org-jobs, coins and get-job-executions)
+with their '--from-db' option.
+
+The sync is incremental. Closed billing periods are fetched once,
+only the current (open) billing period and any periods not yet stored
+are fetched on later runs.
+"""
+import argparse
+from datetime import datetime
+import sqlite3
+import sys
+from typing import Any, Dict, List, Tuple
+import urllib3
+
+from rich.console import Console
+from squonk2.as_api import AsApi, AsApiRv
+from squonk2.environment import Environment
+
+from common import ParallelRunner, call_with_retries, get_access_token
+import metrics
+import warehouse
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+
+def main(c_args: argparse.Namespace, runner: ParallelRunner) -> None:
+    """Main function."""
+
+    console = Console()
+
+    _ = Environment.load()
+    env: Environment = Environment(c_args.environment)
+    AsApi.set_api_url(env.as_api)
+
+    token: str = get_access_token(env, client_id=env.keycloak_as_client_id)
+    if not token:
+        console.log("[bold red]ERROR[/bold red] Failed to get token")
+        sys.exit(1)
+
+    conn: sqlite3.Connection = warehouse.connect(c_args.database)
+
+    # Organisations (all of them or just the one)
+    if c_args.org:
+        org_rv: AsApiRv = AsApi.get_organisation(token, org_id=c_args.org)
+        orgs: List[Dict[str, Any]] = [org_rv.msg] if org_rv.success else []
+    else:
+        org_rv = AsApi.get_organisations(token)
+        orgs = org_rv.msg.get('organisations', [])
+    if not org_rv.success:
+        console.log(org_rv.msg)
+        console.log("[bold red]ERROR[/bold red] Failed to get organisations")
+        sys.exit(1)
+    for org in orgs:
+        warehouse.put_organisation(conn, org['id'], org['name'])
+
+    # Their Units and Products
+    unit_rvs: List[AsApiRv] = runner.run(
+        _get_units,
+        [(token, org['id']) for org in orgs],
+    )
+    unit_ids: List[str] = []
+    for org, unit_rv in zip(orgs, unit_rvs):
+        for unit in unit_rv.msg.get('units', []):
+            warehouse.put_unit(conn, unit['id'], unit['name'], org['id'])
+            unit_ids.append(unit['id'])
+    products_rvs: List[AsApiRv] = runner.run(
+        _get_products_for_unit,
+        [(token, unit_id) for unit_id in unit_ids],
+    )
+    product_ids: List[str] = []
+    for unit_id, products_rv in zip(unit_ids, products_rvs):
+        for product in products_rv.msg.get('products', []):
+            warehouse.put_product(conn, product['product']['id'], product['product']['name'], unit_id)
+            product_ids.append(product['product']['id'])
+    conn.commit()
+    console.log(f'{len(orgs)} Organisations, {len(unit_ids)} Units, {len(product_ids)} Products')
+
+    # The charges for each Product,
+    # skipping the closed billing periods we already have
+    period_rvs: List[List[Tuple[int, AsApiRv]]] = runner.run(
+        _get_new_product_charges,
+        [(token, product_id, c_args.max_pbp, warehouse.get_closed_periods(conn, product_id))
+         for product_id in product_ids],
+    )
+    synced: str = str(datetime.utcnow())
+    num_requests: int = 0
+    num_failed: int = 0
+    for product_id, product_period_rvs in zip(product_ids, period_rvs):
+        for pbp, c_rv in product_period_rvs:
+            num_requests += 1
+            if c_rv.success:
+                warehouse.put_period_charges(conn, product_id, c_rv.msg, closed=pbp < 0, synced=synced)
+            else:
+                num_failed += 1
+                console.log(f"[bold red]ERROR[/bold red] Failed to get [blue]{product_id}[/blue] (pbp {pbp})")
+        conn.commit()
+    conn.close()
+
+    num_possible: int = len(product_ids) * (1 - c_args.max_pbp)
+    console.log(f'Charge requests {num_requests} (of {num_possible})')
+    if num_failed:
+        console.log(f'Charge request failures {num_failed}')
+        sys.exit(1)
+
+
+def _get_units(request: Tuple[str, str]) -> AsApiRv:
+    """Gets the units for a (token, organisation ID) request."""
+    token, org_id = request
+    return AsApi.get_units(token, org_id=org_id)
+
+
+def _get_products_for_unit(request: Tuple[str, str]) -> AsApiRv:
+    """Gets the products for a (token, unit ID) request."""
+    token, unit_id = request
+    return AsApi.get_products_for_unit(token, unit_id=unit_id)
+
+
+def _get_new_product_charges(
+        request: Tuple[str, str, int, Dict[str, str]]) -> List[Tuple[int, AsApiRv]]:
+    """Gets the charges for the current billing period of a
+    (token, product ID, max pbp, closed periods) request, and for each prior
+    billing period (back to max pbp) that is not one of the closed periods.
+    The closed periods are indexed by the date they end (their 'until').
+    Periods are walked back using their 'from' date so the stored
+    closed periods can be stepped over without making any requests.
+    Each request is retried (see call_with_retries()), as the runner
+    cannot retry a list of results.
+    """
+    token, product_id, max_pbp, closed_periods = request
+    c_rv: AsApiRv = call_with_retries(lambda: AsApi.get_product_charges(token, product_id=product_id, pbp=0))
+    period_rvs: List[Tuple[int, AsApiRv]] = [(0, c_rv)]
+    if not c_rv.success:
+        return period_rvs
+    period_from: str = c_rv.msg['from']
+    for pbp in range(-1, max_pbp - 1, -1):
+        if period_from in closed_periods:
+            period_from = closed_periods[period_from]
+            continue
+        c_rv = call_with_retries(
+            lambda period=pbp: AsApi.get_product_charges(token, product_id=product_id, pbp=period))
+        period_rvs.append((pbp, c_rv))
+        if not c_rv.success:
+            break
+        period_from = c_rv.msg['from']
+    return period_rvs
+
+
+if __name__ == "__main__":
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        prog="sync-charges",
+        description="Copies Organisations, Units, Products and charges into a local SQLite database"
+    )
+    parser.add_argument('environment', type=str, help='The environment name')
+    parser.add_argument('--org', type=str, help='Only sync this Organisation (UUID)')
+    parser.add_argument('--database', type=str, help='The database file', default=warehouse.DEFAULT_DATABASE)
+    parser.add_argument('--max-pbp', type=int, help='The maximum Prior Billing Period to sync', default=-23)
+    parser.add_argument('--workers', type=int, help='The number of concurrent requests', default=1)
+    parser.add_argument('--metrics', type=str, nargs='?', const=metrics.SUMMARY,
+                        help='Print a summary of the API calls made,'
+                             ' or write them to this Prometheus textfile')
+    args: argparse.Namespace = parser.parse_args()
+    if args.max_pbp > 0:
+        parser.error("The maximum Prior Billing Period cannot be greater than zero")
+    elif args.max_pbp < -23:
+        parser.error("The earliest Prior Billing Period cannot be less than -23")
+    if args.workers < 1:
+        parser.error("The number of workers must be at least 1")
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    # (one runner, its pool of workers and request pacing, for every request)
+    with ParallelRunner(environment=args.environment, workers=args.workers) as runner:
+        main(args, runner)
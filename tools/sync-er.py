@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Synchronises Job/Application Exchange Rates between two environments.
+The rates in both environments are indexed by collection, job and version
+and only rates that are new or different in the source environment
+are set in the target environment.
+"""
+import argparse
+from decimal import Decimal
+import sys
+from typing import Any, Dict, List, Tuple
+import urllib3
+
+from rich.console import Console
+from squonk2.dm_api import DmApi, DmApiRv
+from squonk2.environment import Environment
+
+from common import get_access_token, run_in_parallel, set_job_exchange_rate
+import metrics
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# A rate's index key, (collection, job, version)
+RateKey = Tuple[str, str, str]
+
+
+def main(c_args: argparse.Namespace) -> None:
+    """Main function."""
+
+    console = Console()
+
+    _ = Environment.load()
+    tokens: List[str] = []
+    for environment in (c_args.source, c_args.target):
+        env: Environment = Environment(environment)
+        token: str = get_access_token(env, client_id=env.keycloak_dm_client_id)
+        if not token:
+            console.log(f"[bold red]ERROR[/bold red] Failed to get token for {environment}")
+            sys.exit(1)
+        tokens.append(token)
+
+    # Get the rates from both environments (at the same time)
+    er_rvs: List[DmApiRv] = run_in_parallel(
+        _get_rates,
+        [(c_args.source, tokens[0]), (c_args.target, tokens[1])],
+        environment=c_args.source,
+        workers=2,
+    )
+    for environment, er_rv in zip((c_args.source, c_args.target), er_rvs):
+        if not er_rv.success:
+            console.log(f'[bold red]ERROR[/bold red] {environment} {er_rv.msg["error"]}')
+            sys.exit(1)
+    source_rates: Dict[RateKey, Dict[str, Any]] = _index_rates(er_rvs[0].msg['exchange_rates'])
+    target_rates: Dict[RateKey, Dict[str, Any]] = _index_rates(er_rvs[1].msg['exchange_rates'])
+
+    # What's new or changed?
+    new_rates: List[Dict[str, Any]] = []
+    num_unchanged: int = 0
+    for key in sorted(source_rates):
+        rate: Dict[str, Any] = source_rates[key]
+        job: str = '/'.join(key)
+        target_rate: Dict[str, Any] = target_rates.get(key)
+        if target_rate is None:
+            console.log(f':heavy_plus_sign: {job} :moneybag:[gold3]{rate["rate"]}[/gold3]')
+        elif Decimal(target_rate['rate']) != Decimal(rate['rate']) \
+                or target_rate.get('comment') != rate.get('comment'):
+            console.log(f':pencil: {job} :moneybag:[gold3]{target_rate["rate"]}[/gold3]'
+                        f' -> [gold3]{rate["rate"]}[/gold3]')
+        else:
+            num_unchanged += 1
+            continue
+        new_rates.append(rate)
+
+    num_rates: int = 0
+    num_rates_failed: int = 0
+    if c_args.do_it and new_rates:
+        DmApi.set_api_url(Environment(c_args.target).dm_api)
+        set_rvs: List[DmApiRv] = run_in_parallel(
+            set_job_exchange_rate,
+            [(tokens[1], rate) for rate in new_rates],
+            environment=c_args.target,
+            workers=c_args.workers,
+            max_rps=c_args.max_rps,
+        )
+        for rate, set_rv in zip(new_rates, set_rvs):
+            if set_rv.success:
+                num_rates += 1
+            else:
+                num_rates_failed += 1
+                console.log(f':cross_mark: {rate["collection"]}/{rate["job"]}/{rate["version"]}')
+
+    # Summary
+    console.log(f'Job rates unchanged {num_unchanged}')
+    console.log(f'Job rates new or changed {len(new_rates)}')
+    if c_args.do_it:
+        console.log(f'Job rates set {num_rates}')
+        if num_rates_failed:
+            console.log(f'Job rate failures {num_rates_failed}')
+            sys.exit(1)
+
+
+def _index_rates(rates: List[Dict[str, Any]]) -> Dict[RateKey, Dict[str, Any]]:
+    """Indexes rates by (collection, job, version), removing their 'id'."""
+    index: Dict[RateKey, Dict[str, Any]] = {}
+    for rate in rates:
+        rate.pop('id', None)
+        index[(rate['collection'], rate['job'], rate['version'])] = rate
+    return index
+
+
+def _get_rates(request: Tuple[str, str]) -> DmApiRv:
+    """Gets the rates for an (environment, token) request."""
+    environment, token = request
+    _ = Environment.load()
+    DmApi.set_api_url(Environment(environment).dm_api)
+    return DmApi.get_job_exchange_rates(token)
+
+
+if __name__ == "__main__":
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        prog="sync-er",
+        description="Copies new or changed exchange rates from one environment to another"
+    )
+    parser.add_argument('source', type=str, help='The environment to copy rates from')
+    parser.add_argument('target', type=str, help='The environment to copy rates to')
+    parser.add_argument('--workers', type=int, help='The number of concurrent rate requests', default=1)
+    parser.add_argument('--max-rps', type=float,
+                        help='The most rate requests to start each second (the default is no limit)')
+    parser.add_argument(
+        '--do-it',
+        help='Set to actually set the rates, if not set the differences are listed',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--metrics',
+        help='Print a summary of the API calls made,'
+             ' or write them to this Prometheus textfile',
+        type=str,
+        nargs='?',
+        const=metrics.SUMMARY,
+    )
+    args: argparse.Namespace = parser.parse_args()
+    if args.source == args.target:
+        parser.error("The source and target environments must be different")
+    if args.workers < 1:
+        parser.error("The number of workers must be at least 1")
+    if args.max_rps is not None and args.max_rps <= 0:
+        parser.error("The maximum requests per second must be greater than zero")
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    main(args)
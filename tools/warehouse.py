@@ -0,0 +1,221 @@
+"""A local SQLite copy of AS Organisations, Units, Products and their charges.
+
+The database is filled by the sync-charges tool and read by the reporting
+tools (when given '--from-db'). Charges are stored for each Product's billing
+period (identified by the period's 'from' date). Closed (prior) billing periods
+never change, so a period that's been stored closed is never fetched again.
+The raw JSON of each charge is kept so charge responses can be rebuilt
+for tools that expect them.
+"""
+from datetime import date
+import json
+import os
+from pathlib import Path
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from common import get_pbp
+
+# The default database
+DEFAULT_DATABASE: str = os.environ.get("SQUONK2_CHARGE_DATABASE", "~/.squonk2/charges.db")
+
+# The processing charge columns get_executions() can test
+EXECUTION_COLUMNS: Tuple[str, ...] = ("username", "job_collection", "job_job", "job_version", "started")
+
+# The SQL of each get_executions() condition operator
+# (a missing value matches as an empty string, as it does in the tools)
+_CONDITION_OPERATORS: Dict[str, str] = {
+    "=": "IFNULL({}, '') GLOB ?",
+    "!=": "NOT IFNULL({}, '') GLOB ?",
+    ">=": "IFNULL({}, '') >= ?",
+    "<": "IFNULL({}, '') < ?",
+}
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS organisation (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS unit (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    organisation_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS unit_organisation ON unit (organisation_id);
+CREATE TABLE IF NOT EXISTS product (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    unit_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS product_unit ON product (unit_id);
+CREATE TABLE IF NOT EXISTS period (
+    product_id TEXT NOT NULL,
+    period_from TEXT NOT NULL,
+    period_until TEXT NOT NULL,
+    closed INTEGER NOT NULL,
+    synced TEXT NOT NULL,
+    PRIMARY KEY (product_id, period_from)
+);
+CREATE TABLE IF NOT EXISTS processing_charge (
+    product_id TEXT NOT NULL,
+    period_from TEXT NOT NULL,
+    timestamp TEXT,
+    username TEXT,
+    coins TEXT NOT NULL,
+    closed INTEGER NOT NULL,
+    job_collection TEXT,
+    job_job TEXT,
+    job_version TEXT,
+    started TEXT,
+    raw TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS processing_charge_period ON processing_charge (product_id, period_from);
+CREATE INDEX IF NOT EXISTS processing_charge_timestamp ON processing_charge (timestamp);
+CREATE INDEX IF NOT EXISTS processing_charge_job ON processing_charge (job_collection, job_job, job_version);
+CREATE INDEX IF NOT EXISTS processing_charge_username ON processing_charge (username);
+CREATE TABLE IF NOT EXISTS storage_charge (
+    product_id TEXT NOT NULL,
+    period_from TEXT NOT NULL,
+    date TEXT,
+    coins TEXT NOT NULL,
+    raw TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS storage_charge_period ON storage_charge (product_id, period_from);
+"""
+
+
+def connect(filename: str = DEFAULT_DATABASE) -> sqlite3.Connection:
+    """Opens (creating if necessary) the database."""
+    path: Path = Path(filename).expanduser()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn: sqlite3.Connection = sqlite3.connect(path)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def put_organisation(conn: sqlite3.Connection, org_id: str, name: str) -> None:
+    """Inserts (or renames) an Organisation."""
+    conn.execute("INSERT INTO organisation (id, name) VALUES (?, ?)"
+                 " ON CONFLICT (id) DO UPDATE SET name = excluded.name",
+                 (org_id, name))
+
+
+def put_unit(conn: sqlite3.Connection, unit_id: str, name: str, org_id: str) -> None:
+    """Inserts (or updates) a Unit."""
+    conn.execute("INSERT INTO unit (id, name, organisation_id) VALUES (?, ?, ?)"
+                 " ON CONFLICT (id) DO UPDATE SET name = excluded.name,"
+                 " organisation_id = excluded.organisation_id",
+                 (unit_id, name, org_id))
+
+
+def put_product(conn: sqlite3.Connection, product_id: str, name: str, unit_id: str) -> None:
+    """Inserts (or updates) a Product."""
+    conn.execute("INSERT INTO product (id, name, unit_id) VALUES (?, ?, ?)"
+                 " ON CONFLICT (id) DO UPDATE SET name = excluded.name,"
+                 " unit_id = excluded.unit_id",
+                 (product_id, name, unit_id))
+
+
+def get_closed_periods(conn: sqlite3.Connection, product_id: str) -> Dict[str, str]:
+    """Returns the 'from' date of each stored closed billing period,
+    indexed by its 'until' date (the 'from' date of the period that follows it).
+    """
+    return dict(conn.execute("SELECT period_until, period_from FROM period"
+                             " WHERE product_id = ? AND closed = 1",
+                             (product_id,)))
+
+
+def put_period_charges(conn: sqlite3.Connection,
+                       product_id: str,
+                       charges: Dict[str, Any],
+                       *,
+                       closed: bool,
+                       synced: str) -> None:
+    """Stores (replacing any that are stored) a Product's charges for a billing
+    period, using the response from AsApi.get_product_charges().
+    """
+    period_from: str = charges["from"]
+    conn.execute("DELETE FROM processing_charge WHERE product_id = ? AND period_from = ?",
+                 (product_id, period_from))
+    conn.execute("DELETE FROM storage_charge WHERE product_id = ? AND period_from = ?",
+                 (product_id, period_from))
+    processing_rows: List[tuple] = []
+    for processing_charge in charges.get("processing_charges") or []:
+        charge: Dict[str, Any] = processing_charge["charge"]
+        ad: Dict[str, Any] = charge.get("additional_data", {})
+        processing_rows.append((product_id, period_from, charge.get("timestamp"),
+                                charge.get("username"), charge["coins"],
+                                "closed" in processing_charge,
+                                ad.get("job_collection"), ad.get("job_job"),
+                                ad.get("job_version"), ad.get("started"),
+                                json.dumps(processing_charge)))
+    conn.executemany("INSERT INTO processing_charge VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     processing_rows)
+    storage_rows: List[tuple] = [(product_id, period_from, item.get("date"), item["coins"], json.dumps(item))
+                                 for item in charges.get("storage_charges", {}).get("items", [])]
+    conn.executemany("INSERT INTO storage_charge VALUES (?, ?, ?, ?, ?)", storage_rows)
+    conn.execute("INSERT OR REPLACE INTO period VALUES (?, ?, ?, ?, ?)",
+                 (product_id, period_from, charges["until"], closed, synced))
+
+
+def get_organisation_products(conn: sqlite3.Connection, org_id: str) -> List[tuple]:
+    """Returns the (ID, name, Unit name) of an Organisation's Products
+    (in the order they were stored).
+    """
+    return conn.execute(
+        "SELECT product.id, product.name, unit.name FROM product"
+        " JOIN unit ON product.unit_id = unit.id"
+        " WHERE unit.organisation_id = ? ORDER BY unit.rowid, product.rowid",
+        (org_id,)).fetchall()
+
+
+def get_product_charges(conn: sqlite3.Connection,
+                        product_id: str,
+                        pbp: int) -> Optional[Dict[str, Any]]:
+    """Rebuilds a Product's charges for a prior billing period (counting back
+    from today's period) in the form returned by AsApi.get_product_charges().
+    None is returned if the period is not stored (i.e. sync-charges has not
+    been run since the period started).
+    """
+    today: date = date.today()
+    periods: List[tuple] = conn.execute(
+        "SELECT period_from, period_until FROM period WHERE product_id = ?"
+        " ORDER BY period_from DESC", (product_id,)).fetchall()
+    period: Optional[tuple] = next((period for period in periods if get_pbp(period[0], today) == pbp), None)
+    if not period:
+        return None
+    period_from, period_until = period
+    processing_charges: List[Dict[str, Any]] = [json.loads(row[0]) for row in conn.execute(
+        "SELECT raw FROM processing_charge WHERE product_id = ? AND period_from = ? ORDER BY rowid",
+        (product_id, period_from))]
+    items: List[Dict[str, Any]] = [json.loads(row[0]) for row in conn.execute(
+        "SELECT raw FROM storage_charge WHERE product_id = ? AND period_from = ? ORDER BY rowid",
+        (product_id, period_from))]
+    return {"from": period_from,
+            "until": period_until,
+            "processing_charges": processing_charges,
+            "storage_charges": {"items": items}}
+
+
+def get_executions(conn: sqlite3.Connection,
+                   product_id: str,
+                   from_date: str,
+                   conditions: Iterable[Tuple[str, str, str]] = ()) -> List[tuple]:
+    """Returns the (username, collection, job, version, started, coins)
+    of a Product's Job executions from a date.
+
+    Each condition is a (column, operator, value) the executions must match,
+    where the column is one of EXECUTION_COLUMNS and the operator is '=' or '!='
+    (the value is a glob pattern) or '>=' or '<'.
+    """
+    sql: str = ("SELECT username, job_collection, job_job, job_version, started, coins"
+                " FROM processing_charge WHERE product_id = ? AND timestamp >= ?"
+                " AND job_collection IS NOT NULL")
+    params: List[str] = [product_id, from_date]
+    for column, operator, value in conditions:
+        if column not in EXECUTION_COLUMNS or operator not in _CONDITION_OPERATORS:
+            raise ValueError(f"Invalid condition '{column}{operator}{value}'")
+        sql += f" AND {_CONDITION_OPERATORS[operator].format(column)}"
+        params.append(value)
+    # (in time order, as the AS returns them)
+    return conn.execute(sql + " ORDER BY timestamp, rowid", params).fetchall()